@@ -0,0 +1,145 @@
+import numpy as np
+from audio_processing import AudioProcessor, VocoderState
+from instrumentation import phase
+from sidecar import Sidecar
+
+class AnalysisIndex(Sidecar):
+    """ Short-Time Fourier Transform analysis of a whole file.
+
+    The analysis doesn't depend on the stretch factor, so it is computed once per file
+    and every later computation only propagates phases and synthesises the blocks.
+    For every frame on the grid of hop_a samples from the start of the file it holds
+    magnitudes and phases as float32, the transient flag and the regions of spectral peaks.
+    This takes about 10 bytes per bin, around 0.9 MB per second of audio with the default settings.
+
+    The index can be saved into a sidecar .stft.npz file next to the audio file, so reopening the file
+    skips the analysis.
+    """
+    suffix = ".stft.npz"
+    version = 2
+
+    def __init__(self, magnitude: np.ndarray, phase: np.ndarray, is_transient: np.ndarray,
+                 peak_of: np.ndarray, window_len: int, hop_a: int, data_len: int, transients: str):
+        self.magnitude = magnitude
+        self.phase = phase
+        self.is_transient = is_transient
+        self.peak_of = peak_of
+
+        self.window_len = window_len
+        self.hop_a = hop_a
+        # Length of the analysed data, used to check the index belongs to it
+        self.data_len = data_len
+        # Key of the transient detector which computed is_transient, as a string
+        self.transients = transients
+
+
+    @classmethod
+    def build(cls, processor: AudioProcessor, progress=None) -> "AnalysisIndex":
+        """ Analyses all data of the processor in batches of frames.
+        progress is called with the part of the frames done after every batch
+        """
+        window_len = processor.window_len
+        hop_a = processor.analysis_hop()
+        data = processor.data
+
+        num_frames = max((len(data) - window_len) // hop_a + 1, 0)
+        num_bins = window_len // 2 + 1
+
+        magnitude = np.empty((num_frames, num_bins), dtype=np.float32)
+        phase = np.empty((num_frames, num_bins), dtype=np.float32)
+        is_transient = np.empty(num_frames, dtype=bool)
+        peak_of = np.empty((num_frames, num_bins), dtype=np.int16 if num_bins <= 2**15 else np.int32)
+
+        # Transient detection continues from one batch to the next
+        state = VocoderState()
+
+        for first in range(0, num_frames, processor.batch_size):
+            batch = slice(first, min(first + processor.batch_size, num_frames))
+
+            # Data is read one batch at a time, so it can be an AudioSource decoding the file lazily
+            samples = data[first * hop_a: (batch.stop - 1) * hop_a + window_len]
+            frames = processor.frames(samples, hop_a)
+            mag, current_phase, is_transient[batch] = processor.analyse(frames, state)
+
+            magnitude[batch] = mag
+            phase[batch] = current_phase
+            _, peak_of[batch] = processor.locate_peaks(mag)
+
+            if progress is not None:
+                progress(batch.stop / num_frames)
+
+        return cls(magnitude, phase, is_transient, peak_of, window_len, hop_a, len(data), str(processor.transients.key()))
+
+
+    def matches(self, processor: AudioProcessor) -> bool:
+        """ Returns True if the index was computed from the data with the settings of the processor.
+        Only mono data is indexed, the short window of the adaptive mode is not stored
+        """
+        return (processor.channels == 1 and not processor.adaptive and self.window_len == processor.window_len and self.hop_a == processor.analysis_hop()
+                and self.data_len == len(processor.data) and self.transients == str(processor.transients.key()))
+
+
+    def grid(self, start_index: int, end_index: int, hop_s: int) -> tuple:
+        """ Returns the index of the first frame lying completely inside the range, the number of such frames
+        and the delay of the output of the first frame in the result of vocode
+        """
+        first = -(-start_index // self.hop_a)
+        end = (end_index - self.window_len) // self.hop_a + 1
+        shift = int(round((first * self.hop_a - start_index) * hop_s / self.hop_a))
+        return first, max(end - first, 0), shift
+
+
+    def vocode(self, processor: AudioProcessor, start_index: int, end_index: int, hop_s: int,
+               state=None) -> np.ndarray:
+        """ Same as AudioProcessor.vocode of data[start_index:end_index], but using the stored analysis.
+
+        The frames lie on the grid of the whole file, so the first frame can start up to hop_a - 1 samples
+        after start_index. The result is delayed by the same time, so it stays aligned with start_index.
+        A new VocoderState can be passed in, it is left after the last frame.
+        """
+        first, num_frames, shift = self.grid(start_index, end_index, hop_s)
+        result = np.zeros(shift + num_frames * hop_s + self.window_len, dtype=processor.dtype)
+
+        # The first frame of the range is initialised as a new starting frame
+        plan = processor.plan(hop_s)
+        if state is None:
+            state = VocoderState(plan.workspace())
+
+        for start in range(first, first + num_frames, processor.batch_size):
+            batch = slice(start, min(start + processor.batch_size, first + num_frames))
+
+            peak_of = self.peak_of[batch] if processor.phase_lock else None
+            with phase("synthesis"):
+                output = processor.resynthesise(self.magnitude[batch].astype(processor.dtype),
+                                                self.phase[batch].astype(processor.dtype),
+                                                self.is_transient[batch].copy(), self.hop_a, hop_s, state, peak_of,
+                                                plan)
+
+                processor.overlap_add(result, output, shift + (start - first) * hop_s, hop_s)
+
+        return result
+
+
+    def settings(self) -> tuple:
+        return (self.window_len, self.hop_a, self.data_len)
+
+
+    def arrays(self) -> dict:
+        return {"magnitude": self.magnitude, "phase": self.phase, "is_transient": self.is_transient,
+                "peak_of": self.peak_of, "transients": np.array(self.transients)}
+
+
+    @classmethod
+    def from_file(cls, file, settings: tuple) -> "AnalysisIndex":
+        window_len, hop_a, data_len = settings
+        return cls(file["magnitude"], file["phase"], file["is_transient"], file["peak_of"],
+                   window_len, hop_a, data_len, str(file["transients"]))
+
+
+    @classmethod
+    def for_file(cls, processor: AudioProcessor, source_path: str, progress=None) -> "AnalysisIndex":
+        """ Loads the sidecar file of source_path if it matches the processor,
+        otherwise analyses the data, reporting the progress like build, and tries to save the sidecar file
+        """
+        return cls.load_or_create(source_path, lambda: cls.build(processor, progress),
+                                  lambda index: index.matches(processor))
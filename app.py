@@ -1,20 +1,56 @@
-import soundfile as sf
 from tkinter import *
 from tkinter import ttk
 from tkinter import filedialog
-from audio_processing import *
+import numpy as np
+from audio_processing import AudioProcessor
+from streaming import StreamingVocoder
+from worker import PlaybackBuffer, PlaybackProducer, RenderWorker
+from ring_buffer import RingBuffer
+from analysis import AnalysisIndex
+from waveform import PeakPyramid
+from instrumentation import Instrumentation
+from latency import PROFILES, LatencyController, choose_settings
+from time import perf_counter
 import os
+import threading
 
 class App:
-    """Class handling GUI, playback and setting logic"""
-    def __init__(self, root: Tk):
+    """ Class handling GUI, playback and setting logic.
+
+    The window is shown before any file is opened. Files are opened in a background thread
+    (soundfile is imported only there), so the window keeps responding while they load.
+    started is the perf_counter time the program started, the time until the first paint is measured from it
+    """
+    def __init__(self, root: Tk, started=None):
         self.file_path = None
         self.file_name = "" 
+        self.AP = None
 
         self.is_playing = False
 
-        # Array used for audio playback
-        self.out_data = None
+        # Snapshot of the array used for audio playback and its playback indexes
+        self.playback = None
+
+        # Computes out_data in the background, processes can be used instead of threads
+        self.use_processes = False
+        self.worker = None
+        # Settings of out_data being computed and whether to start playing once it is ready
+        self.pending_render = None
+        self.play_when_ready = False
+        # Render of the current out_data, a moved loop near it only extends it
+        self.render = None
+        # Pending after() call applying settings changed during playback
+        self.update_job = None
+
+        # Processor computing the audio while it is played, used instead of out_data in streaming mode
+        self.use_streaming = False
+        self.streamer = None
+
+        # Files up to this length are analysed once in the background, the index takes about 0.9 MB per second
+        self.analysis_max_seconds = 300
+
+        # Multichannel files are played with all their channels, unless they are mixed down to mono
+        self.mono = False
 
         self.stretch_factor = 1.0
         self.pitch_factor = 1.0
@@ -34,25 +70,61 @@ class App:
         self.start_index = None
         self.end_index = None
 
-        # Indexes of the out_data array for the selected segment
-        self.pb_start_index = None
-        self.pb_end_index = None
-        
-        # Index of the start of currently playing chunk of audio
-        self.i = None
-
         # Size of the chunk of audio requested by callback function for OutputStream in main.py
+        # and the latency requested from sounddevice, both are chosen by the latency profile
         self.out_blocksize = 1024
-        
-        # Prepare gui and open a sound file
+        self.out_latency = "high"
+        # Selected latency profile, it switches to a safer one after repeated dropouts
+        self.latency = LatencyController()
+        self.latency_checked = 0.0
+
+        # Shortest loop which can be played in seconds, it doesn't depend on the blocksize
+        self.min_loop_seconds = 0.05
+
+        # Frames waiting for the callback, filled by the producer thread, and the capacity in blocks
+        # A larger capacity survives longer stalls of the producer but delays changes of the streamed audio
+        self.ring = None
+        self.producer = None
+        self.ring_blocks = 4
+
+        # Timing of the playback and the processing, shown in the debug panel
+        self.instrumentation = Instrumentation()
+        self.debug_window = None
+        self.debug_updated = 0.0
+        # When the audio being computed in the background was requested
+        self.render_started = None
+
+        # Thread opening a file and its result, the path and the opened AudioSource or the raised exception
+        self.loader = None
+        self.loaded = None
+        # Part of the analysis of the opened file done, None if it is not running
+        self.analysis_progress = None
+
+        # Peak pyramid of the opened file drawn in the waveform, None until it is computed,
+        # the thread computing it and the range of original samples shown
+        self.peaks = None
+        self.peaks_loader = None
+        self.view_start = 0
+        self.view_end = 1
+        # Position where dragging the waveform started and the view start at that moment
+        self.drag_start = None
+
+        # Prepare gui, the file dialog opens once the window is drawn
+        self.started = perf_counter() if started is None else started
         self.build_gui(root)
-        self.openfile()
+        self.root.after_idle(self.shown)
+
+
+    def shown(self):
+        """Called once the window is drawn, records the startup time and asks for a file"""
+        self.instrumentation.record_startup(perf_counter() - self.started)
+        self.root.after(1, self.openfile)
 
 
     def build_gui(self, root: Tk):
         # Root is the parent node of every piece of the gui
         self.root = root
-        self.root.geometry("600x480")
+        self.root.geometry("600x600")
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
         self.root.resizable(False, False)
@@ -60,7 +132,7 @@ class App:
         # Frame is a child of root, which will have all other elements as children
         self.frame = Frame(self.root)
         self.frame.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
-        for i in range(7):
+        for i in range(8):
             self.frame.rowconfigure(i, weight=1)
         for i in range(4):
             self.frame.columnconfigure(i, weight=1)
@@ -79,7 +151,7 @@ class App:
         self.time.grid(row=1, column=0, sticky="w")
 
         # Visualise playback
-        self.pb_bar = ttk.Progressbar(self.frame, value=self.i, 
+        self.pb_bar = ttk.Progressbar(self.frame, value=0, 
                                       mode="determinate", maximum=100, orient="horizontal")
         self.pb_bar.grid(row=1, column=1, columnspan=3, sticky="ew")
 
@@ -135,43 +207,153 @@ class App:
         self.rewind_button = Button(self.frame, text="Rewind", command=self.rewind, height=1, width=6)
         self.rewind_button.grid(row=6, column=2,  columnspan=1)
 
+        # Streaming mode toggle
+        self.streaming_var = BooleanVar(value=self.use_streaming)
+        self.streaming_check = Checkbutton(self.frame, text="Stream", variable=self.streaming_var,
+                                           command=self.toggle_streaming)
+        self.streaming_check.grid(row=6, column=3)
+
+        # Debug panel with the timing of the playback and the processing
+        self.debug_button = Button(self.frame, text="Debug", command=self.toggle_debug, height=1, width=6)
+        self.debug_button.grid(row=6, column=0)
+
+        # Latency profile of the output stream
+        self.latency_var = StringVar(value=self.latency.profile)
+        self.latency_menu = OptionMenu(self.frame, self.latency_var, *PROFILES, command=self.select_latency)
+        self.latency_menu.grid(row=0, column=3)
+
+        # Waveform with the loop and the playhead, a click moves the closer loop marker,
+        # the mouse wheel zooms and dragging with the right button scrolls
+        self.waveform = Canvas(self.frame, height=120, background="white", highlightthickness=0)
+        self.waveform.grid(row=7, column=0, columnspan=4, sticky="ew")
+        self.waveform.bind("<Configure>", lambda event: self.draw_waveform())
+        self.waveform.bind("<ButtonPress-1>", self.click_waveform)
+        self.waveform.bind("<MouseWheel>", lambda event: self.zoom_waveform(event.x, event.delta > 0))
+        self.waveform.bind("<Button-4>", lambda event: self.zoom_waveform(event.x, True))
+        self.waveform.bind("<Button-5>", lambda event: self.zoom_waveform(event.x, False))
+        self.waveform.bind("<ButtonPress-3>", self.start_drag)
+        self.waveform.bind("<B3-Motion>", self.drag_waveform)
+
 
     def openfile(self, value=None):
-        """Opens a sound file and initialises AudioProcessor and all internal attributes"""
+        """Asks for a sound file and starts opening it in the background"""
+        # Only one file is opened at a time, the button is disabled until it is loaded
+        if self.loader is not None:
+            return
 
         if self.is_playing:
             self.pause()
 
-        self.file_path = filedialog.askopenfilename(initialdir = os.getcwd(),
+        # The opened file keeps its path until the next one is loaded
+        path = filedialog.askopenfilename(initialdir = os.getcwd(),
                                           title = "Select a File",
                                           filetypes = [("WAV", "*.wav"),
                                                        ("FLAC", "*.flac"),
                                                         ("MP3", "*.mp3")])
-        if not self.file_path:
+        if not path:
             return
         
         # Extract file name from its path
-        self.file_name = self.file_path.split("/")[-1]
-        self.title["text"] = "File: " + self.file_name
-        
-        # Open sound file, convert all files to mono and initialise AudioProcessor
-        d, sr = sf.read(self.file_path, dtype="float32", always_2d=True)
-        d = np.mean(d, axis=1)
+        self.file_name = path.split("/")[-1]
+        self.title["text"] = "Loading: " + self.file_name
+        self.pb_bar.config(mode="indeterminate")
+        self.pb_bar.start(20)
+        self.file_button.config(state="disabled")
+
+        self.loaded = None
+        self.loader = threading.Thread(target=self.load_file, args=(path, self.mono), daemon=True)
+        self.loader.start()
+        self.root.after(20, self.check_loading)
+
+
+    def load_file(self, path: str, mono: bool):
+        """ Opens the sound file in the loading thread and decodes its first block, so the first render
+        doesn't wait for the decoder. soundfile is imported here, not at startup.
+        loaded is set to the path and the AudioSource, or to the error
+        """
+        try:
+            from source import AudioSource
+
+            source = AudioSource(path, mono=mono)
+            source[0: min(source.block_len, len(source))]
+            self.loaded = (path, source)
+        except Exception as error:
+            self.loaded = error
+
+
+    def check_loading(self):
+        """Checks periodically if the file is opened and shows the progress of its analysis"""
+        if self.loader is not None:
+            if self.loader.is_alive():
+                self.root.after(20, self.check_loading)
+                return
+
+            self.loader = None
+            self.file_button.config(state="normal")
+            self.pb_bar.stop()
+            self.pb_bar.config(mode="determinate", value=0)
+
+            if isinstance(self.loaded, Exception):
+                self.title["text"] = "Can't open: " + self.file_name
+                return
+
+            self.title["text"] = "File: " + self.file_name
+            self.file_path, source = self.loaded
+            self.use_source(source)
+
+        # The analysis runs in the background, the file can already be played
+        progress = self.analysis_progress
+        if progress is not None:
+            self.title["text"] = f"File: {self.file_name} (analysing {100 * progress:.0f} %)"
+            self.root.after(100, self.check_loading)
+        elif self.loaded is not None:
+            self.title["text"] = "File: " + self.file_name
+
+
+    def use_source(self, d):
+        """Initialises AudioProcessor and all internal attributes for the opened AudioSource"""
+        sr = d.samplerate
         self.AP = AudioProcessor(d, sr)
-
+        self.AP.instrumentation = self.instrumentation
+        self.instrumentation.processor = self.AP
+        self.streamer = None
+
+        # Results computed for the previous file are not needed anymore
+        if self.worker is not None:
+            self.worker.shutdown()
+        self.worker = RenderWorker(self.AP, self.use_processes)
+        self.pending_render = None
+        self.render = None
+        self.play_when_ready = False
 
         self.samplerate = sr
 
+        # The ring buffer has the channels of the new file, the producer starts with no audio to play,
+        # the snapshot of the previous file must not reach it
+        self.playback = None
+        self.apply_latency()
+
         self.file_len = len(d)
 
-        self.start_index = 0
-        self.pb_start_index = 0
+        # Worker processes already have their copy of AudioProcessor, so only threads use the index
+        # The index is computed only for mono audio
+        if self.AP.channels == 1 and self.file_len <= self.analysis_max_seconds * sr:
+            self.analysis_progress = 0.0
+            threading.Thread(target=self.load_analysis, args=(self.AP, self.file_path), daemon=True).start()
 
+        # The waveform shows the whole file once its peaks are computed
+        self.peaks = None
+        self.view_start, self.view_end = 0, self.file_len
+        self.waveform.delete("all")
+        self.peaks_loader = threading.Thread(target=self.load_peaks, args=(d, self.file_path), daemon=True)
+        self.peaks_loader.start()
+        self.root.after(50, self.check_peaks)
+
+        self.start_index = 0
         self.end_index = self.file_len - 1
-        self.pb_end_index = int(round(self.end_index * self.stretch_factor))
-        
-        self.i = 0
-        self.loop_size = self.file_len - 1
+
+        # Nothing is computed yet, but the playback indexes are used to reset the sliders
+        self.publish(None, 0, int(round(self.end_index * self.stretch_factor)))
         
         
         self.update_settings()
@@ -182,121 +364,450 @@ class App:
 
     def pause(self):
         """Handles switching is_playing and also recomputing out_data if needed"""
-        # If any setttings changed we figure out if we need to recompute the whole array
-        # or just change the playback start and end indexes
-        if not self.is_playing and (self.param_change or self.loop_change):
-            self.pause_button.config(text="Loading")
-            self.pause_button.update_idletasks()
-
-            recompute = False
-
-            # read slider values once and convert them into indexes of the original audio array
-            s = int(self.start_slider.get() * self.file_len)
-            e = int(self.end_slider.get() * self.file_len)
-
-            if e > self.file_len:
-                e = self.file_len
-
-            # If only indexes change and time and pitch factors stay the same,
-            # we might not need to recompute out_data
-            if self.loop_change and (not self.param_change):
-
-                # Convert start and end indexes into indexes of out_data array
-                ps = int(round((s - self.start_index) * self.stretch_factor))
-                pe = int(round((e - self.start_index) * self.stretch_factor))
-
-                # Clamp to the actual out_data bounds
-                ps = max(ps, 0)
-                pe = min(pe, len(self.out_data))
-
-                loop_len = pe - ps
-
-                # Check if indexes are valid, if so only update the plaback indexes
-                if self.start_index <= s and s < e and e <= self.end_index and loop_len > self.out_blocksize:
-                    self.pb_start_index = ps
-                    self.pb_end_index = pe
-                    self.loop_size = loop_len
-                    self.i = ps
-                # If indexes are completely invalid reset sliders back
-                elif e <= s or loop_len <= self.out_blocksize:
-                    self.start_slider.set((self.pb_start_index / self.stretch_factor + self.start_index) / self.file_len)
-                    self.end_slider.set((self.pb_end_index / self.stretch_factor + self.start_index) / self.file_len)
-                # If sliders are valid but not in the range of currently computed out_data, we need to recomput
+        # Pausing logic
+        if self.is_playing:
+            self.is_playing = False
+            self.play_when_ready = False
+            self.pause_button.config(text="Play")
+            return
+
+        # Nothing can be played before a file is opened
+        if self.AP is None:
+            return
+
+        # In streaming mode the audio is computed during playback, so nothing is recomputed here
+        if self.use_streaming:
+            if not self.start_streaming():
+                return
+
+        # If any setttings changed, out_data might be recomputed in the background
+        # and the playback starts once it is ready
+        elif (self.param_change or self.loop_change) and self.apply_settings():
+            self.play_when_ready = True
+            return
+
+        self.is_playing = True
+        self.pause_button.config(text="Pause")
+
+
+    def apply_settings(self) -> bool:
+        """ Figures out if we need to recompute the whole out_data array
+        or just change the playback start and end indexes
+
+        returns True if out_data is being recomputed in the background
+        """
+        self.update_job = None
+        recompute = False
+        started = False
+        playback = self.playback
+
+        # read slider values once and convert them into indexes of the original audio array
+        s = int(self.start_slider.get() * self.file_len)
+        e = int(self.end_slider.get() * self.file_len)
+
+        if e > self.file_len:
+            e = self.file_len
+
+        # If only indexes change and time and pitch factors stay the same,
+        # we might not need to recompute out_data
+        # If out_data is still being computed, the new loop is computed instead
+        if self.loop_change and (not self.param_change) and self.pending_render is None:
+
+            # Convert start and end indexes into indexes of out_data array
+            ps = int(round((s - self.start_index) * self.stretch_factor))
+            pe = int(round((e - self.start_index) * self.stretch_factor))
+
+            # Clamp to the actual out_data bounds
+            ps = max(ps, 0)
+            pe = min(pe, len(playback.out_data))
+
+            loop_len = pe - ps
+
+            # Check if indexes are valid, if so only update the plaback indexes
+            if self.start_index <= s and s < e and e <= self.end_index and loop_len >= self.min_loop_len():
+                self.publish(playback.out_data, ps, pe)
+            # If indexes are completely invalid reset sliders back
+            elif e <= s or loop_len < self.min_loop_len():
+                self.start_slider.set((playback.pb_start_index / self.stretch_factor + self.start_index) / self.file_len)
+                self.end_slider.set((playback.pb_end_index / self.stretch_factor + self.start_index) / self.file_len)
+            # If sliders are valid but not in the range of currently computed out_data, we need to recomput
+            else:
+                recompute = True
+            self.loop_change = False
+
+        # If time or pitch factors change or recomputing is needed
+        if self.param_change or self.loop_change or recompute:
+            stretch_factor = self.stretch_slider.get()
+            pitch_factor = self.pitch_slider.get()
+
+            loop_len = int(round((e - s) * stretch_factor))
+
+            # Check if indexes are valid
+            if s < e and loop_len >= self.min_loop_len():
+
+                # Choose a segment of the original audio padded by 3 seconds on each side
+                start_index = max(s -  3 * self.samplerate, 0)
+                end_index = min(e + 3 * self.samplerate, self.file_len - 1)
+
+                # Compute stretched audio in the background
+                # The check loop is already running if another computation is pending
+                if self.pending_render is None:
+                    self.root.after(20, self.check_render)
+                    self.render_started = perf_counter()
+
+                # A loop moved close to the current out_data only extends it by the missing audio
+                render = self.render
+                if (recompute and render is not None and (render.stretch_factor, render.pitch_factor) == (stretch_factor, pitch_factor)
+                        and self.can_extend(render, start_index, end_index)):
+                    start_index = min(start_index, render.start_index)
+                    end_index = max(end_index, render.end_index)
+                    self.worker.extend(render, start_index, end_index)
                 else:
-                    recompute = True
-                self.loop_change = False
+                    self.worker.submit(start_index, end_index, stretch_factor, pitch_factor)
+                self.pending_render = (s, e, start_index, end_index, stretch_factor, pitch_factor)
+                self.pause_button.config(text="Loading")
+                started = True
 
-            # If time or pitch factors change or recomputing is needed
-            if self.param_change or recompute:
-                # Update internal values
-                self.stretch_factor = self.stretch_slider.get()
-                self.pitch_factor = self.pitch_slider.get()
+            else:
+                # Reset sliders to a safe position
+                self.start_slider.set((playback.pb_start_index / self.stretch_factor + self.start_index) / self.file_len)
+                self.end_slider.set((playback.pb_end_index / self.stretch_factor + self.start_index) / self.file_len)
 
-                loop_len = int(round((e - s) * self.stretch_factor))
+        # Clear flags
+        self.param_change = False
+        self.loop_change = False
 
-                # Check if indexes are valid
-                if s < e and loop_len > self.out_blocksize:
+        return started
 
-                    # Choose a segment of the original audio padded by 3 seconds on each side
-                    self.start_index = max(s -  3 * self.samplerate, 0)
-                    self.end_index = min(e + 3 * self.samplerate, self.file_len - 1)
 
-                    # Compute stretched audio
-                    self.out_data = self.AP.process(self.start_index, self.end_index,
-                                                    self.stretch_factor, self.pitch_factor)
+    def check_render(self):
+        """Checks periodically if the background computation finished and publishes its result"""
+        if self.pending_render is None:
+            return
 
-                    # Convert start and end indexes into indexes of the out_data domain and clamp
-                    ps = int(round((s - self.start_index) * self.stretch_factor))
-                    pe = int(round((e - self.start_index) * self.stretch_factor))
+        render = self.worker.poll()
+        if render is None:
+            self.root.after(20, self.check_render)
+            return
 
-                    ps = max(ps, 0)
-                    pe = min(pe, len(self.out_data))
+        self.render = render
+        out_data = render.data
 
-                    # If clamped result is invalid, fall back to full out_data and update playback indexes
-                    if pe <= ps:
-                        self.pb_start_index = 0
-                        self.pb_end_index = len(self.out_data)
-                    else:
-                        self.pb_start_index = ps
-                        self.pb_end_index   = pe
+        s, e, self.start_index, self.end_index, self.stretch_factor, self.pitch_factor = self.pending_render
+        self.pending_render = None
+        self.instrumentation.record_loading(perf_counter() - self.render_started)
 
-                    self.loop_size = self.pb_end_index - self.pb_start_index
-                    self.i = self.pb_start_index
+        # Convert start and end indexes into indexes of the out_data domain and clamp
+        ps = int(round((s - self.start_index) * self.stretch_factor))
+        pe = int(round((e - self.start_index) * self.stretch_factor))
 
-                else:
-                    # Reset sliders to a safe position
-                    self.start_slider.set((self.pb_start_index / self.stretch_factor + self.start_index) / self.file_len)
-                    self.end_slider.set((self.pb_end_index / self.stretch_factor + self.start_index) / self.file_len)
+        ps = max(ps, 0)
+        pe = min(pe, len(out_data))
 
-            # Clear flags
-            self.param_change = False
-            self.loop_change = False
+        # If clamped result is invalid, fall back to full out_data and update playback indexes
+        if pe <= ps:
+            self.publish(out_data, 0, len(out_data), render.time_map)
+        else:
+            self.publish(out_data, ps, pe, render.time_map)
 
-        # Pausing logic
-        if not self.is_playing:
-            self.pause_button.config(text="Pause")
+        if self.play_when_ready:
+            self.play_when_ready = False
+            self.is_playing = True
+
+        self.pause_button.config(text="Pause" if self.is_playing else "Play")
+
+
+    def can_extend(self, render, start_index: int, end_index: int) -> bool:
+        """ Returns True if the range is better computed by extending render - it overlaps render
+        and the extended out_data is at most twice as long as a new one
+        """
+        union = max(end_index, render.end_index) - min(start_index, render.start_index)
+        return (start_index <= render.end_index and end_index >= render.start_index
+                and union <= 2 * (end_index - start_index))
+
+
+    def load_analysis(self, processor: AudioProcessor, path: str):
+        """Loads or computes the analysis index of the file, renders started after this only synthesise"""
+        def progress(done: float):
+            # Only the newest file reports its progress
+            if processor is self.AP:
+                self.analysis_progress = done
+
+        try:
+            processor.analysis = AnalysisIndex.for_file(processor, path, progress)
+        finally:
+            if processor is self.AP:
+                self.analysis_progress = None
+
+
+    def load_peaks(self, source, path: str):
+        """Loads or computes the peak pyramid of the file for the waveform"""
+        peaks = PeakPyramid.for_file(source, path)
+        # A file opened meanwhile has its own pyramid
+        if self.AP is not None and self.AP.data is source:
+            self.peaks = peaks
+
+
+    def check_peaks(self):
+        """Draws the waveform once the peak pyramid is ready"""
+        if self.peaks is not None:
+            self.draw_waveform()
+        elif self.peaks_loader is not None and self.peaks_loader.is_alive():
+            self.root.after(50, self.check_peaks)
+
+
+    def to_x(self, index: float) -> float:
+        """Converts an index of the original audio into the x coordinate in the waveform"""
+        return (index - self.view_start) / (self.view_end - self.view_start) * self.waveform.winfo_width()
+
+
+    def to_index(self, x: float) -> float:
+        """Converts the x coordinate in the waveform into an index of the original audio"""
+        return self.view_start + x / max(self.waveform.winfo_width(), 1) * (self.view_end - self.view_start)
+
+
+    def draw_waveform(self):
+        """ Redraws the visible part of the waveform, one column of the peak pyramid per pixel,
+        so it takes the same time for any length of the file
+        """
+        if self.peaks is None:
+            return
+
+        width, height = self.waveform.winfo_width(), self.waveform.winfo_height()
+        if width <= 1:
+            return
+        mins, maxs, rms = self.peaks.columns(int(self.view_start), int(self.view_end), width)
+
+        # The envelope is a single polygon, maxima from the left and minima back from the right
+        x = np.arange(width)
+        middle, scale = height / 2, 0.95 * height / 2
+        envelope = np.concatenate((np.column_stack((x, middle - scale * maxs)),
+                                   np.column_stack((x[::-1], middle - scale * mins[::-1]))))
+        rms = np.minimum(rms, np.maximum(maxs, -mins))
+        loudness = np.concatenate((np.column_stack((x, middle - scale * rms)),
+                                   np.column_stack((x[::-1], middle + scale * rms[::-1]))))
+
+        self.waveform.delete("wave")
+        self.waveform.create_polygon(envelope.ravel().tolist(), fill="#7a9cc6", outline="", tags="wave")
+        self.waveform.create_polygon(loudness.ravel().tolist(), fill="#2f5d94", outline="", tags="wave")
+        self.draw_markers()
+
+
+    def draw_markers(self):
+        """Draws the selected loop behind the waveform and its start and end markers and the playhead over it"""
+        if self.file_len is None:
+            return
+
+        height = self.waveform.winfo_height()
+        start = self.to_x(self.start_slider.get() * self.file_len)
+        end = self.to_x(self.end_slider.get() * self.file_len)
+
+        self.waveform.delete("loop", "marker")
+        self.waveform.create_rectangle(start, 0, end, height, fill="#e8eef6", outline="", tags="loop")
+        self.waveform.create_line(start, 0, start, height, fill="green", tags="marker")
+        self.waveform.create_line(end, 0, end, height, fill="red", tags="marker")
+        self.waveform.tag_lower("loop")
+        self.waveform.tag_raise("marker")
+
+        if not self.waveform.find_withtag("playhead"):
+            self.waveform.create_line(0, 0, 0, height, fill="black", tags="playhead")
+        self.waveform.tag_raise("playhead")
+
+
+    def draw_playhead(self, v: float):
+        """Moves the playhead to v, the place in the file from 0.0 to 1.0"""
+        if self.file_len is None:
+            return
+
+        x = self.to_x(v * self.file_len)
+        self.waveform.coords("playhead", x, 0, x, self.waveform.winfo_height())
+
+
+    def click_waveform(self, event):
+        """Moves the loop marker closer to the click there"""
+        if self.file_len is None:
+            return
+
+        value = min(max(self.to_index(event.x) / self.file_len, 0.0), 1.0)
+        if abs(value - self.start_slider.get()) <= abs(value - self.end_slider.get()):
+            self.start_slider.set(value)
         else:
-            self.pause_button.config(text="Play")
+            self.end_slider.set(value)
+
+
+    def zoom_waveform(self, x: int, zoom_in: bool):
+        """Zooms the waveform in or out around the sample under x"""
+        if self.peaks is None:
+            return
+
+        centre = self.to_index(x)
+        length = (self.view_end - self.view_start) * (0.8 if zoom_in else 1.25)
+        # At least one sample per pixel, at most the whole file
+        length = min(max(length, self.waveform.winfo_width()), self.file_len)
+
+        start = centre - (centre - self.view_start) * length / (self.view_end - self.view_start)
+        self.view_start = min(max(start, 0), self.file_len - length)
+        self.view_end = self.view_start + length
+        self.draw_waveform()
+
+
+    def start_drag(self, event):
+        self.drag_start = (event.x, self.view_start)
+
+
+    def drag_waveform(self, event):
+        """Scrolls the zoomed waveform with the mouse"""
+        if self.peaks is None or self.drag_start is None:
+            return
+
+        x, view_start = self.drag_start
+        length = self.view_end - self.view_start
+        start = view_start - (event.x - x) / max(self.waveform.winfo_width(), 1) * length
+        self.view_start = min(max(start, 0), self.file_len - length)
+        self.view_end = self.view_start + length
+        self.draw_waveform()
+
+
+    def publish(self, out_data: np.ndarray, pb_start_index: int, pb_end_index: int, time_map=None):
+        """ Replaces the audio used for playback with a new snapshot in a single assignment.
+        time_map maps out_data to the original audio if it was computed with envelopes
+        """
+        self.playback = PlaybackBuffer(out_data, pb_start_index, pb_end_index,
+                                       self.start_index, self.stretch_factor, time_map)
+        self.loop_size = pb_end_index - pb_start_index
+
+        # The producer starts playing the new snapshot from pb_start_index
+        if self.producer is not None:
+            self.producer.notify()
+
+
+    def min_loop_len(self) -> int:
+        """Returns the length of the shortest loop which can be played in samples of out_data"""
+        return max(int(self.min_loop_seconds * self.samplerate), 1)
+
+
+    def apply_latency(self):
+        """ Chooses the stream settings for the selected latency profile from the measured timing
+        and starts a producer with a ring buffer of the new size, main.py then reopens the stream.
+        The new producer continues with the audio of the previous one
+        """
+        settings = choose_settings(PROFILES[self.latency.profile], self.samplerate, self.instrumentation)
+        self.out_blocksize, self.out_latency, self.ring_blocks = settings
+
+        previous = self.producer
+        if previous is not None:
+            previous.stop()
+
+        self.ring = RingBuffer(self.ring_blocks * self.out_blocksize, self.AP.channels)
+        self.producer = PlaybackProducer(self, self.ring, self.out_blocksize)
+        if previous is not None and previous.source is self.playback:
+            self.producer.source, self.producer.index = previous.source, previous.index
+        self.producer.start()
+        self.instrumentation.ring = self.ring
+
+
+    def stream_settings(self) -> tuple:
+        """Returns the settings the OutputStream has to be opened with"""
+        return (self.samplerate, self.AP.channels, self.out_blocksize, self.out_latency)
+
+
+    def select_latency(self, value: str):
+        """Switches to the latency profile selected in the menu"""
+        self.latency.set_profile(value)
+        if self.samplerate is not None:
+            self.apply_latency()
+
+
+    def check_latency(self):
+        """Once per second moves to a safer latency profile if the playback keeps dropping out"""
+        now = perf_counter()
+        if self.samplerate is None or now - self.latency_checked < 1.0:
+            return
+
+        self.latency_checked = now
+        if self.latency.check(self.instrumentation, now):
+            self.latency_var.set(self.latency.profile)
+            self.apply_latency()
+
+
+    def schedule_update(self):
+        """While playing, applies changed settings shortly after the last slider move"""
+        if not self.is_playing or self.use_streaming:
+            return
 
-        self.is_playing = not self.is_playing
+        if self.update_job is not None:
+            self.root.after_cancel(self.update_job)
+        self.update_job = self.root.after(200, self.apply_settings)
+
+
+    def start_streaming(self) -> bool:
+        """ Prepares the StreamingVocoder for the selected loop and settings
+        returns False if there is no valid loop to play"""
+        self.stretch_factor = self.stretch_slider.get()
+        self.pitch_factor = self.pitch_slider.get()
+
+        s = int(self.start_slider.get() * self.file_len)
+        e = min(int(self.end_slider.get() * self.file_len), self.file_len)
+
+        if self.streamer is None or self.loop_change:
+            # The loop has to be longer than a single analysis window
+            if e - s > self.AP.window_len:
+                self.streamer = StreamingVocoder(self.AP, s, e, self.stretch_factor, self.pitch_factor)
+                self.producer.notify()
+            # Reset sliders back to the current loop
+            elif self.streamer is not None:
+                self.start_slider.set(self.streamer.start_index / self.file_len)
+                self.end_slider.set(self.streamer.end_index / self.file_len)
+        else:
+            self.streamer.set_factors(self.stretch_factor, self.pitch_factor)
+
+        # Settings have to be recomputed when switching back to out_data
+        self.param_change = True
+        self.loop_change = False
+
+        return self.streamer is not None
+
+
+    def toggle_streaming(self):
+        """Switches between playing precomputed out_data and computing the audio during playback"""
+        if self.is_playing:
+            self.pause()
+
+        self.use_streaming = self.streaming_var.get()
+        self.streamer = None
+        self.param_change = True
 
 
     def update_start(self, value: float):
         self.loop_change = True
         self.start_label.config(text= "Start: " + self.time_to_string(float(value)))
+        self.draw_markers()
+        self.schedule_update()
 
 
     def update_end(self, value: float):
         self.loop_change = True
         self.end_label.config(text= "End: " + self.time_to_string(float(value)))
+        self.draw_markers()
+        self.schedule_update()
 
 
     def update_settings(self, value=None):
         self.param_change = True
+        self.schedule_update()
+
+        # Streamed audio follows the sliders immediately
+        if self.streamer is not None:
+            self.streamer.set_factors(self.stretch_slider.get(), self.pitch_slider.get())
 
 
     def update_time(self, v):
+        # The progress bar shows the loading of a file
+        if self.loader is not None:
+            return
+
         self.pb_bar["value"] = 100 * v
+        self.draw_playhead(v)
         self.time.config(text="Time: " + self.time_to_string(v))
 
 
@@ -304,6 +815,9 @@ class App:
         """ Converts a value from 0.0 to 1.0 representing a place in the audio segment
         into a string representing its timecode
         returns this computed string"""
+        if self.file_len is None:
+            return "00:00:000"
+
         seconds = float(value) * self.file_len / self.samplerate
         milliseconds = int(seconds * 1000 % 1000)
         minutes = int(seconds // 60)
@@ -323,6 +837,60 @@ class App:
 
 
     def rewind(self, value=None):
-        self.i = self.pb_start_index
+        # Nothing to rewind before a file is opened
+        if self.AP is None:
+            return
+
+        # The streamer restarts before the producer drops the buffered frames, so no stale block follows
+        if self.streamer is not None:
+            self.streamer.rewind()
+        if self.producer is not None:
+            self.producer.rewind()
 
-        self.pb_bar["value"] = 100 * (self.start_index + self.pb_start_index) / self.file_len
+        if self.streamer is not None:
+            self.pb_bar["value"] = 100 * self.streamer.start_index / self.file_len
+            return
+
+        self.pb_bar["value"] = 100 * (self.start_index + self.playback.pb_start_index / self.stretch_factor) / self.file_len
+
+
+    def toggle_debug(self):
+        """Opens or closes the window showing the timing of the playback and the processing"""
+        if self.debug_window is not None:
+            self.debug_window.destroy()
+            self.debug_window = None
+            return
+
+        self.debug_window = Toplevel(self.root)
+        self.debug_window.title("Debug")
+        self.debug_window.protocol("WM_DELETE_WINDOW", self.toggle_debug)
+
+        self.debug_label = Label(self.debug_window, justify=LEFT, anchor="w", font="TkFixedFont")
+        self.debug_label.grid(row=0, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+
+        Button(self.debug_window, text="Export JSON", command=lambda: self.export_debug("json")).grid(row=1, column=0)
+        Button(self.debug_window, text="Export CSV", command=lambda: self.export_debug("csv")).grid(row=1, column=1)
+        self.update_debug()
+
+
+    def update_debug(self):
+        """Refreshes the debug panel if it is open, at most twice per second"""
+        if self.debug_window is None or perf_counter() - self.debug_updated < 0.5:
+            return
+
+        self.debug_updated = perf_counter()
+        self.debug_label.config(text=self.instrumentation.summary())
+
+
+    def export_debug(self, file_format: str):
+        """Saves all collected timing as JSON or CSV"""
+        path = filedialog.asksaveasfilename(initialdir=os.getcwd(), title="Export timing",
+                                            defaultextension="." + file_format,
+                                            filetypes=[(file_format.upper(), "*." + file_format)])
+        if not path:
+            return
+
+        if file_format == "json":
+            self.instrumentation.export_json(path)
+        else:
+            self.instrumentation.export_csv(path)
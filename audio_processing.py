@@ -1,51 +1,756 @@
+import copy
+import threading
 import numpy as np
+from collections import OrderedDict
+from contextlib import nullcontext
+from cache import SegmentCache
+from resampling import make_resampler
+from transients import make_detector
+from fft_backends import make_fft
+from automation import is_automated, is_unity, time_map
+from instrumentation import phase
+
+class Workspace:
+    """ Named work buffers reused from one batch of frames to the next, so the inner loop
+    of the phase vocoder doesn't allocate new arrays for every batch.
+    A buffer is reallocated only when a larger one or one of a different shape or dtype is requested
+    """
+    __slots__ = ("buffers",)
+
+    def __init__(self):
+        self.buffers = {}
+
+
+    def get(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        """Returns the buffer name with the given shape, its content is undefined"""
+        buffer = self.buffers.get(name)
+        if (buffer is None or buffer.dtype != dtype or buffer.shape[1:] != tuple(shape[1:])
+                or len(buffer) < shape[0]):
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+
+        return buffer[:shape[0]]
+
+
+class Resolution:
+    """ Tables of one window length, computed once and shared by all batches of frames:
+    the square root of the Hann window (used for both analysis and synthesis),
+    its copy in the working precision, its square in the working precision (the Hann window of the frames),
+    the indexes of the bins in the working precision (weights of transient detectors),
+    the sum of its squares and the expected phase advances of the bins for every analysis hop.
+
+    Resolutions are shared by all processors with the same window length and precision, see resolution_for.
+    Every thread also keeps its work buffers for this window length here, so consecutive calls
+    reuse them instead of allocating them again
+    """
+    __slots__ = ("window_len", "dtype", "num_bins", "window", "work_window", "window_square", "bin_weights",
+                 "window_power", "advances", "workspaces")
+
+    def __init__(self, window_len: int, dtype):
+        self.window_len = window_len
+        self.dtype = np.dtype(dtype)
+        self.num_bins = window_len // 2 + 1
+        self.window = np.sqrt(np.hanning(window_len))
+        self.work_window = self.window.astype(dtype)
+        self.window_square = np.square(self.window).astype(dtype)
+        self.bin_weights = np.arange(self.num_bins).astype(dtype)
+        # The analysis and synthesis windows multiply to a Hann window, the overlap gain divides by its sum
+        self.window_power = np.sum(np.square(self.window))
+        self.advances = {}
+        self.workspaces = threading.local()
+
+
+    def expected_advance(self, hop_a: int, dtype) -> np.ndarray:
+        """Returns the phase advance of every bin over hop_a samples"""
+        key = (hop_a, np.dtype(dtype))
+        advance = self.advances.get(key)
+        if advance is None:
+            advance = (2 * np.pi * np.arange(self.num_bins) / self.window_len * hop_a).astype(dtype)
+            self.advances[key] = advance
+        return advance
+
+
+    def workspace(self) -> "Workspace":
+        """ Returns the work buffers of the calling thread. A vocoder state uses them only while it processes
+        a batch, nothing is kept in them from one batch to the next, so the states of one thread can share them
+        """
+        workspace = getattr(self.workspaces, "workspace", None)
+        if workspace is None:
+            workspace = self.workspaces.workspace = Workspace()
+        return workspace
+
+
+    def __reduce__(self):
+        # Copies sent to other processes use the shared tables there, the work buffers stay in this process
+        return (resolution_for, (self.window_len, self.dtype))
+
+
+class VocoderPlan:
+    """ Everything the phase vocoder needs for one window length and pair of hops, prepared once:
+    the windows of the Resolution, the expected phase advances of the bins over hop_a
+    and the gain of blocks overlap-added hop_s apart. synthesise passes the plan down to all methods
+    processing a batch, which read their tables from it.
+
+    hop_s is None for frames with hops of their own (render_automated), such a plan has no gain.
+    Plans are shared by all processors and files with the same parameters, see plan_for,
+    so recomputing a segment with the same settings skips all of this
+    """
+    __slots__ = ("window_len", "hop_a", "hop_s", "num_bins", "resolution", "window", "work_window",
+                 "window_square", "bin_weights", "expected_advance", "gain")
+
+    def __init__(self, window_len: int, hop_a: int, hop_s, dtype):
+        self.window_len = window_len
+        self.hop_a = hop_a
+        self.hop_s = hop_s
+        self.resolution = resolution_for(window_len, dtype)
+        self.num_bins = self.resolution.num_bins
+        self.window = self.resolution.window
+        self.work_window = self.resolution.work_window
+        self.window_square = self.resolution.window_square
+        self.bin_weights = self.resolution.bin_weights
+        self.expected_advance = self.resolution.expected_advance(hop_a, dtype)
+        self.gain = None if hop_s is None else hop_s / self.resolution.window_power
+
+
+    def workspace(self) -> "Workspace":
+        """Returns the work buffers of the calling thread, see Resolution.workspace"""
+        return self.resolution.workspace()
+
+
+    def __reduce__(self):
+        return (plan_for, (self.window_len, self.hop_a, self.hop_s, self.resolution.dtype))
+
+
+# Shared resolutions and plans, the least recently used ones are dropped
+# Resolutions hold the work buffers of the threads, so only a few of them are kept
+MAX_RESOLUTIONS = 8
+MAX_PLANS = 64
+_resolutions = OrderedDict()
+_plans = OrderedDict()
+_shared_lock = threading.Lock()
+
+
+def _shared(cache: OrderedDict, key: tuple, max_len: int, create):
+    """Returns the value of key in the LRU cache, calls create() and stores its result if it is missing"""
+    with _shared_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+            return value
+
+    # Created outside of the lock, plans create their resolution through it
+    value = create()
+    with _shared_lock:
+        value = cache.setdefault(key, value)
+        cache.move_to_end(key)
+        if len(cache) > max_len:
+            cache.popitem(last=False)
+    return value
+
+
+def resolution_for(window_len: int, dtype) -> Resolution:
+    """Returns the shared Resolution of window_len in the precision dtype"""
+    return _shared(_resolutions, (window_len, np.dtype(dtype)), MAX_RESOLUTIONS,
+                   lambda: Resolution(window_len, dtype))
+
+
+def plan_for(window_len: int, hop_a: int, hop_s, dtype) -> VocoderPlan:
+    """Returns the shared VocoderPlan of window_len and the hops in the precision dtype"""
+    return _shared(_plans, (window_len, hop_a, hop_s, np.dtype(dtype)), MAX_PLANS,
+                   lambda: VocoderPlan(window_len, hop_a, hop_s, dtype))
+
+
+class VocoderState:
+    """ Phase vocoder state carried over from one batch of frames to the next.
+    workspace are the work buffers of the batches, a plan or a resolution gives the shared ones of the thread
+    """
+    __slots__ = ("previous_phase", "previous_phase_synthesis", "transient_previous", "short_state",
+                 "short_frames_left", "workspace")
+
+    def __init__(self, workspace=None):
+        # Phases of the last analysed frame, None before the first frame
+        self.previous_phase = None
+        # Phases used to synthesise the last frame
+        self.previous_phase_synthesis = None
+        # Value the transient detector carries from the last frame, None before the first frame
+        self.transient_previous = None
+        # State of the short window of the adaptive mode, created by its first frame,
+        # and the number of frames after the last batch which still use the short window
+        self.short_state = None
+        self.short_frames_left = 0
+        # Work buffers of the batches, a state is used by one thread at a time
+        self.workspace = workspace if workspace is not None else Workspace()
+
+
+    def release(self):
+        """Detaches the state and its short window state from the shared work buffers, before it is kept"""
+        self.workspace = Workspace()
+        if self.short_state is not None:
+            self.short_state.release()
+
+
+class Render:
+    """ Processed audio of the original range [start_index, end_index), which AudioProcessor.extend
+    can extend to a larger range by processing only the added audio.
+
+    data is normalised - divided by gain, which is None if it is not known (results from the cache).
+    Sample x of the original audio is at data[position(x)].
+
+    state, next_frame and tail continue the phase vocoder after its last frame - next_frame is the original
+    index of the next analysis frame and tail are the unnormalised stretched samples from tail_start,
+    the last complete ones first, which the following frames still add to.
+    Stretched sample r is at data[raw_offset + r / step], step is the resampling step of pitch shifting.
+    state is None if the render can't be continued.
+
+    Renders with factors changing over time have a time_map instead of the fixed scale,
+    original indexes and their indexes in data, which position interpolates
+    """
+    def __init__(self, data: np.ndarray, start_index: int, end_index: int, stretch_factor: float,
+                 pitch_factor: float, scale: float, step=1.0, gain=None, origin=None, out_offset=0,
+                 state=None, next_frame=None, tail=None, tail_start=None, raw_offset=0, time_map=None):
+        self.data = data
+        self.start_index = start_index
+        self.end_index = end_index
+        self.stretch_factor = stretch_factor
+        self.pitch_factor = pitch_factor
+        self.gain = gain
+
+        # Mapping of the original indexes to the indexes of data
+        self.origin = start_index if origin is None else origin
+        self.out_offset = out_offset
+        self.scale = scale
+        self.step = step
+
+        self.state = state
+        self.next_frame = next_frame
+        self.tail = tail
+        self.tail_start = tail_start
+        self.raw_offset = raw_offset
+        self.time_map = time_map
+
+
+    def position(self, index: int) -> float:
+        """Returns the index in data of the original index"""
+        if self.time_map is not None:
+            return float(np.interp(index, *self.time_map))
+        return self.out_offset + (index - self.origin) * self.scale
+
+
+    def source_index(self, position) -> np.ndarray:
+        """Returns the original index of the sample at position in data, the inverse of position"""
+        if self.time_map is not None:
+            return np.interp(position, self.time_map[1], self.time_map[0])
+        return self.origin + (np.asarray(position) - self.out_offset) / self.scale
+
 
 class AudioProcessor:
-    """Class used for storing original audio data and computing time stretched and pitch shifted audio"""
+    """ Class used for storing original audio data and computing time stretched and pitch shifted audio.
+    data is a numpy array or an AudioSource reading a file lazily, either mono
+    or multichannel with the shape (samples, channels)
+    """
     def __init__(self, data: np.ndarray, samplerate: int, 
-                 window_len=4096, hop_len=None, phase_lock = True):
+                 window_len=4096, hop_len=None, phase_lock = True, batch_size=256, cache_bytes=256 * 2**20,
+                 channel_lock=True, resampling="linear", precision="double", transients="energy", fft="numpy",
+                 fft_workers=None, adaptive=False):
         
         self.samplerate = samplerate
         self.data = data
         self.duration = len(self.data) / self.samplerate
+        self.channels = 1 if len(data.shape) == 1 else data.shape[1]
 
         self.window_len = window_len
         self.hop_len = hop_len
         self.phase_lock = phase_lock
-        self.window = np.sqrt(np.hanning(window_len))
+
+        # Floating point precision of the phase vocoder - "double" or "single"
+        # Single precision halves the memory traffic of the FFTs and the phase computations.
+        # Its rounding errors slowly shift the synthesis phases, so the waveform differs from double precision
+        # (45 - 65 dB signal to difference ratio), the magnitudes of the spectra stay the same
+        if precision not in ("double", "single"):
+            raise ValueError(f"Unknown precision {precision!r}, use double or single")
+        self.precision = precision
+        self.dtype = np.dtype(np.float64 if precision == "double" else np.float32)
+        self.complex_dtype = np.dtype(np.complex128 if precision == "double" else np.complex64)
+
+        # Windows and phase advance tables of the main window used for all frames, shared with other processors
+        self.main = self.resolution(window_len)
+        self.window = self.main.window
+        self.work_window = self.main.work_window
+
+        # Adaptive mode resynthesises the middle of the frames around transients with a window of
+        # short_window_len, which keeps attacks sharp, while the tonal frames keep the long window
+        # The short blocks are the middle parts of the same frames, nothing is read twice
+        self.adaptive = adaptive
+        self.short_window_len = window_len // 4
+        if adaptive:
+            short = self.resolution(self.short_window_len)
+            start = (window_len - self.short_window_len) // 2
+            self.short_slice = slice(start, start + self.short_window_len)
+            # The short block (short Hann window) replaces the same shape in the long block (long Hann window),
+            # so every frame still adds up to the long window and the overlap gain stays the same
+            self.short_fade = (1 - short.window ** 2 / np.maximum(self.main.window[self.short_slice] ** 2, 1e-12)
+                               ).astype(self.dtype)
+
+        # Channels of multichannel audio are synthesised with the phases of their mid channel (their sum),
+        # so the phase differences between channels and the stereo image are kept
+        self.channel_lock = channel_lock
+
+        # Engine resampling the stretched audio in pitch_shift - "linear", "sinc" or "polyphase"
+        self.resampling = resampling
+        self.resampler = make_resampler(resampling)
+
+        # Detector of transient frames, which restart the phases - "energy", "flux", "hfc"
+        # or a detector from transients.py with its own threshold
+        self.transients = make_detector(transients)
+
+        # Number of frames transformed together by a single batched FFT in phase_vocoder
+        self.batch_size = batch_size
+
+        # Library computing the FFTs - "numpy", "scipy", "pyfftw" or "auto", the fastest installed one
+        # A library which is not installed falls back to a simpler one, fft.name is the one used
+        # Threaded backends use fft_workers threads, all cores by default
+        self.fft = make_fft(fft, fft_workers)
+
+        # Processed segments, so switching back to previous settings doesn't recompute them
+        # Factors are rounded to cache_resolution in the cache keys, the same as the resolution of the sliders
+        self.cache = SegmentCache(cache_bytes)
+        self.cache_resolution = 0.001
+
+        # Precomputed AnalysisIndex of the whole data, used by phase_vocoder when it is set
+        self.analysis = None
+
+        # Instrumentation measuring every process call, None disables the measurements
+        self.instrumentation = None
 
 
     def process(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float) -> np.ndarray:
-        """Handles processing logic"""
+        """ Handles processing logic, results are cached and the returned arrays are read-only.
+        Either factor can be an Envelope from automation.py changing over time, see render_automated
+        """
         if start_index >= end_index or start_index >= len(self.data) or end_index >= len(self.data):
             raise ValueError("Invalid index range")
 
+        with self.measure(start_index, end_index, stretch_factor, pitch_factor) as call:
+            result = self.cached(start_index, end_index, stretch_factor, pitch_factor)
+            call["cached"] = result is not None
+            if result is None:
+                result = self.render(start_index, end_index, stretch_factor, pitch_factor)
+                self.store(start_index, end_index, stretch_factor, pitch_factor, result)
+
+        return result
+
+
+    def render(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float) -> np.ndarray:
+        """Processes the segment without using the cache"""
+        if is_automated(stretch_factor) or is_automated(pitch_factor):
+            return self.render_automated(start_index, end_index, stretch_factor, pitch_factor)
+
         segment = self.data[start_index : end_index]
 
         # No processing needed
         if pitch_factor == 1 and stretch_factor == 1:
-            return segment.astype(np.float32)
+            return segment.astype(np.float32, copy=False)
         # Only time stretching is needed
         elif pitch_factor == 1:
-            return self.phase_vocoder(segment, stretch_factor)
+            return self.phase_vocoder(segment, stretch_factor, start_index=start_index)
         
         # Apply all processing
-        return self.pitch_shift(segment, stretch_factor, pitch_factor).astype(np.float32)
+        return self.pitch_shift(segment, stretch_factor, pitch_factor, start_index)
+
+
+    def cache_key(self, stretch_factor: float, pitch_factor: float) -> tuple:
+        """Returns the key of all settings which change the processed audio"""
+        return (int(round(stretch_factor / self.cache_resolution)), int(round(pitch_factor / self.cache_resolution)),
+                self.window_len, self.hop_len, self.phase_lock, self.channel_lock, self.resampling,
+                self.precision, self.transients.key(), self.adaptive)
+
+
+    def cached(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float) -> np.ndarray:
+        """Returns the cached result of process or None"""
+        # Unprocessed segments are cheap, so they are never cached
+        # Results of envelopes can't be sliced for smaller ranges, so they aren't cached either
+        if self.uncached(stretch_factor, pitch_factor):
+            return None
+
+        return self.cache.get(self.cache_key(stretch_factor, pitch_factor), start_index, end_index, stretch_factor)
+
+
+    def store(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float, result: np.ndarray):
+        """Stores a result of process in the cache"""
+        if self.uncached(stretch_factor, pitch_factor):
+            return
+
+        self.cache.put(self.cache_key(stretch_factor, pitch_factor), start_index, end_index, result)
+
+
+    @staticmethod
+    def uncached(stretch_factor, pitch_factor) -> bool:
+        return (is_automated(stretch_factor) or is_automated(pitch_factor)
+                or (pitch_factor == 1 and stretch_factor == 1))
+
+
+    def measure(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float):
+        """ Returns a context measuring a call with the instrumentation, the yielded dict can be filled in.
+        Envelopes are recorded as their average factors
+        """
+        if self.instrumentation is None:
+            return nullcontext({})
+        if is_automated(stretch_factor):
+            stretch_factor = stretch_factor.mean(start_index, end_index)
+        if is_automated(pitch_factor):
+            pitch_factor = pitch_factor.mean(start_index, end_index)
+        return self.instrumentation.measure_process(self, start_index, end_index, stretch_factor, pitch_factor)
+
+
+    def render_extendable(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float) -> "Render":
+        """ Processes the segment the same way as process, but returns a Render, which extend can extend
+        later by processing only the added audio. Results from the cache can be extended only with crossfades
+        """
+        if start_index >= end_index or start_index >= len(self.data) or end_index >= len(self.data):
+            raise ValueError("Invalid index range")
+
+        with self.measure(start_index, end_index, stretch_factor, pitch_factor) as call:
+            data = self.cached(start_index, end_index, stretch_factor, pitch_factor)
+            call["cached"] = data is not None
+            if data is not None:
+                scale, step = self.output_scale(end_index - start_index, stretch_factor, pitch_factor)
+                return Render(data, start_index, end_index, stretch_factor, pitch_factor, scale, step)
+
+            # Renders of envelopes can't be continued, they are only mapped by their time map
+            if is_automated(stretch_factor) or is_automated(pitch_factor):
+                data = self.render_automated(start_index, end_index, stretch_factor, pitch_factor)
+                mapping = self.automation_map(start_index, end_index, stretch_factor, pitch_factor, len(data))
+                return Render(data, start_index, end_index, stretch_factor, pitch_factor,
+                              len(data) / (end_index - start_index), time_map=mapping)
+
+            render = self.render_piece(start_index, end_index, stretch_factor, pitch_factor)
+            self.store(start_index, end_index, stretch_factor, pitch_factor, render.data)
+
+        return render
+
+
+    def output_scale(self, length: int, stretch_factor: float, pitch_factor: float) -> tuple:
+        """ Returns the number of output samples per original sample and the resampling step
+        of a processed segment of length samples
+        """
+        if stretch_factor == 1 and pitch_factor == 1:
+            return 1.0, 1.0
+
+        hop_a = self.analysis_hop()
+        hop_s = int(round(stretch_factor * pitch_factor * hop_a))
+        step = 1.0
+        if pitch_factor != 1:
+            step = (int(length * stretch_factor * pitch_factor) - 1) / max(int(length * stretch_factor) - 1, 1)
+        return hop_s / hop_a / step, step
+
+
+    def render_piece(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float,
+                     step=None) -> "Render":
+        """ Computes the same audio as render and keeps the vocoder state after the last frame.
+        step forces the resampling step of pitch shifting, so the piece lines up with another render
+        """
+        segment = self.data[start_index: end_index]
+        if stretch_factor == 1 and pitch_factor == 1:
+            return Render(segment.astype(np.float32, copy=False), start_index, end_index, 1.0, 1.0, 1.0, gain=1.0)
+
+        hop_a = self.analysis_hop()
+        hop_s = int(round(stretch_factor * pitch_factor * hop_a))
+
+        state = VocoderState(self.plan(hop_s).workspace())
+        analysis = self.analysis
+        if analysis is not None and analysis.matches(self):
+            first, num_frames, shift = analysis.grid(start_index, end_index, hop_s)
+            raw = analysis.vocode(self, start_index, end_index, hop_s, state)
+            next_frame, tail_start = (first + num_frames) * hop_a, shift + num_frames * hop_s
+        else:
+            raw = self.vocode(segment, hop_s, state)
+            num_frames = max((len(segment) - self.window_len) // hop_a + 1, 0)
+            next_frame, tail_start = start_index + num_frames * hop_a, num_frames * hop_s
+
+        # The work buffers are not kept with the render
+        state.release()
+        # The last complete hop is kept too, the next piece crossfades over it
+        lead = min(hop_s, tail_start)
+        tail = raw[tail_start - lead:].copy()
+
+        # The same normalisation as phase_vocoder, the gain is kept to scale the extensions equally
+        gain = max(raw.max(), -raw.min()) if len(raw) else 0
+        gain = gain if gain != 0 else 1.0
+        raw /= gain
+        stretched = self.fit_length(raw, int(len(segment) * stretch_factor * pitch_factor))
+
+        if pitch_factor == 1:
+            data, step = stretched, 1.0
+        else:
+            new_len = int(len(segment) * stretch_factor) if step is None else int(round((len(stretched) - 1) / step)) + 1
+            with phase("resample"):
+                data = self.resample(stretched, new_len).astype(np.float32, copy=False)
+            step = (len(stretched) - 1) / max(new_len - 1, 1)
+
+        return Render(data, start_index, end_index, stretch_factor, pitch_factor, hop_s / hop_a / step, step, gain,
+                      state=state, next_frame=next_frame, tail=tail, tail_start=tail_start)
+
+
+    def extend(self, render: "Render", start_index: int, end_index: int) -> "Render":
+        """ Returns render extended to the original range [start_index, end_index), which contains its range.
+
+        Only the added audio is processed. At the end the phase vocoder continues from the state of render,
+        so the added audio follows without a seam. At the start, or if render can't be continued,
+        a new piece overlapping render by a few windows is processed and crossfaded with it.
+        The added audio is scaled by the gain of render, if it would clip, the whole result is scaled down.
+        Returns a new Render, render is not changed
+        """
+        if (start_index > render.start_index or end_index < render.end_index or start_index < 0
+                or end_index >= len(self.data)):
+            raise ValueError("Invalid index range")
+
+        stretch_factor, pitch_factor = render.stretch_factor, render.pitch_factor
+        # Unprocessed audio is only copied
+        if stretch_factor == 1 and pitch_factor == 1:
+            return self.render_extendable(start_index, end_index, 1.0, 1.0)
+
+        with self.measure(start_index, end_index, stretch_factor, pitch_factor) as call:
+            call["processed"] = (render.start_index - start_index) + (end_index - render.end_index)
+
+            # A shallow copy, the data and gain set below don't change render if its range stays the same
+            result = copy.copy(render)
+            if end_index > result.end_index:
+                result = self.extend_end(result, end_index)
+            if start_index < result.start_index:
+                result = self.extend_start(result, start_index)
+
+            # The same length as a render of the whole range
+            result.data = self.fit_length(result.data, int((end_index - start_index) * stretch_factor))
+
+            # The added audio can be louder than the peak of the previous audio
+            m = max(result.data.max(), -result.data.min())
+            if m > 1:
+                result.data = result.data / m
+                if result.gain is not None:
+                    result.gain *= m
+
+            self.store(start_index, end_index, stretch_factor, pitch_factor, result.data)
+
+        return result
+
+
+    def extend_end(self, render: "Render", end_index: int) -> "Render":
+        """Extends render to end_index, continuing its phase vocoder if possible"""
+        if render.state is not None:
+            return self.continue_render(render, end_index)
+
+        # Both renders are complete one window away from their ends, the crossfade lies between
+        window_len = self.window_len
+        piece_start = render.end_index - window_len * 5 // 2
+        if piece_start < render.start_index:
+            return self.render_piece(render.start_index, end_index, render.stretch_factor, render.pitch_factor)
+
+        piece = self.render_piece(piece_start, end_index, render.stretch_factor, render.pitch_factor, render.step)
+        offset = int(round(render.position(piece_start)))
+        fade_start = int(round(render.position(render.end_index - window_len * 3 // 2)))
+        fade_len = int(window_len // 2 * render.scale)
+
+        factor = self.piece_gain(render, piece, offset, fade_start, fade_len)
+        data = self.splice(render.data, piece.data * piece.data.dtype.type(factor), offset, fade_start, fade_len)
+
+        return Render(data, render.start_index, end_index, render.stretch_factor, render.pitch_factor, render.scale,
+                      render.step, render.gain, render.origin, render.out_offset, piece.state, piece.next_frame,
+                      piece.tail, piece.tail_start, piece.raw_offset + offset)
+
+
+    def extend_start(self, render: "Render", start_index: int) -> "Render":
+        """Extends render back to start_index with a crossfaded piece, the phase vocoder can't run backwards"""
+        window_len = self.window_len
+        piece_end = render.start_index + window_len * 5 // 2
+        if piece_end > render.end_index:
+            return self.render_piece(start_index, render.end_index, render.stretch_factor, render.pitch_factor)
+
+        piece = self.render_piece(start_index, piece_end, render.stretch_factor, render.pitch_factor, render.step)
+
+        # Number of samples added before the data of render
+        offset = int(round(-render.position(start_index)))
+        fade_start = offset + int(round(render.position(render.start_index + window_len)))
+        fade_len = int(window_len // 2 * render.scale)
+
+        factor = self.piece_gain(render, piece, offset, fade_start, fade_len, before=True)
+        data = self.splice(piece.data * piece.data.dtype.type(factor), render.data, offset, fade_start, fade_len)
+
+        return Render(data, start_index, render.end_index, render.stretch_factor, render.pitch_factor, render.scale,
+                      render.step, render.gain, render.origin, render.out_offset + offset, render.state, render.next_frame,
+                      render.tail, render.tail_start, render.raw_offset + offset)
+
+
+    def continue_render(self, render: "Render", end_index: int) -> "Render":
+        """Runs the phase vocoder of render from its state over the frames up to end_index"""
+        hop_a = self.analysis_hop()
+        window_len = self.window_len
+        hop_s = int(round(render.stretch_factor * render.pitch_factor * hop_a))
+
+        num_frames = max((end_index - render.next_frame - window_len) // hop_a + 1, 0)
+        if num_frames == 0:
+            return Render(render.data, render.start_index, end_index, render.stretch_factor, render.pitch_factor,
+                          render.scale, render.step, render.gain, render.origin, render.out_offset, render.state,
+                          render.next_frame, render.tail, render.tail_start, render.raw_offset)
+
+        segment = self.data[render.next_frame: render.next_frame + (num_frames - 1) * hop_a + window_len]
+        state = copy.deepcopy(render.state)
+        state.workspace = self.plan(hop_s).workspace()
+        raw = self.vocode(segment, hop_s, state)
+        state.release()
+
+        # The kept tail gets the contributions of the new frames, its complete start is put back before them
+        lead = min(hop_s, render.tail_start)
+        overlap = min(len(render.tail) - lead, len(raw))
+        raw[:overlap] += render.tail[lead: lead + overlap]
+        raw = np.concatenate((render.tail[:lead], raw))
+        base = render.tail_start - lead
+
+        tail_start = render.tail_start + num_frames * hop_s
+        tail = raw[tail_start - min(hop_s, tail_start) - base:].copy()
+
+        piece = raw / render.gain
+        if render.pitch_factor == 1:
+            offset = render.raw_offset + base
+        else:
+            offset = int(round(render.raw_offset + base / render.step))
+            with phase("resample"):
+                piece = self.resample(piece, int(round((len(piece) - 1) / render.step)) + 1)
+
+        # Both are the same audio over the lead, the previous one only misses the rounding of the resampling
+        data = self.splice(render.data, piece.astype(render.data.dtype, copy=False), offset, offset,
+                           int(lead / render.step), coherent=True)
+
+        return Render(data, render.start_index, end_index, render.stretch_factor, render.pitch_factor, render.scale,
+                      render.step, render.gain, render.origin, render.out_offset, state, render.next_frame + num_frames * hop_a,
+                      tail, tail_start, render.raw_offset)
+
+
+    def piece_gain(self, render: "Render", piece: "Render", offset: int, fade_start: int, fade_len: int,
+                   before=False) -> float:
+        """ Returns the factor bringing the normalised piece to the level of render.
+        If any of the gains is unknown, the levels are matched over the crossfade.
+        The piece is at offset in the indexes of render, or render at offset in the indexes of piece if before
+        """
+        if render.gain is not None and piece.gain is not None:
+            return piece.gain / render.gain
+
+        region = slice(fade_start, fade_start + fade_len)
+        shifted = slice(fade_start - offset, fade_start - offset + fade_len)
+        render_part, piece_part = (render.data[shifted], piece.data[region]) if before else (render.data[region], piece.data[shifted])
+
+        piece_level = np.sqrt(np.mean(np.square(piece_part))) if len(piece_part) else 0
+        if piece_level == 0:
+            return 1.0
+        return float(np.sqrt(np.mean(np.square(render_part)))) / piece_level
+
+
+    @staticmethod
+    def splice(first: np.ndarray, second: np.ndarray, offset: int, fade_start: int, fade_len: int,
+               coherent=False) -> np.ndarray:
+        """ Joins first, which starts at index 0, and second, which starts at offset, with a crossfade
+        from fade_start over fade_len samples. Before it the result is first and after it second.
+
+        Coherent audio (the same audio in both) is crossfaded linearly,
+        otherwise with equal power, like the seams of ParallelProcessor
+        """
+        fade_start = min(max(fade_start, offset), len(first))
+        fade_end = min(fade_start + fade_len, len(first))
+
+        result = np.empty((offset + len(second),) + second.shape[1:], dtype=first.dtype)
+        result[:fade_start] = first[:fade_start]
+        result[fade_end:] = second[fade_end - offset:]
+
+        fade = ((np.arange(fade_start, fade_end) - fade_start + 0.5) / max(fade_end - fade_start, 1)
+                ).reshape((-1,) + (1,) * (second.ndim - 1))
+        fade_in, fade_out = (fade, 1 - fade) if coherent else (np.sin(fade * np.pi / 2), np.cos(fade * np.pi / 2))
+        result[fade_start:fade_end] = first[fade_start:fade_end] * fade_out + second[fade_start - offset: fade_end - offset] * fade_in
+
+        return result
+
+
+    def render_automated(self, start_index: int, end_index: int, stretch_factor, pitch_factor) -> np.ndarray:
+        """ Processes the segment like render with factors changing over time, either of them can be an Envelope.
+
+        Every frame gets its own hop_s from the product of both factors around it - its phases advance
+        by its hop_s and it is placed hop_s after the previous frame. Every frame is scaled by its
+        overlap_gain, so slower and faster parts keep the same level, and the result is normalised
+        to a peak of 1.0 like phase_vocoder. The changing pitch factor is then applied by resampling
+        with a changing ratio, following the time map of the factors.
+        The frames are placed at their rounded positions in the time map, so the rounding errors
+        of the hops don't add up. With constant envelopes whose synthesis hop is a whole number of samples
+        the result is the same as with the fixed factors (for pitch shifting within the interpolation error
+        of the resampling engine), other constant envelopes alternate between the neighbouring hops
+        where the fixed factors round the hop once
+        """
+        segment = self.data[start_index: end_index]
+        hop_a = self.analysis_hop()
+        _, stretched, output = time_map(stretch_factor, pitch_factor, start_index, end_index, hop_a)
+
+        # hop_s of every frame is the distance from the previous frame, hop_s of the first frame isn't used
+        num_frames = max((len(segment) - self.window_len) // hop_a + 1, 0)
+        hops = np.maximum(np.diff(np.round(stretched)), 1).astype(np.intp)
+        frame_hops = np.concatenate((hops[:1], hops[: max(num_frames - 1, 0)]))[:num_frames]
+        offsets = np.concatenate(([0], np.cumsum(frame_hops[1:])))[:num_frames]
+
+        result_len = (int(offsets[-1]) if num_frames > 0 else 0) + self.window_len
+        result = np.zeros((result_len,) + segment.shape[1:], dtype=self.dtype)
+        if num_frames > 0:
+            frames = self.frames(segment, hop_a)[:num_frames]
+
+        plan = self.plan(frame_hops)
+        state = VocoderState(plan.workspace())
+        for first in range(0, num_frames, self.batch_size):
+            batch = slice(first, first + self.batch_size)
+            output_blocks = self.synthesise(frames[batch], hop_a, frame_hops[batch], state, plan)
+
+            with phase("synthesis"):
+                gains = self.overlap_gain(frame_hops[batch]).astype(self.dtype)
+                output_blocks *= gains.reshape((-1,) + (1,) * (output_blocks.ndim - 1))
+                self.overlap_add_at(result, output_blocks, offsets[batch])
+
+        m = max(result.max(), -result.min()) if len(result) else 0
+        if m != 0:
+            result /= m
 
+        # The lengths are rounded, so constant envelopes give the lengths of the fixed factors
+        stretched_len = int(round(stretched[-1], 6))
+        result = self.fit_length(result, stretched_len)
+        if is_unity(pitch_factor):
+            return result
 
-    def pitch_shift(self, segment: np.ndarray, stretch_factor: float, pitch_factor: float) -> np.ndarray:
+        # Output samples are spaced like in resample, so a constant pitch factor gives the same positions,
+        # and every one of them is moved to the stretched position where the time maps meet
+        new_len = int(round(output[-1], 6))
+        with phase("resample"):
+            step = self.resampler.step(stretched_len, new_len) * output[-1] / stretched[-1]
+            positions = np.interp(np.arange(new_len) * step, output, stretched)
+            return self.resampler.interpolate(result, positions)
+
+
+    def automation_map(self, start_index: int, end_index: int, stretch_factor, pitch_factor, length: int) -> tuple:
+        """ Returns the time map of a result of render_automated of the length samples - original indexes
+        and their indexes in the result, used to follow the playback position
+        """
+        indexes, stretched, output = time_map(stretch_factor, pitch_factor, start_index, end_index,
+                                              self.analysis_hop())
+        positions = stretched if is_unity(pitch_factor) else output
+        return indexes, positions * (length / positions[-1] if positions[-1] > 0 else 0.0)
+
+
+    def pitch_shift(self, segment: np.ndarray, stretch_factor: float, pitch_factor: float, start_index=None) -> np.ndarray:
         """ Uses the phase vocoder to time stretch the signal by the correct stretch_factor 
         and then resample the signal to speed up or slow down the signal - resulting in pitch shifting
 
         Returns an audio array of a pitch shifted signal.
         """
 
-        stretched = self.phase_vocoder(segment, stretch_factor * pitch_factor)
+        stretched = self.phase_vocoder(segment, stretch_factor * pitch_factor, start_index=start_index)
         new_length = int(len(segment) * stretch_factor)
-        return self.resample(stretched, new_length).astype(np.float32)
+        with phase("resample"):
+            return self.resample(stretched, new_length).astype(np.float32, copy=False)
         
 
-    def phase_vocoder(self, segment: np.ndarray, stretch_factor: float) -> np.ndarray:
+    def phase_vocoder(self, segment: np.ndarray, stretch_factor: float, normalise=True, start_index=None) -> np.ndarray:
         
         """Time-stretches an audio signal by a given stretch_factor
         by splitting it into overlapping blocks of length window_len,
@@ -62,206 +767,596 @@ class AudioProcessor:
         Larger window_len sizes provide better tonal information but worse rhythmic information while
         Smaller window_len sizes provide better rhythmic information but worse tonal information
 
+        The blocks are transformed in batches of batch_size frames with a single FFT call,
+        only the propagation of phases from one frame to the next is sequential.
+        Batching only changes the order of floating point operations, so the result is
+        within 1e-9 of processing the blocks one by one.
+
+        The result is normalised to a peak of 1.0, unless normalise is False.
+
+        If start_index, the position of the segment in data, is given and the analysis index is available,
+        only the synthesis is computed, using the stored magnitudes, phases and peaks.
+
+        Multichannel segments of the shape (samples, channels) are processed in the same batched pass,
+        every block then has the shape (channels, window_len).
+
+        With precision "single" everything is computed in float32 and float32 is returned,
+        the large synthesis phases are then kept wrapped to [-pi, pi] so they don't lose precision.
+        The batches reuse the work buffers of their VocoderState, so after the first batch
+        the inner loop only allocates the small per batch index arrays.
+
         Returns an array of the time stretch audio signal.
         """
 
+        # Initialise hop length for synthesis
+        hop_s = int(round(stretch_factor * self.analysis_hop()))
+
+        analysis = self.analysis
+        if start_index is not None and analysis is not None and analysis.matches(self):
+            result = analysis.vocode(self, start_index, start_index + len(segment), hop_s)
+        else:
+            result = self.vocode(segment, hop_s)
+
+        # Normalise the result in place, it is a new array from vocode
+        m = max(result.max(), -result.min()) if len(result) else 0
+        if normalise and m != 0:
+            result /= m
+
+        # Trim or pad the result based on expected length
+        return self.fit_length(result, int(len(segment) * stretch_factor))
+
+
+    def vocode(self, segment: np.ndarray, hop_s: int, state=None) -> np.ndarray:
+        """ Runs the phase vocoder over all blocks of the segment and overlap-adds
+        the reconstructed blocks spaced by hop_s.
+
+        A VocoderState of a previous call can be passed in to continue from it, it is updated in place.
+
+        Returns the unnormalised result of length num_frames * hop_s + window_len
+        """
+        hop_a = self.analysis_hop()
+
+        num_frames = max((len(segment) - self.window_len) // hop_a + 1, 0)
+        output_len = int(num_frames * hop_s) + self.window_len
+        result = np.zeros((output_len,) + segment.shape[1:], dtype=self.dtype)
+
+        if num_frames > 0:
+            frames = self.frames(segment, hop_a)[:num_frames]
+
+        # Phases from the previous frame and energy in decibels used to detect transients
+        # are carried over from one batch of frames to the next
+        plan = self.plan(hop_s)
+        if state is None:
+            state = VocoderState(plan.workspace())
+
+        # Frames are processed in batches so the memory used by the spectra stays bounded
+        for first in range(0, num_frames, self.batch_size):
+            output = self.synthesise(frames[first: first + self.batch_size], hop_a, hop_s, state, plan)
+
+            # Add the reconstructed blocks to the result, they start at multiples of hop_s
+            with phase("synthesis"):
+                self.overlap_add(result, output, first * hop_s, hop_s)
+
+        return result
+
+
+    def frames(self, segment: np.ndarray, hop: int) -> np.ndarray:
+        """ Returns all blocks of audio of length window_len each hop samples apart as rows of a view.
+        No data is copied here, the rows share memory with the segment.
+        Blocks of multichannel audio have the shape (channels, window_len)
+        """
+        return np.lib.stride_tricks.sliding_window_view(segment, self.window_len, axis=0)[::hop]
+
+
+    def analysis_hop(self) -> int:
+        """Returns the analysis hop size hop_a"""
         if not self.hop_len:
             # If not specified by a user, hop_a is set so the blocks overlap by 75 %
             # which provides good sound quality while not being too expensive for processing
-            hop_a = int(self.window_len // 4)
+            return int(self.window_len // 4)
+
+        return self.hop_len
+
+
+    def resolution(self, window_len: int) -> "Resolution":
+        """Returns the shared tables of window_len in the precision of the processor"""
+        return resolution_for(window_len, self.dtype)
+
+
+    def plan(self, hop_s, window_len=None) -> "VocoderPlan":
+        """ Returns the shared plan of the analysis hop and hop_s for the main window or window_len.
+        Hops of every frame (an array) share a plan without a gain
+        """
+        return plan_for(window_len or self.window_len, self.analysis_hop(), None if np.ndim(hop_s) else hop_s,
+                        self.dtype)
+
+
+    def synthesise(self, blocks: np.ndarray, hop_a: int, hop_s: int, state: "VocoderState", plan=None,
+                   is_transient=None) -> np.ndarray:
+        """ Reconstructs a batch of blocks of audio, each one window_len samples long and hop_a samples
+        after the previous one, with phases advanced for blocks spaced by hop_s.
+
+        state holds the phases of the previous block and is updated, so consecutive batches
+        continue where the previous batch ended.
+        plan is the VocoderPlan of the length of the blocks and the hops, of the main window by default.
+        is_transient are the transient flags of the blocks, they are detected if not given.
+
+        Returns a 2D array of windowed blocks, one row per block, ready to be overlap-added.
+        The array is a work buffer of state, it is overwritten by the next batch.
+        """
+        plan = plan or self.plan(hop_s)
+        if blocks.ndim == 3 and self.channel_lock:
+            output, is_transient = self.synthesise_channels(blocks, hop_a, hop_s, state, plan, is_transient)
         else:
-            hop_a = self.hop_len
+            with phase("analysis"):
+                mag, current_phase, is_transient = self.analyse(blocks, state, plan, is_transient)
+            with phase("synthesis"):
+                output = self.resynthesise(mag, current_phase, is_transient, hop_a, hop_s, state, plan=plan)
 
-        # Initialise hop length for synthesis
-        hop_s = int(round(stretch_factor * hop_a))
+        if self.adaptive and plan.window_len == self.window_len:
+            self.sharpen_transients(blocks, output, is_transient, hop_a, hop_s, state)
+        return output
+
+
+    def sharpen_transients(self, blocks: np.ndarray, output: np.ndarray, is_transient: np.ndarray,
+                           hop_a: int, hop_s: int, state: "VocoderState"):
+        """ Adaptive mode - resynthesises the middle of every transient frame and of the frames until
+        the transient passes the middle of the window with the short window and blends it into output.
+
+        The short blocks continue their phases from one frame to the next within a run of such frames,
+        the first frame of a run restarts them. Only the frames of the runs are transformed again,
+        so the mode costs little more than the long window alone
+        """
+        if len(output) == 0:
+            return
+
+        # Frames from a transient until the frame whose middle is half a window later
+        span = max(self.window_len // (2 * hop_a), 1)
+        frame_indices = np.arange(len(output))
+        last = np.maximum.accumulate(np.where(is_transient, frame_indices, -span - 1))
+        short = (frame_indices - last < span) | (frame_indices < state.short_frames_left)
+
+        # A run of short frames restarts its phases at its first frame and at every transient
+        previous_short = np.concatenate(([state.short_frames_left > 0], short[:-1]))
+        starts = short & (~previous_short | is_transient)
+        state.short_frames_left = max(span - (len(output) - int(last[-1])), state.short_frames_left - len(output), 0)
+        if not short.any():
+            return
+
+        short_plan = self.plan(hop_s, self.short_window_len)
+        if state.short_state is None:
+            state.short_state = VocoderState()
+        state.short_state.workspace = short_plan.workspace()
+        selected = np.flatnonzero(short)
+        if np.ndim(hop_s):
+            hop_s = hop_s[selected]
+        short_blocks = blocks[..., self.short_slice][selected]
+        short_output = self.synthesise(short_blocks, hop_a, hop_s, state.short_state, short_plan,
+                                       starts[selected])
+
+        with phase("synthesis"):
+            middle = output[selected][..., self.short_slice]
+            middle *= self.short_fade
+            middle += short_output
+            output[selected, ..., self.short_slice] = middle
+
+
+    def synthesise_channels(self, blocks: np.ndarray, hop_a: int, hop_s: int, state: "VocoderState",
+                            plan=None, is_transient=None) -> tuple:
+        """ Multichannel version of synthesise used with channel_lock, blocks have the shape (frames, channels, window_len).
+
+        Phases are propagated only for the mid channel, the sum of all channels.
+        The spectra of all channels are then rotated by the same phase shift as the mid channel,
+        so every channel keeps its magnitudes and its phase differences to the other channels.
+        Only the FFTs and the rotation are computed per channel.
+
+        Returns a 3D array of windowed blocks of the shape (frames, channels, window_len) and the transient flags
+        """
+        plan = plan or self.plan(hop_s)
+        work = state.workspace
+        spectrum_shape = blocks.shape[:-1] + (plan.num_bins,)
+        mid_shape = spectrum_shape[:1] + spectrum_shape[2:]
+
+        with phase("analysis"):
+            current_blocks = np.multiply(blocks, plan.work_window,
+                                         out=work.get("blocks", blocks.shape, self.dtype))
+            X = self.rfft(current_blocks, work.get("spectrum", spectrum_shape, self.complex_dtype))
+
+            # The transform is linear, so the spectrum of the mid channel is the sum of the spectra
+            mid = np.sum(X, axis=1, out=work.get("mid", mid_shape, X.dtype))
+            mag = np.abs(mid, out=work.get("mag", mid_shape, self.dtype))
+            current_phase = np.arctan2(mid.imag, mid.real, out=work.get("phase", mid_shape, self.dtype))
+
+            if is_transient is None:
+                is_transient = self.transient_flags(current_blocks, mag, state, plan)
+
+        with phase("synthesis"):
+            synthesis_phase = self.propagate_phases(mag, current_phase, is_transient, hop_a, hop_s, state,
+                                                    plan=plan)
+
+            # Phase advances of the batch are not needed any more, their buffer is reused
+            shift = np.subtract(synthesis_phase, current_phase, out=work.get("advance", mid_shape, self.dtype))
+            rotation = self.wrap_phase(shift, out=work.get("wrapped", mid_shape, self.dtype))
+            rotator = work.get("rotator", mid_shape, X.dtype)
+            np.cos(rotation, out=rotator.real)
+            np.sin(rotation, out=rotator.imag)
+            np.multiply(X, rotator[:, np.newaxis], out=X)
+
+            output = self.irfft(X, current_blocks, plan)
+            output *= plan.work_window
+        return output, is_transient
+
+
+    def analyse(self, blocks: np.ndarray, state: "VocoderState", plan=None, is_transient=None) -> tuple:
+        """ Windows and transforms a batch of blocks and detects transients in them, unless is_transient is given.
+        Nothing here depends on the stretch factor, plan can be any plan or Resolution of the length of the blocks,
+        the main Resolution by default.
+
+        Returns a tuple of magnitudes, phases and transient flags of the blocks,
+        the arrays are work buffers of state overwritten by the next batch
+        """
+        plan = plan or self.main
+        work = state.workspace
+        spectrum_shape = blocks.shape[:-1] + (plan.num_bins,)
+
+        current_blocks = np.multiply(blocks, plan.work_window, out=work.get("blocks", blocks.shape, self.dtype))
+
+        # Takes a Fourier Transform of every block in the batch at once
+        # Each row of X is an array containing complex numbers
+        # Each array corresponds to a frequency: k-th index corresponds to (k / window_len) * sampling rate
+        # Summing all these frequencies with correct amplitude and phase produces the original block (approximately)
+        # Magnitude of k-th complex numbers is the amplitude of the k-th frequency
+        # The phase of the k-th frequency is given by the angle of k-th complex number
+        # For real valued inputs, X[k] is equal to the complex conjugate of X[N-k],
+        # so only a half of the bins are needed -> X has rows of length (window_len // 2 + 1)
+        X = self.rfft(current_blocks, work.get("spectrum", spectrum_shape, self.complex_dtype))
+
+        mag = np.abs(X, out=work.get("mag", spectrum_shape, self.dtype))
+        # Same as np.angle, which can't write into a buffer
+        current_phase = np.arctan2(X.imag, X.real, out=work.get("phase", spectrum_shape, self.dtype))
+
+        if is_transient is None:
+            is_transient = self.transient_flags(current_blocks, mag, state, plan)
+
+        return (mag, current_phase, is_transient)
+
+
+    def detect_transients(self, blocks: np.ndarray, state: "VocoderState") -> np.ndarray:
+        """ Returns the transient flags synthesise finds in a batch of blocks, continuing from state,
+        without synthesising the blocks. The array is a work buffer of state
+        """
+        if blocks.ndim == 3 and self.channel_lock:
+            # Like synthesise_channels - all channels are windowed, the magnitudes are of the mid channel
+            work = state.workspace
+            current_blocks = np.multiply(blocks, self.main.work_window, out=work.get("blocks", blocks.shape, self.dtype))
+            X = self.rfft(current_blocks, work.get("spectrum", blocks.shape[:-1] + (self.main.num_bins,),
+                                                   self.complex_dtype))
+            mag = np.abs(np.sum(X, axis=1))
+            return self.transient_flags(current_blocks, mag, state)
+
+        return self.analyse(blocks, state)[2]
+
+
+    def transient_flags(self, current_blocks: np.ndarray, mag: np.ndarray, state: "VocoderState",
+                        plan=None) -> np.ndarray:
+        """ Detects transients in a batch of windowed blocks and their magnitudes with the detector
+        of the processor, all frames at once, continuing from the previous batch in state.
+        All channels of a multichannel frame share the flag
+        """
+        if len(current_blocks) == 0:
+            return np.zeros(0, dtype=bool)
+
+        # Transient frames will be processed as the new starting frame
+        is_transient, state.transient_previous = self.transients.detect(current_blocks, mag, plan or self.main,
+                                                                        state.transient_previous)
+        return is_transient
 
-        num_frames = (len(segment) - self.window_len) // hop_a + 1
-        output_len = int(num_frames * hop_s) + self.window_len
-        result = np.zeros(output_len)
 
-        # Array of phases from previous frames
-        previous_phase = np.zeros(self.window_len // 2 + 1)
+    def resynthesise(self, mag: np.ndarray, current_phase: np.ndarray, is_transient: np.ndarray,
+                     hop_a: int, hop_s: int, state: "VocoderState", peak_of=None, plan=None) -> np.ndarray:
+        """ Reconstructs a batch of analysed blocks with phases advanced for blocks spaced by hop_s.
+        peak_of are the regions of peaks from locate_peaks, they are found here if not given.
+
+        Returns a 2D array of windowed blocks, one row per block, ready to be overlap-added.
+        The array is a work buffer of state, it is overwritten by the next batch.
+        """
+        plan = plan or self.plan(hop_s)
+        work = state.workspace
+        output_angle = self.propagate_phases(mag, current_phase, is_transient, hop_a, hop_s, state, peak_of, plan)
+
+        # Synthesise back the output with the same amplitudes, but new computed phases
+        # Use inverse FFT to get the signal in the time domain
+        # Wrapping the phases first keeps cos and sin fast, they are slow for large arguments
+        # The buffers of the phase advances and of the analysed spectra are not needed any more
+        synthesis_angle = self.wrap_phase(output_angle, out=work.get("advance", mag.shape, self.dtype))
+        Y = work.get("spectrum", mag.shape, self.complex_dtype)
+        np.cos(synthesis_angle, out=Y.real)
+        Y.real *= mag
+        np.sin(synthesis_angle, out=Y.imag)
+        Y.imag *= mag
+        output = self.irfft(Y, work.get("blocks", mag.shape[:-1] + (plan.window_len,), self.dtype), plan)
+
+        # Fade edges of the blocks using a windowing function
+        output *= plan.work_window
+        return output
+
+
+    def propagate_phases(self, mag: np.ndarray, current_phase: np.ndarray, is_transient: np.ndarray,
+                         hop_a: int, hop_s: int, state: "VocoderState", peak_of=None, plan=None) -> np.ndarray:
+        """ Computes the synthesis phases of a batch of analysed frames and updates state.
+        The expected phase advances come from plan, the plan of hop_s by default.
+
+        Returns an array of synthesis phases with the same shape as current_phase
+        """
+        work = state.workspace
 
         # Array of expected phase advances for each bin over a time frame of length hop_a
-        expected_phase_advance = 2 * np.pi * np.arange(self.window_len // 2 + 1) / self.window_len * hop_a
-        
-        previous_phase_synthesis = np.zeros(self.window_len // 2 + 1)
-        
-        # Energy in decibels used to detect transients
-        energy_previous_db = 0
-        is_transient = False
-
-        # Go over each block of audio of length window_len each hop_a apart
-        for n in range(num_frames):
-            i = n * hop_a
-            current_block = segment[i: i + self.window_len] * self.window
-            
-            # Takes a Fourier Transform of a signal block
-            # X is an array containing complex numbers
-            # Each array corresponds to a frequency: k-th index corresponds to (k / window_len) * sampling rate
-            # Summing all these frequencies with correct amplitude and phase produces the original block (approximately)
-            # Magnitude of k-th complex numbers is the amplitude of the k-th frequency
-            # The phase of the k-th frequency is given by the angle of k-th complex number
-            # For real valued inputs, X[k] is equal to the complex conjugate of X[N-k],
-            # so only a half of the bins are needed -> X has the length of (window_len // 2 + 1)
-            X = np.fft.rfft(current_block)
-
-            mag = np.abs(X)
-            current_phase = np.angle(X)
-
-            # Transient frames will be processed as the new starting frame
-            is_transient, energy_previous_db = self.detect_transient(current_block, energy_previous_db)
-
-            # Initialise the first frame by copying all the information 
-            # If a frame is a transient, treat it as a new frame to avoid audio smearing
-            if n == 0 or is_transient:
-                output_angle = current_phase.copy()
-                previous_phase = current_phase.copy()
-                previous_phase_synthesis = current_phase.copy()
-            else:
-                actual_phase_advance = (current_phase - previous_phase)
-                # Phase unwrapping
-                phase_difference = actual_phase_advance - expected_phase_advance
-                phase_difference = (phase_difference + np.pi) % (2 * np.pi) - np.pi
-
-                # The bin frequency doesnt have to be the exact frequency in the signal
-                # With the measured phase deviation we can find the actual frequency
-                actual_phase = expected_phase_advance + phase_difference
-                actual_frequency = actual_phase / hop_a
-                
-                previous_phase = current_phase.copy()
-
-                # Compute the correct phases for signal synthesis
-                if not self.phase_lock:
-                    output_angle = previous_phase_synthesis + actual_frequency * hop_s
-
-                # Energy can sometimes leak to neighbouring bins.
-                # For phase coherence accross neighbouring bins, we find the peaks in the spectrum
-                # and use their phases for the adjacent bins to improve sound quality
-                else:
-                    output_angle = np.zeros(len(previous_phase_synthesis))
-                    
-                    # Find peak indices and regions of neighbouring bins
-                    peaks, regions = self.locate_peaks(mag)
-                    if len(peaks) == 0: peaks = [1]
-
-                    # Update each region and peak bin 
-                    for j in range(len(peaks) - 1):
-                        peak = peaks[j]
-                        region = regions[j]
-                        output_angle[region] = previous_phase_synthesis[peak] + actual_frequency[peak] * hop_s + (current_phase[region]- current_phase[peak])
-                        output_angle[peak] = previous_phase_synthesis[peak] + actual_frequency[peak] * hop_s        
-
-                    # update last peak region
-                    peak = peaks[-1]
-                    region = regions[-1]
-                    output_angle[region] = previous_phase_synthesis[peak] + actual_frequency[peak] * hop_s + (current_phase[region]- current_phase[peak])
-                    output_angle[peak] = previous_phase_synthesis[peak] + actual_frequency[peak] * hop_s
-
-            # Calculate the starting index of the reconstructed audio block
-            i2 = int(n * hop_s)
-            
-            previous_phase_synthesis = output_angle
-            
-            # Synthesise back the output with the same amplitudes, but new computed phases
-            # Use inverse FFT to get the signal in the time domain
-            Y = mag * np.exp(1j * output_angle)
-            output = np.fft.irfft(Y).real
-
-            # Fade edges of the block using a windowing function and add to the result
-            result[i2: i2 + self.window_len] += output * self.window
-
-        # Normalise the result
-        m = np.max(np.abs(result))
-        if m != 0:
-            result = result / m
+        expected_phase_advance = (plan or self.plan(hop_s)).expected_advance
 
-        # Trim or pad the result based on expected length
-        target_len = int(len(segment) * stretch_factor)
+        # Initialise the first frame by copying all the information
+        # If a frame is a transient, treat it as a new frame to avoid audio smearing
+        if state.previous_phase is None:
+            is_transient[0] = True
+            state.previous_phase = current_phase[0].copy()
 
-        if len(result) < target_len:
-            # Pad with zeros at the end
-            result = np.pad(result, (0, target_len - len(result)))
+        # Phase advance of every frame from the frame before it, the first one comes from the previous batch
+        phase_advance = work.get("advance", current_phase.shape, current_phase.dtype)
+        np.subtract(current_phase[0], state.previous_phase, out=phase_advance[0])
+        np.subtract(current_phase[1:], current_phase[:-1], out=phase_advance[1:])
+        state.previous_phase = current_phase[-1].copy()
+
+        # Phase unwrapping
+        phase_advance -= expected_phase_advance
+        phase_advance += np.pi
+        np.remainder(phase_advance, 2 * np.pi, out=phase_advance)
+        phase_advance -= np.pi
+
+        # The bin frequency doesnt have to be the exact frequency in the signal
+        # With the measured phase deviation we can find the actual frequency
+        # and from it the phase advance over hop_s samples
+        phase_advance += expected_phase_advance
+        phase_advance /= hop_a
+        # Frames of render_automated have their own hop_s
+        if np.ndim(hop_s):
+            hop_s = np.reshape(hop_s, (-1,) + (1,) * (phase_advance.ndim - 1))
+        phase_advance *= hop_s
+
+        # Single precision can't hold large phases accurately, so they are kept small,
+        # only their values modulo 2 pi matter
+        if self.precision == "single":
+            phase_advance = self.wrap_phase(phase_advance, out=work.get("advance_wrapped", phase_advance.shape,
+                                                                        phase_advance.dtype))
+
+        # Compute the correct phases for signal synthesis
+        if not self.phase_lock:
+            output_angle = self.accumulate_phases(phase_advance, current_phase, is_transient,
+                                                  state.previous_phase_synthesis, work)
         else:
-            # trim extra samples
-            result = result[:target_len]
-        
-        return result[:]
+            output_angle = self.lock_phases(mag, phase_advance, current_phase, is_transient,
+                                            state.previous_phase_synthesis, peak_of, work)
 
+        if self.precision == "single":
+            state.previous_phase_synthesis = self.wrap_phase(output_angle[-1])
+        else:
+            state.previous_phase_synthesis = output_angle[-1].copy()
+        return output_angle
 
-    def resample(self, input: np.ndarray, new_len: int) -> np.ndarray:
-        """Implements linear resampling"""
-        old_len = len(input)
 
-        new_indices = np.linspace(0, old_len - 1, new_len)
+    def overlap_gain(self, hop_s: int) -> float:
+        """ Returns the gain which brings overlap-added blocks spaced by hop_s back to the level of the input.
+        The analysis and synthesis windows multiply to a Hann window, whose copies add up to sum(window^2) / hop_s.
+        hop_s can be an array of the hops of every frame
+        """
+        if np.ndim(hop_s):
+            return hop_s / self.main.window_power
+        return self.plan(hop_s).gain
 
-        left = np.floor(new_indices).astype(int)
-        right = np.minimum(left + 1, old_len - 1)
-        
-        f = new_indices - left
-        
-        return (1 - f) * input[left] + f * input[right]
 
+    def fit_length(self, result: np.ndarray, target_len: int) -> np.ndarray:
+        """Trims or pads the result with zeros at the end to target_len samples"""
+        if len(result) < target_len:
+            return np.pad(result, [(0, target_len - len(result))] + [(0, 0)] * (result.ndim - 1))
+
+        return result[:target_len]
+
+
+    def rfft(self, blocks: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Transforms the last axis of blocks with the FFT backend, into out if the backend supports it"""
+        return self.fft.rfft(blocks, out)
+
+
+    def irfft(self, spectra: np.ndarray, out: np.ndarray, plan=None) -> np.ndarray:
+        """ Inverse of rfft, returns blocks of length window_len (of the plan), written into out
+        if the backend supports it. The spectra can be overwritten
+        """
+        return self.fft.irfft(spectra, (plan or self.main).window_len, out)
+
+
+    @staticmethod
+    def wrap_phase(phase: np.ndarray, out=None) -> np.ndarray:
+        """Wraps phases into the interval [-pi, pi], out must not be phase"""
+        turns = np.divide(phase, 2 * np.pi, out=out)
+        np.round(turns, out=turns)
+        turns *= 2 * np.pi
+        return np.subtract(phase, turns, out=turns)
+
+
+    def accumulate_phases(self, phase_advance: np.ndarray, current_phase: np.ndarray,
+                          is_transient: np.ndarray, previous_phase_synthesis: np.ndarray, work=None) -> np.ndarray:
+        """ Computes synthesis phases of a batch of frames without phase locking.
+
+        Every frame adds its phase_advance to the synthesis phase of the previous frame,
+        which is a cumulative sum over the frames. Transient frames restart the sum from their own phase.
+
+        Returns a 2D array of synthesis phases, one row per frame
+        """
+        if work is None:
+            work = Workspace()
+        shape, dtype = phase_advance.shape, phase_advance.dtype
+        frame_indices = np.arange(len(phase_advance))
+
+        # Index of the last transient frame at or before every frame
+        # -1 means the sum continues from the previous batch
+        restart = np.maximum.accumulate(np.where(is_transient, frame_indices, -1))
+
+        # Running sum of phase advances, the first row is the state before the batch
+        advance_sum = work.get("advance_sum", (len(phase_advance) + 1,) + shape[1:], dtype)
+        advance_sum[0] = 0
+        np.cumsum(phase_advance, axis=0, out=advance_sum[1:])
+
+        # Sum of the advances since the frame the sum starts from
+        output_angle = np.take(advance_sum, restart + 1, axis=0, out=work.get("angle", shape, dtype), mode="clip")
+        np.subtract(advance_sum[1:], output_angle, out=output_angle)
 
-    def locate_peaks(self, magnitudes: list, rel_threshold=0.03, neighbours=4) -> tuple:
+        # Phases the sums start from - phases of transient frames or the previous synthesis phase
+        start_phase = np.take(current_phase, np.maximum(restart, 0), axis=0,
+                              out=work.get("start_phase", shape, dtype), mode="clip")
+        start_phase[restart < 0] = 0 if previous_phase_synthesis is None else previous_phase_synthesis
+
+        output_angle += start_phase
+        return output_angle
+
+
+    def lock_phases(self, mag: np.ndarray, phase_advance: np.ndarray, current_phase: np.ndarray,
+                    is_transient: np.ndarray, previous_phase_synthesis: np.ndarray, peak_of=None,
+                    work=None) -> np.ndarray:
+        """ Computes synthesis phases of a batch of frames with phase locking.
+
+        Energy can sometimes leak to neighbouring bins.
+        For phase coherence accross neighbouring bins, we find the peaks in the spectrum
+        and use their phases for the adjacent bins to improve sound quality
+
+        Returns a 2D array of synthesis phases, one row per frame
+        """
+        if work is None:
+            work = Workspace()
+        shape, dtype = current_phase.shape, current_phase.dtype
+        output_angle = work.get("angle", shape, dtype)
+
+        # Find the peak owning every bin of every frame at once
+        if peak_of is None:
+            with phase("peaks"):
+                _, peak_of = self.locate_peaks(mag)
+
+        # Flat indexes of the peaks within their frame and within the batch, so their values
+        # can be gathered into the work buffers, channels of a frame follow each other
+        num_bins = shape[-1]
+        frame_size = current_phase[0].size
+        channel_offset = (np.arange(frame_size // num_bins) * num_bins).reshape(shape[1:-1] + (1,))
+        frame_peak = np.add(peak_of, channel_offset, out=work.get("frame_peak", shape, np.intp))
+        frame_offset = (np.arange(len(current_phase)) * frame_size).reshape((-1,) + (1,) * (len(shape) - 1))
+        batch_peak = np.add(frame_peak, frame_offset, out=work.get("batch_peak", shape, np.intp))
+
+        # Each bin advances like its peak and keeps its phase offset from the peak
+        peak_advance = np.take(phase_advance, batch_peak, out=work.get("peak_advance", shape, dtype), mode="clip")
+        peak_offset = np.take(current_phase, batch_peak, out=work.get("peak_offset", shape, dtype), mode="clip")
+        np.subtract(current_phase, peak_offset, out=peak_offset)
+
+        # Each frame depends on the synthesis phases of the frame before, so this loop stays sequential
+        for n in range(len(current_phase)):
+            if is_transient[n]:
+                output_angle[n] = current_phase[n]
+            else:
+                np.take(previous_phase_synthesis, frame_peak[n], out=output_angle[n], mode="clip")
+                output_angle[n] += peak_advance[n]
+                output_angle[n] += peak_offset[n]
+
+            previous_phase_synthesis = output_angle[n]
+
+        return output_angle
+
+
+    def overlap_add(self, result: np.ndarray, blocks: np.ndarray, offset: int, hop: int):
+        """ Adds blocks spaced hop samples apart into result, starting at index offset.
+
+        Blocks which are at least len(block) samples apart do not overlap,
+        so every such group of blocks is added at once through a view of result
+        with one row per block, nothing is copied.
+        Multichannel blocks have the shape (channels, block_len) and result the shape (samples, channels).
+        result has to be contiguous.
+        """
+        num_blocks, block_len = blocks.shape[0], blocks.shape[-1]
+        channels = blocks.shape[1:-1]
+        # Number of groups of non overlapping blocks
+        step = -(-block_len // hop)
+        stride = step * hop
+
+        for group in range(min(step, num_blocks)):
+            group_blocks = np.moveaxis(blocks[group::step], -1, 1)
+            start = offset + group * hop
+
+            # Blocks whose whole stride fits into result, each one starts a row of the view
+            count = min(len(group_blocks), max((len(result) - start) // stride, 0))
+            if count > 0:
+                rows = result[start: start + count * stride].reshape((count, stride) + channels)
+                rows[:, :block_len] += group_blocks[:count]
+
+            # The last blocks can reach past the end of result
+            for k in range(count, len(group_blocks)):
+                block_start = start + k * stride
+                block_end = min(block_start + block_len, len(result))
+                if block_end > block_start:
+                    result[block_start: block_end] += group_blocks[k, : block_end - block_start]
+
+
+    @staticmethod
+    def overlap_add_at(result: np.ndarray, blocks: np.ndarray, offsets: np.ndarray):
+        """ Adds every block into result starting at its own offset, used for unevenly spaced blocks.
+        Multichannel blocks have the shape (channels, block_len) and result the shape (samples, channels)
+        """
+        for block, offset in zip(blocks, offsets):
+            end = min(offset + block.shape[-1], len(result))
+            if end > offset:
+                result[offset: end] += np.moveaxis(block, -1, 0)[: end - offset]
+
+
+    def resample(self, input: np.ndarray, new_len: int) -> np.ndarray:
+        """ Resamples input to new_len samples with the selected resampling engine.
+        The engines work in float32 blocks, see resampling.py
+        """
+        return self.resampler.resample(input, new_len)
+
+
+    def locate_peaks(self, magnitudes: np.ndarray, rel_threshold=0.03, neighbours=4) -> tuple:
         """ Finds indices of peaks in an array of magnitudes
         if a value is larger than the threshold and is also the largest among its 4
         neighbours, it is considered as a peak
-        
-        Returns a tuple of 2 lists
-        first list is a list of peak indices
-        second is a list of all regions nearest to the respective peak index
-        """
-
-        threshold = rel_threshold * magnitudes.max()
-        peaks = []
-        index = neighbours
-        regions = []
-        last_peak = -1
-        start_point = 0
-        end_point = 0
-
-        # Find peaks and regions
-        while index < len(magnitudes) - neighbours:
-            local_max = np.amax(magnitudes[index - neighbours:index + neighbours + 1])
-            if local_max < threshold:
-                index += neighbours
-            elif magnitudes[index] == local_max:
-                peaks.append(index)
-                # If we have a first peak
-                if last_peak == -1:
-                    last_peak = index
-                else:
-                    end_point = (last_peak + index) // 2
-                    regions.append(list(range(start_point, last_peak)) + list(range(last_peak + 1, end_point)))
-                    start_point = end_point
-                    last_peak = index
-            index += 1
-
-        # Cover region of the last peak
-        regions.append(list(range(start_point, last_peak)) + list(range(last_peak + 1, len(magnitudes))))
-
-        return (peaks, regions)
-    
-
-    def detect_transient(self, audio_block: np.ndarray, energy_previous_db: float, threshold_db=6.0) -> bool:
-        """ A transient is a sudden high energy event in a signal.
-        They are often caused by drums or attack portions of sounds.
-
-        Detects transient frames and updates energy_previous_db for the next frame 
-        """
-        # Energy here is similar to acoustic energy but the array of magnitudes is normalised so it
-        # is not in any unit just the squares of magnitudes
-        energy_current = np.sum(np.square((audio_block) * self.window))
-        # Prevent log of zero
-        if energy_current <= 1e-12:
-            energy_current_db = -120.0
-        # Convert to decibels
-        else:
-            energy_current_db = 10 * np.log10(energy_current)
 
-        if energy_current_db - energy_previous_db > threshold_db:
-            return (True, energy_current_db)
-        
+        Every row of a 2D (or higher) array of magnitudes is searched separately, so all frames of a batch
+        can be processed at once. If a row has no peaks, bin 1 is used as its only peak.
+
+        Returns a tuple of 2 arrays with the same shape as magnitudes
+        first array is True at the indices of peaks
+        second array holds for every bin the index of the nearest peak which owns its region
+        """
+
+        mags = magnitudes.reshape(-1, magnitudes.shape[-1])
+        num_bins = mags.shape[1]
+        threshold = rel_threshold * mags.max(axis=1, keepdims=True)
+
+        # Maximum of every window of 2 * neighbours + 1 bins, computed from shifted slices
+        centre = mags[:, neighbours: num_bins - neighbours]
+        local_max = centre.copy()
+        for shift in range(2 * neighbours + 1):
+            np.maximum(local_max, mags[:, shift: shift + len(local_max[0])], out=local_max)
+
+        is_peak = np.zeros(mags.shape, dtype=bool)
+        is_peak[:, neighbours: num_bins - neighbours] = (centre == local_max) & (local_max >= threshold)
+
+        # Peaks in row major order, so the peaks of every row are sorted
+        rows, peaks = np.nonzero(is_peak)
+
+        # Region of each peak starts halfway between the peak and the previous peak in the same row
+        # The first peak of each row owns everything from bin 0
+        region_starts = np.zeros(len(peaks), dtype=int)
+        same_row = rows[1:] == rows[:-1]
+        region_starts[1:] = np.where(same_row, (peaks[:-1] + peaks[1:]) // 2, 0)
+
+        # Mark the start of each region with its peak and carry it forward to the end of the region
+        # This works because the peaks in a row are increasing
+        peak_of = np.zeros(mags.shape, dtype=int)
+        peak_of[rows, region_starts] = peaks
+        peak_of[~is_peak.any(axis=1), 0] = 1
+        np.maximum.accumulate(peak_of, axis=1, out=peak_of)
 
-        return (False, energy_current_db)
+        return (is_peak.reshape(magnitudes.shape), peak_of.reshape(magnitudes.shape))
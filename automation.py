@@ -0,0 +1,82 @@
+import numpy as np
+
+class Envelope:
+    """ A stretch or pitch factor changing over the original audio, given by breakpoints.
+    values[i] applies at the data index indexes[i], the factor changes linearly between the breakpoints
+    and stays at the first and the last value outside of them.
+
+    AudioProcessor.process accepts envelopes instead of the fixed factors, e.g. a tape stop slowing
+    the last second down to a quarter of the speed:
+    Envelope([end - samplerate, end], [1.0, 4.0]) as the stretch factor with the same envelope
+    divided into 1.0 as the pitch factor
+    """
+    def __init__(self, indexes, values):
+        self.indexes = np.asarray(indexes, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+        if self.indexes.ndim != 1 or self.indexes.shape != self.values.shape or len(self.indexes) == 0:
+            raise ValueError("An envelope needs the same number of indexes and values")
+        if np.any(np.diff(self.indexes) < 0):
+            raise ValueError("Indexes of an envelope have to be increasing")
+        if np.any(self.values <= 0):
+            raise ValueError("Values of an envelope have to be positive")
+
+
+    def __call__(self, index) -> np.ndarray:
+        """Returns the factor at the data indexes"""
+        return np.interp(index, self.indexes, self.values)
+
+
+    def mean(self, start_index: float, end_index: float) -> float:
+        """Returns the average factor over the original range [start_index, end_index)"""
+        if end_index <= start_index:
+            return float(self(start_index))
+        inside = (self.indexes > start_index) & (self.indexes < end_index)
+        indexes = np.concatenate(([start_index], self.indexes[inside], [end_index]))
+        return float(np.trapezoid(self(indexes), indexes) / (end_index - start_index))
+
+
+    def key(self) -> tuple:
+        return (tuple(self.indexes.tolist()), tuple(self.values.tolist()))
+
+
+    @classmethod
+    def parse(cls, text: str, samplerate: int) -> "Envelope":
+        """ Reads breakpoints written as "seconds:value,seconds:value,...", a single number is a constant factor.
+        Used by the command line
+        """
+        if ":" not in text:
+            return cls([0.0], [float(text)])
+
+        points = [point.split(":") for point in text.split(",") if point.strip()]
+        return cls([float(seconds) * samplerate for seconds, _ in points], [float(value) for _, value in points])
+
+
+def is_automated(factor) -> bool:
+    """Returns True if factor is an Envelope and not a fixed number"""
+    return isinstance(factor, Envelope)
+
+
+def is_unity(factor) -> bool:
+    """Returns True if factor is 1 everywhere"""
+    if is_automated(factor):
+        return bool(np.all(factor.values == 1))
+    return factor == 1
+
+
+def time_map(stretch_factor, pitch_factor, start_index: int, end_index: int, hop: int) -> tuple:
+    """ Integrates the factors over the original range from start_index to end_index on a grid of hop samples.
+
+    Returns the original indexes of the grid and the positions they are moved to in the audio stretched
+    by both factors (which the phase vocoder produces) and in the audio stretched only by stretch_factor
+    (the result after resampling). Either factor can be a number or an Envelope
+    """
+    indexes = np.append(np.arange(start_index, end_index, hop, dtype=np.float64), end_index)
+    middles = (indexes[:-1] + indexes[1:]) / 2
+    lengths = np.diff(indexes)
+
+    stretch = stretch_factor(middles) if is_automated(stretch_factor) else np.full(len(middles), float(stretch_factor))
+    pitch = pitch_factor(middles) if is_automated(pitch_factor) else np.full(len(middles), float(pitch_factor))
+
+    stretched = np.concatenate(([0.0], np.cumsum(lengths * stretch * pitch)))
+    output = np.concatenate(([0.0], np.cumsum(lengths * stretch)))
+    return indexes, stretched, output
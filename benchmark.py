@@ -0,0 +1,434 @@
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from audio_processing import AudioProcessor
+from parallel import ParallelProcessor
+from resampling import RESAMPLERS
+from fft_backends import BACKENDS, make_fft
+
+# Settings of the benchmarked cases, every signal is processed with each of them
+CONFIGS = {
+    "w4096-lock-s1.25":          dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0),
+    "w4096-nolock-s1.25":        dict(window_len=4096, hop_len=None, phase_lock=False, stretch=1.25, pitch=1.0),
+    "w4096-lock-s0.8":           dict(window_len=4096, hop_len=None, phase_lock=True, stretch=0.8, pitch=1.0),
+    "w4096-lock-s1.0-p1.2":      dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.0, pitch=1.2),
+    "w4096-lock-s0.9-p0.75":     dict(window_len=4096, hop_len=None, phase_lock=True, stretch=0.9, pitch=0.75),
+    "w4096-lock-s1.0-p1.2-sinc": dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.0, pitch=1.2,
+                                      resampling="sinc"),
+    "w4096-lock-s1.25-f32":      dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0,
+                                      precision="single"),
+    "w4096-nolock-s1.25-f32":    dict(window_len=4096, hop_len=None, phase_lock=False, stretch=1.25, pitch=1.0,
+                                      precision="single"),
+    "w4096-lock-s1.25-flux":     dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0,
+                                      transients="flux"),
+    "w4096-lock-s1.25-scipy":    dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0,
+                                      fft="scipy"),
+    "w4096-lock-s1.25-adaptive": dict(window_len=4096, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0,
+                                      transients="flux", adaptive=True),
+    "w2048-lock-s1.25":          dict(window_len=2048, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0),
+    "w8192-lock-s1.25":          dict(window_len=8192, hop_len=None, phase_lock=True, stretch=1.25, pitch=1.0),
+    "w4096-hop512-lock-s1.25":   dict(window_len=4096, hop_len=512, phase_lock=True, stretch=1.25, pitch=1.0),
+}
+
+# Functions reported in the time breakdown
+PROFILED = ("render", "phase_vocoder", "vocode", "analyse", "resynthesise", "accumulate_phases", "lock_phases",
+            "locate_peaks", "transient_flags", "overlap_add", "resample", "rfft", "irfft")
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_files", "test.mp3")
+
+
+def synthetic_signal(seconds: float, samplerate=44100) -> np.ndarray:
+    """Returns a test signal made of a few sines and a little noise"""
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    rng = np.random.default_rng(0)
+
+    signal = sum(np.sin(2 * np.pi * f * t) / (k + 1) for k, f in enumerate((220.0, 330.0, 440.0, 1250.0)))
+    signal += 0.05 * rng.standard_normal(len(t))
+
+    return (signal / np.max(np.abs(signal))).astype(np.float32)
+
+
+def test_signals(seconds: float, samplerate=44100) -> dict:
+    """ Returns the benchmarked signals - sines, a chirp, clicks, noise, a stereo signal
+    and the beginning of audio_files/test.mp3.
+    All of them are deterministic, so the outputs can be compared with golden outputs
+    """
+    n = int(seconds * samplerate)
+    t = np.arange(n) / samplerate
+    rng = np.random.default_rng(1)
+
+    # Exponential sweep from 50 Hz to 15 kHz
+    f0, f1 = 50.0, 15000.0
+    k = np.log(f1 / f0) / seconds
+    chirp = 0.8 * np.sin(2 * np.pi * f0 * (np.exp(k * t) - 1) / k)
+
+    # Decaying clicks four times per second over a quiet tone, full of transients
+    clicks = 0.1 * np.sin(2 * np.pi * 440.0 * t)
+    for position in range(0, n, samplerate // 4):
+        length = min(samplerate // 20, n - position)
+        clicks[position: position + length] += np.exp(-np.arange(length) / 200) * rng.uniform(-1, 1, length)
+
+    signals = {"sines": synthetic_signal(seconds, samplerate),
+               "chirp": chirp.astype(np.float32),
+               "clicks": (clicks / np.max(np.abs(clicks))).astype(np.float32),
+               "noise": (0.5 * rng.standard_normal(n)).astype(np.float32)}
+
+    # Sines panned to the left and the chirp to the right, with a little of each in the other channel
+    signals["stereo"] = np.stack((0.8 * signals["sines"] + 0.2 * signals["chirp"],
+                                  0.2 * signals["sines"] + 0.8 * signals["chirp"]), axis=1)
+
+    if os.path.exists(TEST_FILE):
+        from source import AudioSource
+        source = AudioSource(TEST_FILE)
+        if source.samplerate == samplerate:
+            signals["test.mp3"] = source[0: min(n, len(source))]
+
+    return signals
+
+
+def profile_breakdown(function) -> dict:
+    """Runs function under cProfile and returns the cumulative seconds spent in the PROFILED functions"""
+    profile = cProfile.Profile()
+    profile.runcall(function)
+
+    breakdown = {}
+    for (_, _, name), (_, _, _, cumulative, _) in pstats.Stats(profile).stats.items():
+        if name in PROFILED:
+            breakdown[name] = breakdown.get(name, 0.0) + cumulative
+    return breakdown
+
+
+def peak_memory(function) -> int:
+    """Returns the peak number of bytes allocated while running function, NumPy arrays included"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_case(signal: np.ndarray, samplerate: int, config: dict, repeats=3) -> tuple:
+    """ Benchmarks AudioProcessor.render of the whole signal with one configuration.
+    Returns the statistics and the output of the last run
+    """
+    AP = AudioProcessor(signal, samplerate, config["window_len"], config["hop_len"], config["phase_lock"],
+                        cache_bytes=0, resampling=config.get("resampling", "linear"),
+                        precision=config.get("precision", "double"), transients=config.get("transients", "energy"),
+                        fft=config.get("fft", "numpy"), adaptive=config.get("adaptive", False))
+    end_index = len(signal) - 1
+
+    def run():
+        return AP.render(0, end_index, config["stretch"], config["pitch"])
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = run()
+        times.append(time.perf_counter() - start)
+
+    best = min(times)
+    stats = {"seconds": len(signal) / samplerate, "time": best, "realtime_factor": len(signal) / samplerate / best,
+             "peak_memory": peak_memory(run), "breakdown": profile_breakdown(run)}
+    return stats, output
+
+
+def run_suite(seconds=10.0, samplerate=44100, configs=None, repeats=3, report=print) -> tuple:
+    """ Benchmarks every test signal with every configuration.
+    Returns the results keyed by "signal/configuration" and the outputs under the same keys
+    """
+    configs = CONFIGS if configs is None else configs
+    results = {}
+    outputs = {}
+
+    for signal_name, signal in test_signals(seconds, samplerate).items():
+        for config_name, config in configs.items():
+            key = f"{signal_name}/{config_name}"
+            results[key], outputs[key] = benchmark_case(signal, samplerate, config, repeats)
+
+            if report is not None:
+                r = results[key]
+                slowest = sorted(((t, name) for name, t in r["breakdown"].items()
+                                  if name not in ("render", "phase_vocoder", "vocode")), reverse=True)[:3]
+                report(f"{key:40s} {r['time'] * 1000:8.1f} ms  realtime factor {r['realtime_factor']:6.1f}x  "
+                       f"peak {r['peak_memory'] / 2**20:6.1f} MB  "
+                       + ", ".join(f"{name} {t * 1000:.0f} ms" for t, name in slowest))
+
+    return results, outputs
+
+
+def compare(results: dict, baseline: dict, tolerance=0.10) -> list:
+    """ Compares results with baseline results.
+    Returns messages about the cases more than tolerance slower or using more than tolerance more memory
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old = baseline[key]
+
+        if result["time"] > old["time"] * (1 + tolerance):
+            regressions.append(f"{key}: time {old['time'] * 1000:.1f} ms -> {result['time'] * 1000:.1f} ms "
+                               f"({result['time'] / old['time'] - 1:+.0%})")
+        if result["peak_memory"] > old["peak_memory"] * (1 + tolerance):
+            regressions.append(f"{key}: peak memory {old['peak_memory'] / 2**20:.1f} MB -> "
+                               f"{result['peak_memory'] / 2**20:.1f} MB "
+                               f"({result['peak_memory'] / old['peak_memory'] - 1:+.0%})")
+    return regressions
+
+
+def check_golden(outputs: dict, golden: dict, min_snr_db=60.0) -> list:
+    """ Compares outputs with golden outputs.
+    The difference has to be at least min_snr_db decibels below the golden signal, the lengths must match.
+    Returns messages about the failed cases
+    """
+    failures = []
+    for key, output in outputs.items():
+        if key not in golden:
+            continue
+        expected = golden[key]
+
+        if len(output) != len(expected):
+            failures.append(f"{key}: length {len(expected)} -> {len(output)}")
+            continue
+
+        error = np.sum(np.square(output.astype(float) - expected))
+        energy = np.sum(np.square(expected.astype(float)))
+        snr = np.inf if error == 0 else 10 * np.log10(max(energy, 1e-30) / error)
+        if snr < min_snr_db:
+            failures.append(f"{key}: signal to error ratio {snr:.1f} dB, "
+                            f"max difference {np.max(np.abs(output - expected)):.2e}")
+    return failures
+
+
+def benchmark_resampling(seconds=10.0, pitch_factors=(0.75, 1.2, 1.5), samplerate=44100, report=print) -> dict:
+    """ Compares the throughput and the aliasing of the resampling engines.
+
+    The test signal is a 1 kHz tone and a 19 kHz tone. Resampling by a pitch factor above 1 has to remove
+    the 19 kHz tone, factors below 1 must not create images of the tones. Aliasing is the energy
+    of everything except the two tones relative to the 1 kHz tone, in decibels.
+    Returns the output samples per second and the aliasing keyed by (engine, pitch factor)
+    """
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    signal = (0.5 * np.sin(2 * np.pi * 1000 * t) + 0.5 * np.sin(2 * np.pi * 19000 * t)).astype(np.float32)
+
+    results = {}
+    for name, engine in RESAMPLERS.items():
+        resampler = engine()
+        for pitch_factor in pitch_factors:
+            new_len = int(len(signal) / pitch_factor)
+
+            start = time.perf_counter()
+            output = resampler.resample(signal, new_len)
+            elapsed = time.perf_counter() - start
+
+            spectrum = np.square(np.abs(np.fft.rfft(output * np.hanning(new_len))))
+            frequencies = np.fft.rfftfreq(new_len, 1 / samplerate)
+            tone = np.abs(frequencies - 1000 * pitch_factor) < 20
+            kept = tone | (np.abs(frequencies - 19000 * pitch_factor) < 20)
+            aliasing = 10 * np.log10(max(spectrum[~kept].sum(), 1e-30) / spectrum[tone].sum())
+
+            results[(name, pitch_factor)] = {"samples_per_second": new_len / elapsed, "aliasing_db": aliasing}
+            if report is not None:
+                report(f"{name:10s} pitch {pitch_factor:4.2f}  {new_len / elapsed / 1e6:7.1f} M samples/s  "
+                       f"aliasing {aliasing:6.1f} dB")
+
+    return results
+
+
+def benchmark_fft(window_lens=(1024, 2048, 4096, 8192), batch_size=256, repeats=5, report=print) -> dict:
+    """ Measures the throughput of the installed FFT backends on batches of frames like the phase vocoder,
+    a forward and an inverse transform of every frame in double and single precision.
+    Returns the frames per second keyed by (backend, window_len, dtype), backends which are not installed are skipped
+    """
+    rng = np.random.default_rng(0)
+
+    results = {}
+    for name in BACKENDS:
+        backend = make_fft(name)
+        if backend.name != name:
+            if report is not None:
+                report(f"{name:7s} not installed")
+            continue
+
+        for window_len in window_lens:
+            for dtype, complex_dtype in ((np.float64, np.complex128), (np.float32, np.complex64)):
+                blocks = rng.standard_normal((batch_size, window_len)).astype(dtype)
+                spectrum = np.empty((batch_size, window_len // 2 + 1), dtype=complex_dtype)
+                output = np.empty_like(blocks)
+
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    X = backend.rfft(blocks, spectrum)
+                    backend.irfft(X, window_len, output)
+                    times.append(time.perf_counter() - start)
+
+                frames_per_second = batch_size / min(times)
+                results[(name, window_len, np.dtype(dtype).name)] = frames_per_second
+                if report is not None:
+                    report(f"{name:7s} w{window_len:<5d} {np.dtype(dtype).name:8s} {frames_per_second / 1000:8.1f} k frames/s  "
+                           f"workers {backend.workers}")
+
+    return results
+
+
+def benchmark_parallel(seconds=600.0, stretch_factor=1.25, pitch_factor=1.0, workers=(1, 2, 4, 8),
+                       samplerate=44100) -> dict:
+    """ Measures the speedup of ParallelProcessor over a single AudioProcessor.process call
+    on a synthetic signal of the given length.
+
+    Returns a dictionary with the times in seconds, keyed by the number of workers (0 is the serial run)
+    """
+    AP = AudioProcessor(synthetic_signal(seconds, samplerate), samplerate)
+    end_index = len(AP.data) - 1
+
+    start = time.perf_counter()
+    AP.process(0, end_index, stretch_factor, pitch_factor)
+    times = {0: time.perf_counter() - start}
+    print(f"serial:     {times[0]:7.2f} s  realtime factor {seconds / times[0]:7.1f}x")
+
+    for n in workers:
+        start = time.perf_counter()
+        ParallelProcessor(AP, n).process(0, end_index, stretch_factor, pitch_factor)
+        times[n] = time.perf_counter() - start
+        print(f"{n} workers: {times[n]:7.2f} s  realtime factor {seconds / times[n]:7.1f}x  "
+              f"speedup {times[0] / times[n]:5.2f}x")
+
+    return times
+
+
+def check_parallel_seams(seconds=8.0, stretch_factor=1.3, chunk_seconds=2.0, workers=2, max_db=0.5,
+                         samplerate=44100, report=print) -> list:
+    """ Checks that ParallelProcessor joins its chunks without a change of level.
+    A 440 Hz tone is stretched in chunks of chunk_seconds and by a single AudioProcessor.phase_vocoder pass,
+    the RMS of blocks of a quarter window around every seam must match within max_db decibels,
+    with and without phase locking and for a stereo signal.
+    Returns messages about the failed seams
+    """
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    tone = 0.5 * np.sin(2 * np.pi * 440 * t)
+    failures = []
+
+    for name, signal, phase_lock in (("mono-lock", tone, True), ("mono-nolock", tone, False),
+                                     ("stereo-lock", np.column_stack((tone, 0.7 * tone)), True)):
+        AP = AudioProcessor(signal, samplerate, phase_lock=phase_lock, cache_bytes=0)
+        serial = AP.phase_vocoder(signal[:-1], stretch_factor)
+        parallel = ParallelProcessor(AP, workers, chunk_seconds).phase_vocoder(signal[:-1], stretch_factor)
+
+        hop_a = AP.analysis_hop()
+        hop_s = int(round(stretch_factor * hop_a))
+        chunk_frames = int(chunk_seconds * samplerate) // hop_a
+        block_len = AP.window_len // 4
+
+        for seam in range(chunk_frames, (len(signal) - AP.window_len) // hop_a + 1, chunk_frames):
+            # The frames of both chunks overlap a window after the seam
+            region = slice(seam * hop_s - AP.window_len, seam * hop_s + 2 * AP.window_len)
+            levels = []
+            for output in (serial, parallel):
+                part = output[region].reshape(-1, block_len, *output.shape[1:])
+                levels.append(np.sqrt(np.mean(np.square(part.reshape(len(part), -1)), axis=1)))
+            difference = np.max(np.abs(20 * np.log10(levels[1] / levels[0])))
+
+            if report is not None:
+                report(f"{name} seam at frame {seam}: {difference:.2f} dB")
+            if difference > max_db:
+                failures.append(f"{name}: level at the seam at frame {seam} differs by {difference:.2f} dB")
+    return failures
+
+
+# Entry points whose cold import is measured and the modules they must not import at startup
+STARTUP_MODULES = {"audio_processing": ("tkinter", "soundfile", "sounddevice"),
+                   "render": ("tkinter", "sounddevice"),
+                   "app": ("soundfile", "sounddevice")}
+
+
+def benchmark_startup(repeats=5, report=print) -> tuple:
+    """ Measures the cold import time of the entry points in new interpreters, the fastest run counts.
+    The time until the GUI window is drawn is reported in its debug panel.
+    Returns the times in seconds keyed by module and the list of heavy modules imported too early
+    """
+    code = ("import sys, time; start = time.perf_counter(); import {0}; "
+            "print(time.perf_counter() - start, *[name for name in {1!r} if name in sys.modules])")
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    times, problems = {}, []
+    for module, forbidden in STARTUP_MODULES.items():
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", code.format(module, forbidden)], cwd=directory,
+                                    capture_output=True, text=True, check=True).stdout.split()
+            runs.append(float(output[0]))
+
+        times[module] = min(runs)
+        problems += [f"{module} imports {name}" for name in output[1:]]
+        if report is not None:
+            report(f"{module:18s} {1000 * times[module]:7.1f} ms" + (f"  imports {', '.join(output[1:])}" if output[1:] else ""))
+
+    return times, problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks and regression checks of the phase vocoder")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of the test signals (default 10)")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of every case, the fastest counts (default 3)")
+    parser.add_argument("--save", metavar="JSON", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare the results with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown (default 0.10)")
+    parser.add_argument("--golden", metavar="NPZ", help="check the outputs against golden outputs")
+    parser.add_argument("--update-golden", action="store_true", help="store the outputs as the golden outputs")
+    parser.add_argument("--min-snr", type=float, default=60.0, help="golden check threshold in dB (default 60)")
+    parser.add_argument("--parallel", action="store_true", help="only measure the ParallelProcessor speedup")
+    parser.add_argument("--resampling", action="store_true", help="only compare the resampling engines")
+    parser.add_argument("--fft", action="store_true", help="only compare the FFT backends")
+    parser.add_argument("--startup", action="store_true", help="only measure the import time of the entry points")
+    parser.add_argument("--seams", action="store_true", help="only check the seams of the ParallelProcessor chunks")
+    args = parser.parse_args(argv)
+
+    if args.parallel:
+        benchmark_parallel()
+        return 0
+    if args.resampling:
+        benchmark_resampling()
+        return 0
+    if args.fft:
+        benchmark_fft()
+        return 0
+    if args.startup or args.seams:
+        problems = benchmark_startup()[1] if args.startup else check_parallel_seams()
+        for problem in problems:
+            print("REGRESSION", problem)
+        return 1 if problems else 0
+
+    results, outputs = run_suite(args.seconds, repeats=args.repeats)
+    problems = []
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            problems += compare(results, json.load(file), args.tolerance)
+
+    if args.golden:
+        if args.update_golden:
+            np.savez_compressed(args.golden, **outputs)
+        else:
+            with np.load(args.golden) as golden:
+                problems += check_golden(outputs, dict(golden.items()), args.min_snr)
+
+    for problem in problems:
+        print("REGRESSION", problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
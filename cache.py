@@ -0,0 +1,97 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class SegmentCache:
+    """ Memory bounded LRU cache of processed segments.
+
+    Entries are stored under a key describing the processing settings together with the range
+    of the original audio they were computed from. A request for a range inside a cached range
+    with the same settings is answered with a slice of the cached array.
+    Cached arrays are made read-only, because they are shared by everyone who gets them.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+
+        # (key, start_index, end_index) -> processed audio, the least recently used entry is first
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Segments can be processed by several threads at once
+        self.lock = threading.Lock()
+
+
+    def get(self, key: tuple, start_index: int, end_index: int, stretch_factor: float) -> np.ndarray:
+        """ Returns the processed audio of the original range [start_index, end_index)
+        or None if it is not cached.
+        stretch_factor converts original indexes into indexes of the processed audio
+        """
+        with self.lock:
+            entry = (key, start_index, end_index)
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+                self.hits += 1
+                return self.entries[entry]
+
+            # Look for a larger range with the same settings, the most recently used first
+            for entry in reversed(self.entries):
+                entry_key, start, end = entry
+                if entry_key != key or start > start_index or end < end_index:
+                    continue
+
+                data = self.entries[entry]
+                offset = int(round((start_index - start) * stretch_factor))
+                length = int((end_index - start_index) * stretch_factor)
+                if offset + length <= len(data):
+                    self.entries.move_to_end(entry)
+                    self.hits += 1
+                    return data[offset: offset + length]
+
+            self.misses += 1
+            return None
+
+
+    def put(self, key: tuple, start_index: int, end_index: int, data: np.ndarray):
+        """Stores processed audio, evicting the least recently used entries if over budget"""
+        if data.nbytes > self.max_bytes:
+            return
+
+        data.flags.writeable = False
+
+        with self.lock:
+            entry = (key, start_index, end_index)
+            if entry in self.entries:
+                self.bytes -= self.entries.pop(entry).nbytes
+
+            self.entries[entry] = data
+            self.bytes += data.nbytes
+
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+    def stats(self) -> dict:
+        """Returns the counters and the memory used by the cache"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+    def __getstate__(self):
+        # Copies sent to other processes start empty, the lock can't be pickled
+        return {"max_bytes": self.max_bytes}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
@@ -0,0 +1,156 @@
+import inspect
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class NumpyFFT:
+    """ NumPy's pocketfft, single-threaded.
+    NumPy 2.0 and newer keep float32 in single precision and write the result into out
+    """
+    name = "numpy"
+
+    def __init__(self, workers=None):
+        self.workers = 1
+        self.has_out = "out" in inspect.signature(np.fft.rfft).parameters
+
+
+    def rfft(self, blocks: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Transforms the last axis of blocks, into out if the library supports it"""
+        if self.has_out:
+            return np.fft.rfft(blocks, axis=-1, out=out)
+        return np.fft.rfft(blocks, axis=-1)
+
+
+    def irfft(self, spectra: np.ndarray, n: int, out: np.ndarray) -> np.ndarray:
+        """Inverse of rfft, blocks of length n are written into out if the library supports it"""
+        if self.has_out:
+            return np.fft.irfft(spectra, n=n, axis=-1, out=out)
+        return np.fft.irfft(spectra, n=n, axis=-1)
+
+
+class ScipyFFT:
+    """ scipy.fft splits the transforms of a batch over workers threads (all cores by default)
+    and keeps float32 in single precision. The spectra given to irfft are overwritten.
+    scipy.fft has no out parameter, the results are copied into out
+    """
+    name = "scipy"
+
+    def __init__(self, workers=None):
+        # Imported once here, so make_fft falls back to another backend if scipy is missing
+        import scipy.fft
+        self.fft = scipy.fft
+        self.workers = workers or os.cpu_count() or 1
+
+
+    def rfft(self, blocks: np.ndarray, out: np.ndarray) -> np.ndarray:
+        np.copyto(out, self.fft.rfft(blocks, axis=-1, workers=self.workers))
+        return out
+
+
+    def irfft(self, spectra: np.ndarray, n: int, out: np.ndarray) -> np.ndarray:
+        np.copyto(out, self.fft.irfft(spectra, n=n, axis=-1, workers=self.workers, overwrite_x=True))
+        return out
+
+
+class PyFFTW:
+    """ FFTW with a plan for every shape and dtype of the batches, planned once and reused by all later
+    batches and calls. The last max_plans plans of every thread are kept, a vocoder uses only a few batch shapes.
+
+    Planning with FFTW_MEASURE takes a while, FFTW remembers it as wisdom. If wisdom_path is given,
+    the wisdom is loaded from it and saved after every new plan, so later runs plan instantly.
+
+    A plan owns its input and output arrays, so it can't run in two threads at once.
+    Every thread has its own plans, like the work buffers of Resolution, later threads plan from the wisdom
+    """
+    name = "pyfftw"
+
+    def __init__(self, workers=None, effort="FFTW_MEASURE", wisdom_path=None, max_plans=16):
+        import pyfftw
+        self.workers = workers or os.cpu_count() or 1
+        self.effort = effort
+        self.wisdom_path = wisdom_path
+        self.max_plans = max_plans
+        # Plans of every thread, an OrderedDict for each one
+        self.local = threading.local()
+        self.wisdom_lock = threading.Lock()
+
+        if wisdom_path is not None and os.path.exists(wisdom_path):
+            with open(wisdom_path, "rb") as file:
+                pyfftw.import_wisdom(tuple(file.read().split(b"\0")))
+
+
+    def plan(self, kind: str, shape: tuple, dtype, n: int):
+        """ Returns the cached plan of the calling thread for the transform kind ("rfft" or "irfft")
+        of arrays of shape and dtype
+        """
+        import pyfftw
+
+        plans = getattr(self.local, "plans", None)
+        if plans is None:
+            plans = self.local.plans = OrderedDict()
+
+        key = (kind, shape, np.dtype(dtype), n)
+        plan = plans.get(key)
+        if plan is not None:
+            plans.move_to_end(key)
+            return plan
+
+        builder = pyfftw.builders.rfft if kind == "rfft" else pyfftw.builders.irfft
+        plan = builder(pyfftw.empty_aligned(shape, dtype=dtype), n=n, axis=-1, threads=self.workers,
+                       planner_effort=self.effort)
+        plans[key] = plan
+        if len(plans) > self.max_plans:
+            plans.popitem(last=False)
+
+        if self.wisdom_path is not None:
+            try:
+                with self.wisdom_lock, open(self.wisdom_path, "wb") as file:
+                    file.write(b"\0".join(pyfftw.export_wisdom()))
+            except OSError:
+                pass
+        return plan
+
+
+    def rfft(self, blocks: np.ndarray, out: np.ndarray) -> np.ndarray:
+        # The plan returns its own output array, which the next call overwrites
+        result = self.plan("rfft", blocks.shape, blocks.dtype, blocks.shape[-1])(blocks)
+        np.copyto(out, result)
+        return out
+
+
+    def irfft(self, spectra: np.ndarray, n: int, out: np.ndarray) -> np.ndarray:
+        result = self.plan("irfft", spectra.shape, spectra.dtype, n)(spectra)
+        np.copyto(out, result)
+        return out
+
+
+    def __getstate__(self):
+        # Plans can't be pickled, copies sent to other processes plan again
+        return {"workers": self.workers, "effort": self.effort, "wisdom_path": self.wisdom_path,
+                "max_plans": self.max_plans}
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+# FFT backends by name, ordered from the simplest to the fastest
+BACKENDS = {"numpy": NumpyFFT, "scipy": ScipyFFT, "pyfftw": PyFFTW}
+
+def make_fft(name: str, workers=None):
+    """ Returns a new FFT backend by its name, "auto" is the fastest installed one.
+    If the library of a backend is not installed, the next simpler one is used instead,
+    the name of the returned backend tells which one it is
+    """
+    names = list(BACKENDS)
+    if name == "auto":
+        name = names[-1]
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown FFT backend {name!r}, use auto or one of {', '.join(BACKENDS)}")
+
+    for candidate in reversed(names[: names.index(name) + 1]):
+        try:
+            return BACKENDS[candidate](workers)
+        except ImportError:
+            continue
@@ -0,0 +1,294 @@
+import csv
+import json
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper edges of the bins of the callback time histogram in milliseconds, the last bin has no upper edge
+CALLBACK_EDGES_MS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)
+
+# Phases of the processing reported for every process call, "other" is the rest of the time
+PHASES = ("analysis", "peaks", "synthesis", "resample")
+
+# Phase timer of the process call running in this thread
+_local = threading.local()
+
+
+class Histogram:
+    """ Counts of values in fixed bins, adding a value doesn't allocate any arrays,
+    so it can be used in the OutputStream callback
+    """
+    def __init__(self, edges: tuple):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.total = 0
+        self.max = 0.0
+
+
+    def add(self, value: float):
+        self.counts[bisect_left(self.edges, value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, q: float) -> float:
+        """Returns the upper edge of the bin containing the q-th percentile, the maximum for the last bin"""
+        if self.total == 0:
+            return 0.0
+
+        rank = q / 100 * self.total
+        seen = 0
+        for edge, count in zip(self.edges, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(edge, self.max)
+        return self.max
+
+
+    def stats(self) -> dict:
+        return {"edges": list(self.edges), "counts": list(self.counts), "total": self.total, "max": self.max,
+                "p50": self.percentile(50), "p99": self.percentile(99)}
+
+
+class PhaseTimer:
+    """ Measures the wall time spent in named phases of one process call.
+    Times are exclusive - a phase started inside another phase pauses the outer one
+    """
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.stack = []
+        self.mark = perf_counter()
+
+
+    def enter(self, name: str):
+        now = perf_counter()
+        if self.stack:
+            self.phases[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.mark = now
+
+
+    def exit(self):
+        now = perf_counter()
+        name = self.stack.pop()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+
+@contextmanager
+def phase(name: str):
+    """ Adds the time spent inside the block to the phase name of the process call measured in this thread.
+    It does nothing if no call is measured, so it can stay in the processing code
+    """
+    timer = getattr(_local, "timer", None)
+    if timer is None:
+        yield
+        return
+
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.exit()
+
+
+class Instrumentation:
+    """ Collects timing of the realtime playback and of the processing.
+
+    - callback: histogram of the execution time of the OutputStream callback in milliseconds, the number
+      of callbacks which took longer than the audio they produced, and the underflows and overflows
+      reported by sounddevice in the status argument
+    - ring: underruns and the fill level of the RingBuffer read by the callback
+    - process: wall time, realtime factor (seconds of audio per second) and time of every phase
+      of the last max_calls AudioProcessor.process calls, and the time from a change of settings
+      until the new audio was ready
+    - caches: hit rates of the segment cache and of the decoded blocks of the AudioSource
+    - startup: time from the start of the program until the window was drawn
+
+    The callback side only increments counters. Calls are recorded from the worker threads under a lock.
+    Processing in worker processes is not measured, every process has its own copy.
+    """
+    def __init__(self, max_calls=1000):
+        self.max_calls = max_calls
+
+        self.callback_ms = Histogram(CALLBACK_EDGES_MS)
+        self.late_callbacks = 0
+        self.input_underflows = 0
+        self.input_overflows = 0
+        self.output_underflows = 0
+        self.output_overflows = 0
+
+        self.startup_time = None
+
+        self.process_calls = deque(maxlen=max_calls)
+        self.loading_times = deque(maxlen=max_calls)
+        self.lock = threading.Lock()
+
+        # Set by the application for the opened file
+        self.ring = None
+        self.processor = None
+
+
+    def record_callback(self, seconds: float, frames: int, samplerate: int, status):
+        """Records one OutputStream callback, status are the sounddevice CallbackFlags"""
+        self.callback_ms.add(seconds * 1000)
+        if seconds * samplerate > frames:
+            self.late_callbacks += 1
+
+        if status:
+            self.input_underflows += status.input_underflow
+            self.input_overflows += status.input_overflow
+            self.output_underflows += status.output_underflow
+            self.output_overflows += status.output_overflow
+
+
+    @contextmanager
+    def measure_process(self, processor, start_index: int, end_index: int, stretch_factor: float,
+                        pitch_factor: float):
+        """ Measures a process call of processor running in this thread.
+        The yielded dict is recorded at the end, "cached" can be set in it
+        and "processed", the number of processed samples, if it is not the whole range
+        """
+        call = {"start_index": start_index, "end_index": end_index, "stretch_factor": stretch_factor,
+                "pitch_factor": pitch_factor, "cached": False}
+        timer = PhaseTimer()
+        outer, _local.timer = getattr(_local, "timer", None), timer
+        start = timer.mark
+        try:
+            yield call
+        finally:
+            _local.timer = outer
+            wall = perf_counter() - start
+            seconds = call.get("processed", end_index - start_index) / processor.samplerate
+
+            call["seconds"] = seconds
+            call["time"] = wall
+            call["realtime_factor"] = seconds / wall if wall > 0 else float("inf")
+            call["phases"] = dict(timer.phases)
+            call["phases"]["other"] = max(wall - sum(timer.phases.values()), 0.0)
+
+            with self.lock:
+                self.process_calls.append(call)
+
+
+    def record_startup(self, seconds: float):
+        """Records the time from the start of the program until the window was drawn"""
+        self.startup_time = seconds
+
+
+    def record_loading(self, seconds: float):
+        """Records the time from a change of settings until its audio was published"""
+        with self.lock:
+            self.loading_times.append(seconds)
+
+
+    def cache_stats(self) -> dict:
+        """Returns the counters and hit rates of the caches of the processor"""
+        caches = {}
+        if self.processor is not None:
+            caches["segments"] = self.processor.cache.stats()
+            if hasattr(self.processor.data, "stats"):
+                caches["blocks"] = self.processor.data.stats()
+
+        for stats in caches.values():
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return caches
+
+
+    def snapshot(self) -> dict:
+        """Returns all collected values as a dict of plain values"""
+        with self.lock:
+            calls = list(self.process_calls)
+            loading = list(self.loading_times)
+
+        computed = [call for call in calls if not call["cached"]]
+        phases = {name: sum(call["phases"].get(name, 0.0) for call in computed) for name in PHASES + ("other",)}
+        seconds = sum(call["seconds"] for call in computed)
+        wall = sum(call["time"] for call in computed)
+
+        ring = self.ring
+        return {
+            "callback": {"time_ms": self.callback_ms.stats(), "late": self.late_callbacks,
+                         "input_underflows": self.input_underflows, "input_overflows": self.input_overflows,
+                         "output_underflows": self.output_underflows, "output_overflows": self.output_overflows},
+            "ring": {} if ring is None else {"capacity": ring.capacity, "fill_level": ring.fill_level(),
+                                             "underruns": ring.underruns, "underrun_frames": ring.underrun_frames},
+            "process": {"calls": len(calls), "computed": len(computed), "seconds": seconds, "time": wall,
+                        "realtime_factor": seconds / wall if wall > 0 else 0.0, "phases": phases,
+                        "loading_time_max": max(loading, default=0.0),
+                        "loading_time_last": loading[-1] if loading else 0.0},
+            "caches": self.cache_stats(),
+            "startup": {"first_paint": self.startup_time},
+            "process_calls": calls,
+        }
+
+
+    def summary(self) -> str:
+        """Returns a few lines of text with the most important values, shown in the debug panel"""
+        s = self.snapshot()
+        callback, ring, process = s["callback"], s["ring"], s["process"]
+        lines = [
+            f"Callback: {callback['time_ms']['total']} calls, p50 {callback['time_ms']['p50']:.2f} ms, "
+            f"p99 {callback['time_ms']['p99']:.2f} ms, max {callback['time_ms']['max']:.2f} ms, late {callback['late']}",
+            f"Underflows: output {callback['output_underflows']}, input {callback['input_underflows']}",
+        ]
+        if ring:
+            lines.append(f"Ring buffer: fill {100 * ring['fill_level']:.0f} %, underruns {ring['underruns']} "
+                         f"({ring['underrun_frames']} frames)")
+
+        lines.append(f"Processing: {process['computed']} of {process['calls']} calls computed, "
+                     f"realtime factor {process['realtime_factor']:.1f}x, last loading {process['loading_time_last']:.2f} s")
+        if process["time"] > 0:
+            lines.append("Phases: " + ", ".join(f"{name} {100 * time / process['time']:.0f} %"
+                                                for name, time in process["phases"].items()))
+
+        if self.startup_time is not None:
+            lines.append(f"Startup: window drawn after {self.startup_time:.2f} s")
+
+        for name, stats in s["caches"].items():
+            lines.append(f"Cache {name}: hit rate {100 * stats['hit_rate']:.0f} % "
+                         f"({stats['hits']} hits, {stats['misses']} misses)")
+        return "\n".join(lines)
+
+
+    def export_json(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+
+    def export_csv(self, path: str):
+        """ Writes every value as a row of its dotted name and value,
+        e.g. process_calls.3.phases.synthesis
+        """
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(("name", "value"))
+            writer.writerows(flatten(self.snapshot()))
+
+
+    def __getstate__(self):
+        # Copies sent to other processes start empty, the lock can't be pickled
+        return {"max_calls": self.max_calls}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["max_calls"])
+
+
+def flatten(value, prefix="") -> list:
+    """Returns (dotted name, value) pairs of all plain values in nested dicts and lists"""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+    else:
+        return [(prefix, value)]
+
+    rows = []
+    for key, item in items:
+        rows.extend(flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    return rows
@@ -0,0 +1,115 @@
+from collections import deque
+from math import ceil, log2
+from typing import NamedTuple
+
+class LatencyProfile(NamedTuple):
+    """Target latency of the output stream, the settings are derived from it by choose_settings"""
+    name: str
+    # Duration of one block requested by the OutputStream callback in seconds
+    block_seconds: float
+    # Latency requested from sounddevice in blocks
+    latency_blocks: float
+    # Frames buffered between the producer and the callback in blocks
+    ring_blocks: int
+    # Part of the block duration the slowest callbacks may take
+    max_load: float
+
+
+# Profiles from the lowest latency to the most robust one
+PROFILES = {
+    "low":      LatencyProfile("low", 0.005, 2, 3, 0.25),
+    "balanced": LatencyProfile("balanced", 0.012, 2, 4, 0.4),
+    "safe":     LatencyProfile("safe", 0.046, 3, 6, 0.6),
+}
+
+MIN_BLOCKSIZE = 64
+MAX_BLOCKSIZE = 8192
+
+# Processing slower than this realtime factor leaves the producer little reserve, so more frames are buffered
+MIN_REALTIME_FACTOR = 4.0
+
+
+class StreamSettings(NamedTuple):
+    blocksize: int
+    # Latency requested from sounddevice in seconds
+    latency: float
+    ring_blocks: int
+
+
+def choose_settings(profile: LatencyProfile, samplerate: int, instrumentation=None) -> StreamSettings:
+    """ Returns the settings of the output stream for profile.
+
+    The blocksize is the power of two closest to block_seconds. With instrumentation, it is doubled
+    until the 99th percentile of the measured callback time fits into max_load of the block,
+    and the ring buffer is enlarged when the measured processing realtime factor is low.
+    """
+    blocksize = 2 ** round(log2(profile.block_seconds * samplerate))
+    blocksize = min(max(blocksize, MIN_BLOCKSIZE), MAX_BLOCKSIZE)
+    ring_blocks = profile.ring_blocks
+
+    if instrumentation is not None:
+        stats = instrumentation.snapshot()
+
+        callback_time = stats["callback"]["time_ms"]["p99"] / 1000
+        while blocksize < MAX_BLOCKSIZE and callback_time > profile.max_load * blocksize / samplerate:
+            blocksize *= 2
+
+        realtime_factor = stats["process"]["realtime_factor"]
+        if 0 < realtime_factor < MIN_REALTIME_FACTOR:
+            ring_blocks = ceil(ring_blocks * MIN_REALTIME_FACTOR / realtime_factor)
+
+    return StreamSettings(blocksize, profile.latency_blocks * blocksize / samplerate, ring_blocks)
+
+
+class LatencyController:
+    """ Keeps the selected latency profile and moves to the next safer one
+    after max_xruns xruns within window_seconds, if auto is True.
+
+    Xruns are the underflows reported by sounddevice, callbacks which took longer than their block
+    and underruns of the ring buffer, all taken from Instrumentation.
+    """
+    def __init__(self, profile="balanced", auto=True, max_xruns=3, window_seconds=10.0):
+        self.profile = profile
+        self.auto = auto
+        self.max_xruns = max_xruns
+        self.window_seconds = window_seconds
+
+        # Times of the recent xruns and the total count at the last check
+        self.xrun_times = deque()
+        self.last_count = None
+
+
+    def set_profile(self, profile: str):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown latency profile {profile!r}, use one of {', '.join(PROFILES)}")
+        self.profile = profile
+        # Xruns of the previous settings don't count against the new ones
+        self.xrun_times.clear()
+
+
+    @staticmethod
+    def count_xruns(instrumentation) -> int:
+        ring = instrumentation.ring
+        return (instrumentation.output_underflows + instrumentation.late_callbacks
+                + (ring.underruns if ring is not None else 0))
+
+
+    def check(self, instrumentation, now: float) -> bool:
+        """Counts new xruns, returns True if the profile was changed to a safer one"""
+        count = self.count_xruns(instrumentation)
+        if self.last_count is not None:
+            # A new ring buffer starts counting its underruns from zero
+            new = count - self.last_count if count >= self.last_count else count
+            self.xrun_times.extend([now] * new)
+        self.last_count = count
+
+        while self.xrun_times and now - self.xrun_times[0] > self.window_seconds:
+            self.xrun_times.popleft()
+
+        names = list(PROFILES)
+        position = names.index(self.profile)
+        if not self.auto or len(self.xrun_times) < self.max_xruns or position + 1 == len(names):
+            return False
+
+        self.set_profile(names[position + 1])
+        return True
@@ -1,67 +1,95 @@
-import sounddevice as sd
+from time import perf_counter
+
+# Start of the program, the time until the window is drawn is measured from here
+started = perf_counter()
+
 from app import *
 
 # Values used to update playback progress bar
 pb_value = 0
 
+# Settings the OutputStream was opened with
+stream_settings = None
+
 def callback(outdata, frames, time, status):
     """ Called periodically by sounddevice's OutputStream
     
-    returns piece of audio (zero array if paused) that is used by OutputStream
-    to play back the audio snippets
+    copies the next frames from the ring buffer filled by the PlaybackProducer (zeros if paused),
+    nothing is allocated or computed here, so the callback always finishes in time
     """
     global application, pb_value
+    start = perf_counter()
+
+    # Read the ring buffer only once, opening a file replaces it
+    ring = application.ring
 
     # If audio is paused return a zero array
-    if not application.is_playing or application.out_data is None:
+    # The stream is reopened when the number of channels changes, until then it plays silence
+    if not application.is_playing or ring is None or ring.channels != outdata.shape[1]:
         outdata.fill(0)
-        return
+        if ring is not None:
+            ring.skip_flushed()
+    else:
+        ring.read_into(outdata)
 
-    block_end = application.i + frames
+        # Update progress bar value
+        pb_value = ring.position / application.file_len
 
-    # Copy a block from the out_data array
-    if block_end <= application.pb_end_index:
-        block = application.out_data[application.i : block_end]
-        application.i = block_end
-    # If a block is partly in the loop but partly outside, split it and wrap the second part back
-    else:
-        first_part = application.out_data[application.i: application.pb_end_index]
-        remaining_part_len = block_end - application.pb_end_index
-        second_part = application.out_data[application.pb_start_index : application.pb_start_index + remaining_part_len]
-        block = np.concatenate((first_part, second_part), axis=0)
+    application.instrumentation.record_callback(perf_counter() - start, frames, application.samplerate, status)
 
-        application.i = application.pb_start_index + remaining_part_len
 
-    # copy block into output
-    outdata[:, 0] = block
+def open_stream(application):
+    """ Opens and starts an OutputStream with the samplerate and the number of channels of the opened file
+    and the blocksize and latency of the latency profile.
+    sounddevice initialises PortAudio when it is imported, so it is imported with the first stream,
+    after the window is shown
+    """
+    import sounddevice as sd
 
-    # Update progress bar value
-    orig_sample_index = application.start_index + application.i / application.stretch_factor
-    pb_value = orig_sample_index / application.file_len
+    global stream_settings
+    stream_settings = application.stream_settings()
+    stream = sd.OutputStream(callback=callback, samplerate=application.samplerate,
+                             blocksize=application.out_blocksize, latency=application.out_latency,
+                             channels=application.AP.channels)
+    stream.start()
+    return stream
 
 
 def playback_progress(application):
     """Updates progress bar and timecode every 33 milliseconds"""
-    global pb_value, root
+    global pb_value, root, stream
+
+    # A newly opened file can have another samplerate or number of channels
+    # and the latency profile can change the blocksize and the latency
+    # The first stream is opened with the first file
+    application.check_latency()
+    if application.samplerate is not None and stream_settings != application.stream_settings():
+        if stream is not None:
+            stream.stop()
+            stream.close()
+        stream = open_stream(application)
 
     v = pb_value  # in Tk main thread
     application.update_time(v)
+    application.update_debug()
     root.after(33, playback_progress, application)  # around 30 times per second
 
 
-# Loads application
-root = Tk()
-root.title("Phase Vocoder")
-application = App(root)
+# Worker processes import this module too, so the application starts only in the main process
+if __name__ == "__main__":
+    # Loads application
+    root = Tk()
+    root.title("Phase Vocoder")
+    application = App(root, started)
 
-# Initialise and start audio stream
-stream = sd.OutputStream(callback=callback, samplerate=application.samplerate, blocksize=application.out_blocksize, channels=1)
-stream.start()
+    # The audio stream is opened by playback_progress once a file is opened
+    stream = None
 
-# Start GUI main loop
-playback_progress(application)
-try:
-    root.mainloop()
-finally:
-    stream.stop()
-    stream.close()
+    # Start GUI main loop
+    playback_progress(application)
+    try:
+        root.mainloop()
+    finally:
+        if stream is not None:
+            stream.stop()
+            stream.close()
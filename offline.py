@@ -0,0 +1,211 @@
+import os
+import numpy as np
+from audio_processing import AudioProcessor, VocoderState
+from automation import is_automated
+
+# Normalisation of the rendered audio:
+# - peak: divided by the peak of the vocoder output like process, which needs two passes over the file
+# - running: brought to the level of the input, attenuated from a sample on only if it would exceed 1.0
+# - none: brought to the level of the input, it can exceed 1.0
+NORMALISATIONS = ("peak", "running", "none")
+
+
+class OfflineRender:
+    """ Renders a range of data block by block, so the memory used doesn't depend on its length.
+
+    process needs the whole segment, the whole vocoder output and the resampled copies of it in memory at once.
+    Here the frames are read from data in batches of batch_size, synthesised and overlap-added
+    into a tail of one window, and every finished part is resampled and yielded right away.
+    With an AudioSource as data, only the blocks being processed are decoded.
+
+    With the peak normalisation the blocks are the same as the result of process, within float32 rounding.
+    """
+    def __init__(self, processor: AudioProcessor, start_index=0, end_index=None, stretch_factor=1.0,
+                 pitch_factor=1.0, block_len=2**16):
+        end_index = len(processor.data) if end_index is None else end_index
+        if is_automated(stretch_factor) or is_automated(pitch_factor):
+            raise ValueError("Streamed renders need fixed factors, envelopes are rendered by process")
+        if start_index >= end_index or start_index < 0 or end_index > len(processor.data):
+            raise ValueError("Invalid index range")
+
+        self.AP = processor
+        self.start_index = start_index
+        self.end_index = end_index
+        self.stretch_factor = stretch_factor
+        self.pitch_factor = pitch_factor
+        # Length of the resampled blocks
+        self.block_len = block_len
+
+        length = end_index - start_index
+        self.hop_a = processor.analysis_hop()
+        self.hop_s = int(round(stretch_factor * pitch_factor * self.hop_a))
+        # Lengths of the vocoder output and of the result, the same as in phase_vocoder and pitch_shift
+        self.stretched_len = int(length * stretch_factor * pitch_factor)
+        self.output_len = int(length * stretch_factor) if pitch_factor != 1 else self.stretched_len
+
+        # Peak of the unnormalised vocoder output, known after the vocoder ran over the whole range
+        self.peak = None
+
+
+    def __len__(self) -> int:
+        return self.output_len
+
+
+    def unprocessed(self) -> bool:
+        """process returns unchanged data for these factors"""
+        return self.stretch_factor == 1 and self.pitch_factor == 1
+
+
+    def vocoded(self, scale: float):
+        """ Yields the vocoder output of the range multiplied by scale in consecutive parts,
+        trimmed or padded to stretched_len samples like phase_vocoder. Sets peak at the end
+        """
+        AP, hop_a, hop_s, window_len = self.AP, self.hop_a, self.hop_s, self.AP.window_len
+        channel_shape = AP.data.shape[1:]
+
+        num_frames = max((self.end_index - self.start_index - window_len) // hop_a + 1, 0)
+        plan = AP.plan(hop_s)
+        state = VocoderState(plan.workspace())
+        tail = np.zeros((window_len,) + channel_shape, dtype=AP.dtype)
+        peak = 0.0
+        # Number of samples still to be yielded
+        remaining = self.stretched_len
+
+        for first in range(0, num_frames, AP.batch_size):
+            count = min(AP.batch_size, num_frames - first)
+            position = self.start_index + first * hop_a
+            segment = np.asarray(AP.data[position: position + (count - 1) * hop_a + window_len], dtype=AP.dtype)
+            output = AP.synthesise(AP.frames(segment, hop_a)[:count], hop_a, hop_s, state, plan)
+
+            # The first count * hop_s samples are finished, no later block reaches them
+            finished_len = count * hop_s
+            buffer = np.zeros((finished_len + window_len,) + channel_shape, dtype=AP.dtype)
+            buffer[:window_len] = tail
+            AP.overlap_add(buffer, output, 0, hop_s)
+            tail = buffer[finished_len:]
+
+            finished = buffer[:finished_len]
+            if len(finished):
+                peak = max(peak, finished.max(), -finished.min())
+            if remaining > 0:
+                part = finished[:remaining] * scale
+                remaining -= len(part)
+                yield part
+
+        if len(tail):
+            peak = max(peak, tail.max(), -tail.min())
+        self.peak = peak
+
+        if remaining > 0:
+            part = tail[:remaining] * scale
+            remaining -= len(part)
+            yield part
+
+        # The end is padded with zeros
+        for start in range(0, remaining, self.block_len):
+            yield np.zeros((min(self.block_len, remaining - start),) + channel_shape, dtype=AP.dtype)
+
+
+    def resampled(self, parts):
+        """ Resamples the stretched_len samples coming in parts to output_len samples, yields blocks of block_len.
+        Only the input samples needed by the next block are kept
+        """
+        resampler = self.AP.resampler
+        old_len, new_len = self.stretched_len, self.output_len
+        parts = iter(parts)
+
+        # Kept input samples and the index of the first one
+        kept = np.zeros((0,) + self.AP.data.shape[1:], dtype=self.AP.dtype)
+        offset = 0
+
+        for start in range(0, new_len, self.block_len):
+            end = min(start + self.block_len, new_len)
+            low, high = resampler.span(old_len, new_len, start, end)
+
+            pieces = [kept[low - offset:]]
+            available = offset + len(kept)
+            while available < high:
+                part = next(parts)
+                pieces.append(part)
+                available += len(part)
+            kept = np.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+            offset = max(low, offset)
+
+            yield resampler.resample_part(kept, offset, old_len, new_len, start, end)
+
+        # Runs the vocoder to the end, so peak is set
+        for _ in parts:
+            pass
+
+
+    def stream(self, scale: float):
+        """Yields the result multiplied by scale before resampling, the vocoder output for pitch_factor 1"""
+        if self.pitch_factor == 1:
+            return self.vocoded(scale)
+        return self.resampled(self.vocoded(scale))
+
+
+    def measure_peak(self) -> float:
+        """Runs the vocoder over the whole range and returns the peak of its output"""
+        if self.peak is None:
+            for _ in self.vocoded(1.0):
+                pass
+        return self.peak
+
+
+    def blocks(self, normalise="peak"):
+        """ Yields the rendered audio in float32 blocks, normalised by one of NORMALISATIONS.
+        peak runs the vocoder twice, first only to find the peak
+        """
+        if normalise not in NORMALISATIONS:
+            raise ValueError(f"Unknown normalisation {normalise!r}, use one of {', '.join(NORMALISATIONS)}")
+
+        # Unchanged data isn't normalised, like in process
+        if self.unprocessed():
+            for start in range(self.start_index, self.end_index, self.block_len):
+                yield np.asarray(self.AP.data[start: min(start + self.block_len, self.end_index)], dtype=np.float32)
+            return
+
+        if normalise == "peak":
+            peak = self.measure_peak()
+            scale = 1 / peak if peak != 0 else 1.0
+        else:
+            scale = self.AP.overlap_gain(self.hop_s)
+
+        # The gain of running only goes down, so the level doesn't pump
+        gain = 1.0
+        for block in self.stream(scale):
+            if normalise == "running" and len(block):
+                gain = min(gain, 1 / max(block.max(), -block.min(), 1.0))
+                block = block * gain
+            yield block.astype(np.float32, copy=False)
+
+
+    def write(self, path: str, samplerate: int, normalise="peak", subtype=None):
+        """ Writes the rendered audio into a sound file block by block.
+        With peak, the unnormalised audio is first written into a temporary float file next to path
+        and then rescaled while copying it, so the vocoder runs only once
+        """
+        import soundfile as sf
+
+        channels = self.AP.data.shape[1] if self.AP.data.ndim > 1 else 1
+        if normalise != "peak" or self.unprocessed():
+            with sf.SoundFile(path, "w", samplerate, channels, subtype) as file:
+                for block in self.blocks(normalise):
+                    file.write(block)
+            return
+
+        # W64 files aren't limited to 4 GB like WAV
+        temporary = path + ".tmp.w64"
+        try:
+            with sf.SoundFile(temporary, "w", samplerate, channels, "FLOAT", format="W64") as file:
+                for block in self.stream(1.0):
+                    file.write(block.astype(np.float32, copy=False))
+
+            scale = 1 / self.peak if self.peak != 0 else 1.0
+            with sf.SoundFile(temporary) as source, sf.SoundFile(path, "w", samplerate, channels, subtype) as file:
+                for block in source.blocks(self.block_len, dtype="float32", always_2d=channels > 1):
+                    file.write(block * np.float32(scale))
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
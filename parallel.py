@@ -0,0 +1,186 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from audio_processing import AudioProcessor, VocoderState
+
+# AudioProcessor of a worker process reading the source audio from shared memory
+_processor = None
+_shared = None
+
+def _attach(name: str, shape: tuple, dtype: str, samplerate: int, settings: dict):
+    """Creates the AudioProcessor of a worker process over the shared source audio"""
+    global _processor, _shared
+    _shared = shared_memory.SharedMemory(name=name)
+
+    data = np.ndarray(shape, dtype=dtype, buffer=_shared.buf)
+    _processor = AudioProcessor(data, samplerate, **settings)
+
+
+def _frames(first_frame: int, end_frame: int) -> np.ndarray:
+    """Returns analysis frames first_frame to end_frame of the shared audio"""
+    hop_a = _processor.analysis_hop()
+    chunk = _processor.data[first_frame * hop_a: (end_frame - 1) * hop_a + _processor.window_len]
+    return _processor.frames(chunk, hop_a)[:end_frame - first_frame]
+
+
+def _transient_frames(first_frame: int, end_frame: int) -> np.ndarray:
+    """ Returns the indexes of the transient frames from first_frame to end_frame, the detector continues
+    from the frame before first_frame like in a single pass
+    """
+    state = VocoderState(_processor.main.workspace())
+    if first_frame > 0:
+        _processor.detect_transients(_frames(first_frame - 1, first_frame), state)
+
+    flags = []
+    for first in range(first_frame, end_frame, _processor.batch_size):
+        end = min(first + _processor.batch_size, end_frame)
+        flags.append(_processor.detect_transients(_frames(first, end), state).copy())
+    return first_frame + np.flatnonzero(np.concatenate(flags))
+
+
+def _aligned_state(first_frame: int, hop_s: int, restart: int) -> VocoderState:
+    """ Returns the vocoder state after the frame before first_frame, as if the phase vocoder ran over
+    all frames since the frame restart, which restarted the phases with its analysis phases.
+
+    Over steady audio, the synthesis phase of a frame n is then its analysis phase advanced
+    by the frequency of every bin over (n - restart) * (hop_s - hop_a) samples, the distance the frame moved
+    relative to the frame restart. The two frames before first_frame give the analysis phases and the frequencies,
+    they also continue the transient detection
+    """
+    hop_a = _processor.analysis_hop()
+    plan = _processor.plan(hop_s)
+    state = VocoderState(plan.workspace())
+
+    frames = _frames(first_frame - 2, first_frame)
+    _processor.synthesise(frames[:1], hop_a, hop_s, state, plan)
+    before = state.previous_phase
+    _processor.synthesise(frames[1:], hop_a, hop_s, state, plan)
+
+    # The same estimate of the frequencies as in propagate_phases, in radians per sample
+    expected = plan.expected_advance
+    frequency = (_processor.wrap_phase(state.previous_phase - before - expected) + expected) / np.float64(hop_a)
+    shift = (first_frame - 1 - restart) * (hop_s - hop_a)
+    state.previous_phase_synthesis = _processor.wrap_phase(state.previous_phase + frequency * shift).astype(
+        _processor.dtype)
+    return state
+
+
+def _vocode_chunk(first_frame: int, end_frame: int, hop_s: int, restart: int) -> np.ndarray:
+    """ Runs the phase vocoder over analysis frames first_frame to end_frame of the shared audio,
+    continuing the phases of the frames before it from the frame restart, see _aligned_state
+    """
+    hop_a = _processor.analysis_hop()
+    chunk = _processor.data[first_frame * hop_a: (end_frame - 1) * hop_a + _processor.window_len]
+    state = _aligned_state(first_frame, hop_s, restart) if first_frame >= 2 else None
+    return _processor.vocode(chunk, hop_s, state)
+
+
+class ParallelProcessor:
+    """ Processes long segments on several CPU cores.
+
+    The segment is split into chunks of whole analysis frames, which are processed by a pool of processes.
+    The source audio is copied once into shared memory, so it is not sent to each worker.
+
+    The outputs of the chunks are overlap-added like the frames of a single pass, so the phases of the first frame
+    of a chunk have to follow the phases of the previous chunk. They can't be taken from it, the chunks run
+    at the same time. The transient frames, which restart the phases, are found first in a quick parallel pass.
+    Every chunk then starts with the phases its first frame would have over steady audio since the last
+    restart before it, so the seams of steady sounds add up coherently, without a change of level.
+    The result is normalised as a whole.
+    """
+    def __init__(self, processor: AudioProcessor, workers=None, chunk_seconds=30.0):
+        self.AP = processor
+        # Number of processes, None uses all cores
+        self.workers = workers
+        self.chunk_seconds = chunk_seconds
+
+
+    def process(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float) -> np.ndarray:
+        """ Same as AudioProcessor.render, but the phase vocoder runs in parallel.
+        The result has the same dtype as the result of render
+        """
+        data = self.AP.data
+        if start_index >= end_index or start_index >= len(data) or end_index >= len(data):
+            raise ValueError("Invalid index range")
+
+        segment = data[start_index : end_index]
+
+        # No processing needed
+        if pitch_factor == 1 and stretch_factor == 1:
+            return segment.astype(np.float32, copy=False)
+
+        # Pitch shifting needs the audio stretched by both factors before resampling
+        stretched = self.phase_vocoder(segment, stretch_factor * pitch_factor)
+
+        # Stays in the dtype of the processor, as AudioProcessor.phase_vocoder returns it
+        if pitch_factor == 1:
+            return stretched
+
+        new_length = int(len(segment) * stretch_factor)
+        return self.AP.resample(stretched, new_length).astype(np.float32, copy=False)
+
+
+    def phase_vocoder(self, segment: np.ndarray, stretch_factor: float) -> np.ndarray:
+        """ Parallel version of AudioProcessor.phase_vocoder
+
+        Returns an array of the time stretched audio signal normalised to a peak of 1.0
+        """
+        window_len = self.AP.window_len
+        hop_a = self.AP.analysis_hop()
+        hop_s = int(round(stretch_factor * hop_a))
+
+        num_frames = max((len(segment) - window_len) // hop_a + 1, 0)
+        result = np.zeros((num_frames * hop_s + window_len,) + segment.shape[1:], dtype=self.AP.dtype)
+
+        # Chunk boundaries in analysis frames, every chunk after the first one starts after two frames
+        # which give its starting phases
+        chunk_frames = max(int(self.chunk_seconds * self.AP.samplerate) // hop_a, 2)
+        seams = list(range(chunk_frames, num_frames, chunk_frames))
+
+        # Copy the segment into shared memory once for all workers
+        shared = shared_memory.SharedMemory(create=True, size=max(segment.nbytes, 1))
+        source = np.ndarray(segment.shape, dtype=segment.dtype, buffer=shared.buf)
+        source[:] = segment
+        try:
+            # Every setting which changes the processed audio is passed, so the workers compute the same audio
+            settings = dict(window_len=window_len, hop_len=self.AP.hop_len, phase_lock=self.AP.phase_lock,
+                            batch_size=self.AP.batch_size, channel_lock=self.AP.channel_lock,
+                            precision=self.AP.precision, fft=self.AP.fft.name, fft_workers=self.AP.fft.workers,
+                            adaptive=self.AP.adaptive, transients=self.AP.transients)
+
+            with ProcessPoolExecutor(self.workers, initializer=_attach,
+                                     initargs=(shared.name, segment.shape, segment.dtype.str,
+                                               self.AP.samplerate, settings)) as executor:
+
+                starts = [0] + seams
+                ends = seams + [num_frames]
+
+                # The last frame restarting the phases before every chunk, the first frame always restarts them
+                restarts = [0] * len(starts)
+                if seams:
+                    scans = [executor.submit(_transient_frames, first, end) for first, end in zip(starts, ends)]
+                    transients = np.concatenate([np.zeros(1, dtype=int)] + [scan.result() for scan in scans])
+                    restarts = [int(transients[np.searchsorted(transients, first) - 1]) if first > 0 else 0
+                                for first in starts]
+
+                chunks = [(first, executor.submit(_vocode_chunk, first, end, hop_s, restart))
+                          for first, end, restart in zip(starts, ends, restarts)]
+
+                # Chunks are removed from the list, so their outputs are freed once they are added
+                while chunks:
+                    first, future = chunks.pop(0)
+                    output = future.result()
+                    result[first * hop_s: first * hop_s + len(output)] += output
+        finally:
+            # The array has to be released before the shared memory is closed
+            del source
+            shared.close()
+            shared.unlink()
+
+        # Normalise the whole result
+        m = np.max(np.abs(result))
+        if m != 0:
+            result /= m
+
+        return self.AP.fit_length(result, int(len(segment) * stretch_factor))
+
@@ -0,0 +1,161 @@
+import argparse
+import glob
+import os
+import time
+import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from audio_processing import AudioProcessor
+from source import AudioSource
+from transients import DETECTORS
+from fft_backends import BACKENDS
+from offline import OfflineRender, NORMALISATIONS
+from automation import Envelope
+
+def render_file(input_path: str, output_path: str, stretch_factor=1.0, pitch_factor=1.0,
+                window_len=4096, hop_len=None, phase_lock=True, subtype=None, mono=False,
+                resampling="linear", precision="double", transients="energy", fft="numpy", stream=False,
+                normalise="peak", adaptive=False) -> dict:
+    """ Time stretches and pitch shifts a whole sound file and writes the result with soundfile.
+    All channels are kept, unless mono is True.
+    With stream, the file is rendered block by block by OfflineRender, so files of any length fit into memory,
+    normalise is then one of NORMALISATIONS. Otherwise the whole file is processed at once.
+    The factors can also be envelopes written as text for Envelope.parse, OfflineRender can't stream them
+    Returns the length of the input in seconds and the time spent on it
+    """
+    start = time.perf_counter()
+
+    data = AudioSource(input_path, mono=mono)
+    # Breakpoints are given in seconds, so they are converted with the samplerate of every file
+    stretch_factor = parse_factor(stretch_factor, data.samplerate)
+    pitch_factor = parse_factor(pitch_factor, data.samplerate)
+    # Every file is processed only once, so nothing is cached
+    processor = AudioProcessor(data, data.samplerate, window_len, hop_len, phase_lock, cache_bytes=0,
+                               resampling=resampling, precision=precision, transients=transients, fft=fft,
+                               adaptive=adaptive)
+
+    if stream:
+        OfflineRender(processor, 0, len(data) - 1, stretch_factor, pitch_factor).write(
+            output_path, data.samplerate, normalise, subtype)
+    else:
+        result = processor.process(0, len(data) - 1, stretch_factor, pitch_factor)
+        sf.write(output_path, result, data.samplerate, subtype=subtype)
+
+    return {"input": input_path, "output": output_path, "seconds": processor.duration,
+            "time": time.perf_counter() - start}
+
+
+def parse_factor(factor, samplerate: int):
+    """Returns a factor given as text as a number or an Envelope, other factors are returned unchanged"""
+    if not isinstance(factor, str):
+        return factor
+    envelope = Envelope.parse(factor, samplerate)
+    return float(envelope.values[0]) if len(envelope.values) == 1 else envelope
+
+
+def output_path(input_path: str, output_dir: str, file_format: str, suffix: str) -> str:
+    """Returns the path of the rendered file in output_dir, or next to the input if output_dir is None"""
+    directory = output_dir if output_dir is not None else os.path.dirname(input_path)
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(directory, name + suffix + "." + file_format)
+
+
+def render_files(input_paths: list, output_dir=None, stretch_factor=1.0, pitch_factor=1.0, window_len=4096,
+                 hop_len=None, phase_lock=True, file_format="wav", subtype=None, suffix="_processed",
+                 workers=None, mono=False, resampling="linear", precision="double", transients="energy",
+                 fft="numpy", stream=False, normalise="peak", adaptive=False, report=print) -> dict:
+    """ Renders many files concurrently on a pool of processes.
+
+    Every process renders one file at a time and sends back only its statistics,
+    so the memory used is bounded by the longest files being rendered at once.
+    report is called with a line of progress after every file, None disables it.
+    Returns the number of files, the seconds of rendered audio, the total time, files per second
+    and the realtime factor (seconds of audio rendered per second)
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    seconds = 0.0
+    failed = []
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(render_file, path, output_path(path, output_dir, file_format, suffix),
+                                   stretch_factor, pitch_factor, window_len, hop_len, phase_lock, subtype,
+                                   mono, resampling, precision, transients, fft, stream, normalise, adaptive): path
+                   for path in input_paths}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            elapsed = time.perf_counter() - start
+            try:
+                stats = future.result()
+            except (RuntimeError, ValueError, OSError) as e:
+                failed.append(futures[future])
+                message = f"failed: {futures[future]}: {e}"
+            else:
+                seconds += stats["seconds"]
+                message = (f"{stats['input']} -> {stats['output']}  "
+                           f"({stats['seconds']:.1f} s of audio in {stats['time']:.2f} s)")
+
+            if report is not None:
+                report(f"[{done}/{len(futures)}] {message}  "
+                       f"{done / elapsed:.2f} files/s, realtime factor {seconds / elapsed:.1f}x")
+
+    total = time.perf_counter() - start
+    return {"files": len(input_paths) - len(failed), "failed": failed, "seconds": seconds, "time": total,
+            "files_per_second": (len(input_paths) - len(failed)) / total, "realtime_factor": seconds / total}
+
+
+def expand_paths(patterns: list) -> list:
+    """Expands glob patterns, paths without any match are kept, so a missing file is reported"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time stretches and pitch shifts sound files with the phase vocoder")
+    parser.add_argument("inputs", nargs="+", help="input files or glob patterns")
+    parser.add_argument("-s", "--stretch", default="1.0",
+                        help="time stretch factor or an envelope of seconds:factor pairs, e.g. 0:1,10:2 (default 1.0)")
+    parser.add_argument("-p", "--pitch", default="1.0",
+                        help="pitch shift factor or an envelope of seconds:factor pairs (default 1.0)")
+    parser.add_argument("-w", "--window", type=int, default=4096, help="window length in samples (default 4096)")
+    parser.add_argument("--hop", type=int, default=None, help="analysis hop in samples (default window / 4)")
+    parser.add_argument("--no-phase-lock", action="store_true", help="disable phase locking")
+    parser.add_argument("--mono", action="store_true", help="mix all channels down to mono")
+    parser.add_argument("-r", "--resampling", default="linear", choices=("linear", "sinc", "polyphase"),
+                        help="resampling engine used for pitch shifting (default linear)")
+    parser.add_argument("-t", "--transients", default="energy", choices=tuple(DETECTORS),
+                        help="detector of transients, which restart the phases (default energy)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="resynthesise frames around transients with a 4x shorter window, sharper attacks")
+    parser.add_argument("--fft", default="numpy", choices=("auto",) + tuple(BACKENDS),
+                        help="FFT library, unavailable ones fall back to numpy (default numpy)")
+    parser.add_argument("--stream", action="store_true",
+                        help="render block by block with constant memory, for very long files")
+    parser.add_argument("--normalise", default="peak", choices=NORMALISATIONS,
+                        help="normalisation of streamed renders: peak like the whole file (two passes), "
+                             "running limiter or none (default peak)")
+    parser.add_argument("--single", action="store_true", help="compute in single precision, faster and uses less memory")
+    parser.add_argument("-o", "--output-dir", default=None, help="output directory (default next to the inputs)")
+    parser.add_argument("-f", "--format", default="wav", help="output file format, e.g. wav, flac, ogg (default wav)")
+    parser.add_argument("--subtype", default=None, help="soundfile subtype, e.g. PCM_16, FLOAT")
+    parser.add_argument("--suffix", default="_processed", help="added to the output file names")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (default all cores)")
+    args = parser.parse_args(argv)
+
+    summary = render_files(expand_paths(args.inputs), args.output_dir, args.stretch, args.pitch, args.window,
+                           args.hop, not args.no_phase_lock, args.format, args.subtype, args.suffix, args.workers,
+                           args.mono, args.resampling, "single" if args.single else "double", args.transients,
+                           args.fft, args.stream, args.normalise, args.adaptive)
+
+    print(f"{summary['files']} files, {summary['seconds']:.1f} s of audio in {summary['time']:.2f} s: "
+          f"{summary['files_per_second']:.2f} files/s, realtime factor {summary['realtime_factor']:.1f}x")
+
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,268 @@
+import numpy as np
+from fractions import Fraction
+from functools import lru_cache
+
+class LinearResampler:
+    """ Linear interpolation between the two neighbouring input samples.
+    The fastest engine, but it lets through images and aliases of high frequencies
+    """
+    def __init__(self, block_len=2**16):
+        # Number of output samples computed at once, it bounds the size of the temporary arrays
+        self.block_len = block_len
+
+
+    def resample(self, input: np.ndarray, new_len: int) -> np.ndarray:
+        """ Resamples input to new_len samples, the first and the last samples stay in place.
+        Multichannel audio is resampled along the first axis. Returns a float32 array
+        """
+        output = np.empty((new_len,) + input.shape[1:], dtype=np.float32)
+        for start in range(0, new_len, self.block_len):
+            end = min(start + self.block_len, new_len)
+            output[start:end] = self.resample_part(input, 0, len(input), new_len, start, end)
+
+        return output
+
+
+    @staticmethod
+    def step(old_len: int, new_len: int) -> float:
+        """Returns the distance of the output samples in input samples"""
+        return (old_len - 1) / (new_len - 1) if new_len > 1 else 0.0
+
+
+    def span(self, old_len: int, new_len: int, start: int, end: int) -> tuple:
+        """Returns the range of input samples needed for the output samples from start to end"""
+        step = self.step(old_len, new_len)
+        return int((start * step)), min(int((end - 1) * step) + 2, old_len)
+
+
+    def resample_part(self, chunk: np.ndarray, offset: int, old_len: int, new_len: int, start: int, end: int) -> np.ndarray:
+        """ Returns the output samples from start to end of resampling old_len samples to new_len samples.
+        chunk holds the input samples from offset on, at least the span of the output samples.
+        Computing the output in parts gives the same samples as resample, so long inputs can be streamed
+        """
+        return self.lerp(chunk, offset, old_len, np.arange(start, end) * self.step(old_len, new_len))
+
+
+    @staticmethod
+    def reach(step: float) -> int:
+        """Returns how many input samples on each side of a position interpolate reads for positions step apart"""
+        return 1
+
+
+    def interpolate(self, input: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """ Returns the input at fractional positions, which don't have to be evenly spaced,
+        so the ratio can change over time. Returns a float32 array
+        """
+        output = np.empty((len(positions),) + input.shape[1:], dtype=np.float32)
+        for start in range(0, len(positions), self.block_len):
+            end = min(start + self.block_len, len(positions))
+            output[start:end] = self.lerp(input, 0, len(input), np.clip(positions[start:end], 0, len(input) - 1))
+
+        return output
+
+
+    @staticmethod
+    def lerp(chunk: np.ndarray, offset: int, old_len: int, positions: np.ndarray) -> np.ndarray:
+        """Interpolates between the two input samples around every position, chunk holds the input from offset on"""
+        left = positions.astype(np.intp)
+        right = np.minimum(left + 1, old_len - 1)
+        f = (positions - left).astype(np.float32).reshape((-1,) + (1,) * (chunk.ndim - 1))
+
+        a = chunk[left - offset].astype(np.float32)
+        return a + f * (chunk[right - offset] - a)
+
+
+class SincResampler:
+    """ Band-limited interpolation with a Kaiser windowed sinc filter.
+
+    Every output sample is a weighted sum of 2 * half_taps input samples around its position.
+    The weights for num_phases fractional positions between two input samples are precomputed,
+    the nearest one is used. When the signal is shortened, the cut-off frequency is lowered
+    to the new Nyquist frequency, so frequencies which can't be represented are removed instead of aliased.
+    """
+    def __init__(self, half_taps=16, num_phases=1024, beta=8.6, rolloff=0.85, block_len=2**15):
+        self.half_taps = half_taps
+        self.num_phases = num_phases
+        # Shape of the Kaiser window, larger values attenuate more but widen the transition band
+        self.beta = beta
+        # Cut-off frequency relative to the Nyquist frequency
+        self.rolloff = rolloff
+        self.block_len = block_len
+
+
+    def resample(self, input: np.ndarray, new_len: int) -> np.ndarray:
+        """ Resamples input to new_len samples, sample n of the output is at the position n * len(input) / new_len.
+        Multichannel audio is resampled along the first axis. Returns a float32 array
+        """
+        ratio = Fraction(len(input), new_len) if new_len > 0 else Fraction(1)
+        return self.convolve(input, new_len, *self.plan(ratio))
+
+
+    def step(self, old_len: int, new_len: int) -> float:
+        """Returns the distance of the output samples in input samples"""
+        return old_len / new_len if new_len > 0 else 1.0
+
+
+    def plan(self, ratio: Fraction) -> tuple:
+        """Returns the filter table and a function mapping output indexes to input indexes and table rows"""
+        cutoff = self.rolloff * min(1.0, 1 / float(ratio))
+        table = filter_table(self.num_phases, self.half_taps, round(cutoff, 6), self.beta)
+        step = float(ratio)
+
+        def locate(indices):
+            positions = indices * step
+            base = np.floor(positions).astype(np.intp)
+            phase = np.round((positions - base) * self.num_phases).astype(np.intp)
+            # A fraction rounded up to a whole sample belongs to the next sample
+            carry = phase == self.num_phases
+            return base + carry, np.where(carry, 0, phase)
+
+        return table, locate
+
+
+    def convolve(self, input: np.ndarray, new_len: int, table: np.ndarray, locate, offset=0, old_len=None,
+                 start=0, end=None) -> np.ndarray:
+        """ Computes the output samples from start to end block by block as weighted sums of the input samples
+        around each output sample. input holds the samples of an input of old_len samples from offset on
+        """
+        old_len = len(input) if old_len is None else old_len
+        end = new_len if end is None else end
+        output = np.empty((end - start,) + input.shape[1:], dtype=np.float32)
+
+        for block_start in range(start, end, self.block_len):
+            block_end = min(block_start + self.block_len, end)
+            base, phase = locate(np.arange(block_start, block_end))
+            output[block_start - start: block_end - start] = self.gather(input, offset, old_len, table, base, phase)
+
+        return output
+
+
+    @staticmethod
+    def gather(input: np.ndarray, offset: int, old_len: int, table: np.ndarray, base: np.ndarray,
+               phase: np.ndarray) -> np.ndarray:
+        """ Returns the weighted sums of the input samples around the increasing input indexes base
+        with the rows phase of the filter table
+        """
+        half = table.shape[1] // 2
+        offsets = np.arange(-half + 1, half + 1)
+
+        # Only the input samples used by this block are copied, the input is zero outside of its range
+        low = base[0] - half + 1
+        high = base[-1] + half + 1
+        chunk = np.zeros((high - low,) + input.shape[1:], dtype=np.float32)
+        inside_low, inside_high = max(low, 0), min(high, old_len)
+        if inside_low < inside_high:
+            chunk[inside_low - low: inside_high - low] = input[inside_low - offset: inside_high - offset]
+
+        taps = chunk[(base - low)[:, np.newaxis] + offsets]
+        return np.einsum("ij,ij...->i...", table[phase], taps)
+
+
+    def cutoff(self, step: float) -> float:
+        """Returns the cut-off interpolate uses for positions step apart, rounded so only a few tables are used"""
+        return round(self.rolloff * min(1.0, 1 / step) if step > 0 else self.rolloff, 2)
+
+
+    def reach(self, step: float) -> int:
+        """Returns how many input samples on each side of a position interpolate reads for positions step apart"""
+        return int(np.ceil(self.half_taps / self.cutoff(step)))
+
+
+    def interpolate(self, input: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """ Returns the input at increasing fractional positions, which don't have to be evenly spaced,
+        so the ratio can change over time. The cut-off of every block is lowered for its largest step,
+        rounded to 0.01 so only a few filter tables are used. Returns a float32 array
+        """
+        output = np.empty((len(positions),) + input.shape[1:], dtype=np.float32)
+
+        for start in range(0, len(positions), self.block_len):
+            end = min(start + self.block_len, len(positions))
+            block = positions[start:end]
+            step = np.diff(block).max() if len(block) > 1 else 1.0
+            table = filter_table(self.num_phases, self.half_taps, self.cutoff(step), self.beta)
+
+            base = np.floor(block).astype(np.intp)
+            phase = np.round((block - base) * self.num_phases).astype(np.intp)
+            carry = phase == self.num_phases
+            output[start:end] = self.gather(input, 0, len(input), table, base + carry, np.where(carry, 0, phase))
+
+        return output
+
+
+    def span(self, old_len: int, new_len: int, start: int, end: int) -> tuple:
+        """Returns the range of input samples needed for the output samples from start to end"""
+        table, locate = self.plan(Fraction(old_len, new_len) if new_len > 0 else Fraction(1))
+        half = table.shape[1] // 2
+        base, _ = locate(np.array([start, end - 1]))
+        return max(int(base[0]) - half + 1, 0), min(int(base[1]) + half + 1, old_len)
+
+
+    def resample_part(self, chunk: np.ndarray, offset: int, old_len: int, new_len: int, start: int, end: int) -> np.ndarray:
+        """ Returns the output samples from start to end of resampling old_len samples to new_len samples.
+        chunk holds the input samples from offset on, at least the span of the output samples.
+        Computing the output in parts gives the same samples as resample, so long inputs can be streamed
+        """
+        ratio = Fraction(old_len, new_len) if new_len > 0 else Fraction(1)
+        return self.convolve(chunk, new_len, *self.plan(ratio), offset, old_len, start, end)
+
+
+class PolyphaseResampler(SincResampler):
+    """ Rational resampler with a polyphase filter.
+
+    The ratio of the lengths is approximated by a fraction down / up with up at most max_phases.
+    Output samples then fall exactly on up different fractional positions, every one of them has
+    its own row of the filter table, so there is no error from rounding the positions.
+    """
+    def __init__(self, half_taps=24, max_phases=1024, beta=8.6, rolloff=0.9, block_len=2**15):
+        super().__init__(half_taps, max_phases, beta, rolloff, block_len)
+
+
+    def step(self, old_len: int, new_len: int) -> float:
+        return float(Fraction(old_len, new_len).limit_denominator(self.num_phases)) if new_len > 0 else 1.0
+
+
+    def plan(self, ratio: Fraction) -> tuple:
+        ratio = ratio.limit_denominator(self.num_phases)
+        down, up = ratio.numerator, ratio.denominator
+
+        cutoff = self.rolloff * min(1.0, up / down)
+        table = filter_table(up, self.half_taps, round(cutoff, 6), self.beta)
+
+        def locate(indices):
+            positions = indices * down
+            return positions // up, positions % up
+
+        return table, locate
+
+
+@lru_cache(maxsize=32)
+def filter_table(num_phases: int, half_taps: int, cutoff: float, beta: float) -> np.ndarray:
+    """ Returns the Kaiser windowed sinc filter for num_phases fractional positions as a float32 table,
+    one row per position. Tables are cached, because the same ratios are used again and again.
+
+    The filter is widened by 1 / cutoff, so its transition band stays the same relative to the cut-off.
+    Every row is normalised to a sum of 1, so a constant signal keeps its level
+    """
+    half = int(np.ceil(half_taps / cutoff))
+    taps = np.arange(-half + 1, half + 1)
+    fractions = np.arange(num_phases) / num_phases
+
+    # Distance of every tap from the output position
+    u = fractions[:, np.newaxis] - taps
+    window = np.i0(beta * np.sqrt(np.clip(1 - np.square(u / half), 0, 1))) / np.i0(beta)
+    table = cutoff * np.sinc(cutoff * u) * window
+    table /= table.sum(axis=1, keepdims=True)
+
+    table = table.astype(np.float32)
+    table.flags.writeable = False
+    return table
+
+
+# Resampling engines by name, ordered from the fastest to the highest quality
+RESAMPLERS = {"linear": LinearResampler, "sinc": SincResampler, "polyphase": PolyphaseResampler}
+
+def make_resampler(name: str):
+    """Returns a new resampling engine by its name"""
+    if name not in RESAMPLERS:
+        raise ValueError(f"Unknown resampling engine {name!r}, use one of {', '.join(RESAMPLERS)}")
+    return RESAMPLERS[name]()
@@ -0,0 +1,107 @@
+import numpy as np
+
+class RingBuffer:
+    """ Preallocated single-producer, single-consumer ring buffer of float32 audio frames.
+
+    One thread writes with write and flush, one thread (the OutputStream callback) reads with read_into.
+    The producer only advances write_count and flush_count and the consumer only advances read_count,
+    every counter is a single attribute assignment, so no lock is needed.
+    A counter is advanced after the frames are copied, so the other side never sees unfinished frames.
+
+    read_into copies into the given array and doesn't allocate any arrays, so it is safe in a realtime callback.
+    Every frame carries a position - the index of the original audio it was computed from,
+    position is the position of the last frame read, used to follow the playback.
+    """
+    def __init__(self, capacity: int, channels=1):
+        self.capacity = capacity
+        self.channels = channels
+        self.data = np.zeros((capacity, channels), dtype=np.float32)
+        self.positions = np.zeros(capacity)
+
+        # Numbers of frames written and read since the start, they only grow
+        self.write_count = 0
+        self.read_count = 0
+        # Frames written before this count were dropped by flush
+        self.flush_count = 0
+
+        # Reads which got fewer frames than they requested and the number of missing frames
+        self.underruns = 0
+        self.underrun_frames = 0
+
+        self.position = 0.0
+
+
+    def space(self) -> int:
+        """Returns the number of frames the producer can write"""
+        return self.capacity - (self.write_count - self.read_count)
+
+
+    def available(self) -> int:
+        """Returns the number of frames the consumer can read"""
+        return self.write_count - max(self.read_count, self.flush_count)
+
+
+    def fill_level(self) -> float:
+        """Returns the part of the capacity waiting to be read, from 0.0 to 1.0"""
+        return self.available() / self.capacity
+
+
+    def write(self, block: np.ndarray, position=0.0) -> int:
+        """ Copies frames of block (mono or of the shape (frames, channels)) into the buffer.
+        position is a single value for the whole block or one value per frame.
+        Returns the number of frames written, which is smaller than len(block) if the buffer is full
+        """
+        block = block.reshape(len(block), -1)
+        n = min(len(block), self.space())
+        start = self.write_count % self.capacity
+        first = min(n, self.capacity - start)
+
+        # The frames can wrap around the end of the buffer
+        self.data[start: start + first] = block[:first]
+        self.data[: n - first] = block[first: n]
+        if np.ndim(position) == 0:
+            self.positions[start: start + first] = position
+            self.positions[: n - first] = position
+        else:
+            self.positions[start: start + first] = position[:first]
+            self.positions[: n - first] = position[first: n]
+
+        self.write_count += n
+        return n
+
+
+    def flush(self):
+        """Drops all frames written so far, called by the producer when the audio changes"""
+        self.flush_count = self.write_count
+
+
+    def skip_flushed(self):
+        """Skips the frames dropped by flush, called by the consumer, so the producer can use their space"""
+        flush_count = self.flush_count
+        if flush_count > self.read_count:
+            self.read_count = flush_count
+
+
+    def read_into(self, out: np.ndarray) -> int:
+        """ Fills out, an array of the shape (frames, channels), with the next frames.
+        If there are not enough frames, the rest is filled with zeros and an underrun is counted.
+        Returns the number of frames read
+        """
+        self.skip_flushed()
+        frames = len(out)
+        n = min(frames, self.write_count - self.read_count)
+        start = self.read_count % self.capacity
+        first = min(n, self.capacity - start)
+
+        out[:first] = self.data[start: start + first]
+        out[first: n] = self.data[: n - first]
+
+        if n < frames:
+            out[n:] = 0
+            self.underruns += 1
+            self.underrun_frames += frames - n
+        if n > 0:
+            self.position = float(self.positions[(self.read_count + n - 1) % self.capacity])
+
+        self.read_count += n
+        return n
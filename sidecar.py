@@ -0,0 +1,97 @@
+import os
+from abc import ABC, abstractmethod
+import numpy as np
+
+class Sidecar(ABC):
+    """ Data computed from a whole audio file, which is saved into a sidecar .npz file next to it,
+    so reopening the file skips the computation. Base of AnalysisIndex and PeakPyramid.
+
+    The file holds the integer settings starting with the version of the format, the signature of the audio file
+    and the arrays of the subclass. Subclasses set suffix and version and implement settings, arrays and from_file
+    """
+    # Added to the path of the audio file
+    suffix = ".npz"
+    # Version of the sidecar file format
+    version = 1
+
+    @abstractmethod
+    def settings(self) -> tuple:
+        """Returns the integers describing the saved data, they are stored after the version"""
+
+
+    @abstractmethod
+    def arrays(self) -> dict:
+        """Returns the arrays saved into the file by their names"""
+
+
+    @classmethod
+    @abstractmethod
+    def from_file(cls, file, settings: tuple, **context):
+        """ Returns the instance of an opened file of the same version and audio file,
+        settings are the integers after the version. Returns None if it doesn't fit the context
+        """
+
+
+    @classmethod
+    def sidecar_path(cls, source_path: str) -> str:
+        """Returns the path of the sidecar file of an audio file"""
+        return source_path + cls.suffix
+
+
+    @staticmethod
+    def source_signature(source_path: str) -> np.ndarray:
+        """Size and modification time of the audio file, used to detect that it changed"""
+        info = os.stat(source_path)
+        return np.array([info.st_size, info.st_mtime_ns], dtype=np.int64)
+
+
+    def save(self, path: str, source_path=None):
+        """Saves the data into an .npz file, the file is replaced only once it is complete"""
+        settings = np.array((self.version,) + tuple(self.settings()), dtype=np.int64)
+        signature = self.source_signature(source_path) if source_path else np.zeros(2, dtype=np.int64)
+
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, settings=settings, signature=signature, **self.arrays())
+        os.replace(temporary, path)
+
+
+    @classmethod
+    def load(cls, path: str, source_path=None, **context):
+        """ Loads data saved by save, context is passed to from_file.
+        Returns None if the file is missing, has another version or the audio file changed since
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as file:
+            settings = tuple(int(v) for v in file["settings"])
+            if settings[0] != cls.version:
+                return None
+            if source_path and not np.array_equal(file["signature"], cls.source_signature(source_path)):
+                return None
+
+            return cls.from_file(file, settings[1:], **context)
+
+
+    @classmethod
+    def load_or_create(cls, source_path: str, create, accept=None, **context):
+        """ Loads the sidecar file of source_path if it exists, matches and accept (if given) returns True for it,
+        otherwise returns the result of create and tries to save it into the sidecar file
+        """
+        path = cls.sidecar_path(source_path)
+
+        try:
+            loaded = cls.load(path, source_path, **context)
+        except (OSError, ValueError, KeyError):
+            loaded = None
+        if loaded is not None and (accept is None or accept(loaded)):
+            return loaded
+
+        created = create()
+        try:
+            created.save(path, source_path)
+        except OSError:
+            # The directory might be read-only, the data is still used from memory
+            pass
+        return created
@@ -0,0 +1,181 @@
+import struct
+import threading
+import numpy as np
+import soundfile as sf
+from collections import OrderedDict
+
+class AudioSource:
+    """ Audio of a sound file, decoded lazily when it is sliced.
+
+    It can be used as AudioProcessor.data instead of an array - len() returns the number of samples
+    and slicing returns a float32 numpy array of the mono mix of all channels,
+    or of the shape (samples, channels) if mono is False.
+    Only the requested range is read, in blocks of block_len samples, and every block is downmixed on its own,
+    so the memory used doesn't depend on the length of the file.
+    PCM and float WAV files are memory-mapped, other formats are read through soundfile.SoundFile.seek and read.
+    The last cache_blocks blocks of short reads are kept decoded, because playback reads the same regions again.
+    """
+    def __init__(self, path: str, block_len=2**16, cache_blocks=32, mono=True):
+        self.path = path
+        self.mono = mono
+        self.block_len = block_len
+        self.cache_blocks = cache_blocks
+
+        info = sf.info(path)
+        self.samplerate = info.samplerate
+        self.channels = info.channels
+        self.length = info.frames
+
+        # Attributes of a float32 array
+        self.dtype = np.dtype(np.float32)
+        self.shape = (self.length,) if mono else (self.length, self.channels)
+        self.ndim = len(self.shape)
+
+        # Memory-mapped samples of a WAV file and the scale converting them to [-1.0, 1.0]
+        self.mapped, self.scale = self.map_wav(path, self.channels, self.length)
+        # Opened on the first read, if the file is not memory-mapped
+        self.file = None
+
+        # Block index -> decoded mono block, the least recently used block is first
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Playback, background renders and the analysis read from several threads
+        self.lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        return self.length
+
+
+    def __getitem__(self, key) -> np.ndarray:
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            data = self.read(start, max(stop, start)) if step > 0 else self.read(stop + 1, start + 1)[::-1]
+            return data[::abs(step)] if abs(step) != 1 else data
+
+        index = int(key)
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Index out of range")
+        return self.read(index, index + 1)[0]
+
+
+    def read(self, start_index: int, end_index: int) -> np.ndarray:
+        """Returns the samples from start_index to end_index as a float32 array"""
+        start_index = max(start_index, 0)
+        end_index = min(end_index, self.length)
+        result = np.empty((max(end_index - start_index, 0),) + self.shape[1:], dtype=np.float32)
+
+        # Long reads would only evict the cached blocks
+        use_cache = len(result) <= self.block_len * self.cache_blocks // 2
+
+        position = start_index
+        while position < end_index:
+            n = position // self.block_len
+            block = self.block(n) if use_cache else self.decode(n)
+
+            offset = position - n * self.block_len
+            length = min(len(block) - offset, end_index - position)
+            result[position - start_index: position - start_index + length] = block[offset: offset + length]
+            position += length
+
+        return result
+
+
+    def block(self, n: int) -> np.ndarray:
+        """Returns the n-th decoded block from the cache"""
+        with self.lock:
+            if n in self.blocks:
+                self.blocks.move_to_end(n)
+                self.hits += 1
+                return self.blocks[n]
+            self.misses += 1
+
+        block = self.decode(n)
+
+        with self.lock:
+            self.blocks[n] = block
+            while len(self.blocks) > self.cache_blocks:
+                self.blocks.popitem(last=False)
+        return block
+
+
+    def decode(self, n: int) -> np.ndarray:
+        """Reads the n-th block and mixes it down to mono, unless mono is False"""
+        start = n * self.block_len
+        end = min(start + self.block_len, self.length)
+
+        if self.mapped is not None:
+            d = self.mapped[start:end].astype(np.float32)
+            if self.scale != 1:
+                d *= self.scale
+        else:
+            with self.lock:
+                if self.file is None:
+                    self.file = sf.SoundFile(self.path)
+                self.file.seek(start)
+                d = self.file.read(end - start, dtype="float32", always_2d=True)
+
+            # The length reported for compressed files can be a little longer than the decoded audio
+            if len(d) < end - start:
+                d = np.concatenate((d, np.zeros((end - start - len(d), d.shape[1]), dtype=np.float32)))
+
+        return np.mean(d, axis=1) if self.mono else d
+
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache of decoded blocks"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.blocks),
+                "bytes": sum(block.nbytes for block in list(self.blocks.values()))}
+
+
+    @staticmethod
+    def map_wav(path: str, channels: int, length: int) -> tuple:
+        """ Memory-maps the samples of a 16 or 32 bit PCM or 32 bit float WAV file.
+        Returns the (length, channels) array and the scale of the samples, or (None, 1) for other files
+        """
+        with open(path, "rb") as file:
+            header = file.read(12)
+            if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+                return None, 1
+
+            # Walk through the chunks until the samples
+            fmt = None
+            while True:
+                chunk = file.read(8)
+                if len(chunk) < 8:
+                    return None, 1
+                chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+
+                if chunk_id == b"fmt ":
+                    body = file.read(size + size % 2)
+                    if len(body) < 16:
+                        return None, 1
+                    tag, fmt_channels, _, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+                    # WAVE_FORMAT_EXTENSIBLE stores the format in its sub-format
+                    if tag == 0xFFFE and len(body) >= 26:
+                        tag = struct.unpack("<H", body[24:26])[0]
+                    fmt = (tag, bits)
+                elif chunk_id == b"data":
+                    offset = file.tell()
+                    break
+                else:
+                    file.seek(size + size % 2, 1)
+
+        formats = {(1, 16): ("<i2", 1 / 2**15), (1, 32): ("<i4", 1 / 2**31), (3, 32): ("<f4", 1)}
+        if fmt not in formats or fmt_channels != channels:
+            return None, 1
+
+        dtype, scale = formats[fmt]
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length, channels)), scale
+
+
+    def __getstate__(self):
+        # Copies sent to other processes open the file again, the lock and open files can't be pickled
+        return {"path": self.path, "block_len": self.block_len, "cache_blocks": self.cache_blocks, "mono": self.mono}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["block_len"], state["cache_blocks"], state["mono"])
@@ -0,0 +1,153 @@
+import numpy as np
+from collections import deque
+from audio_processing import AudioProcessor, VocoderState
+
+class StreamingVocoder:
+    """ Computes time stretched and pitch shifted audio of a looped segment block by block
+    while it is being played, instead of processing the whole segment before playback.
+
+    The phase vocoder state, the overlap-add tail and the resampler position are carried over
+    between calls, so the output continues seamlessly and stretch and pitch factors
+    can be changed at any time without recomputing anything.
+    Pitch shifting uses the resampling engine of the processor. The stretched samples it reads
+    before the playback position are kept as history, so the blocks join like one resampled signal,
+    and the samples it reads after it are synthesised first, which adds latency of a few samples.
+    """
+    def __init__(self, processor: AudioProcessor, start_index: int, end_index: int,
+                 stretch_factor=1.0, pitch_factor=1.0, frames_per_step=4):
+
+        # The loop has to fit at least one analysis frame
+        if end_index - start_index < processor.window_len or start_index < 0 or end_index > len(processor.data):
+            raise ValueError("Invalid index range")
+
+        self.AP = processor
+        self.hop_a = processor.analysis_hop()
+        # Multichannel audio is streamed with all its channels, blocks have the shape (frames, channels)
+        self.channel_shape = processor.data.shape[1:]
+
+        # Loop boundaries in the original data array
+        self.start_index = start_index
+        self.end_index = end_index
+
+        self.stretch_factor = stretch_factor
+        self.pitch_factor = pitch_factor
+
+        # Number of frames processed together when more output is needed
+        self.frames_per_step = frames_per_step
+
+        self.restart()
+
+
+    def restart(self):
+        """Starts processing from the beginning of the loop with a fresh vocoder state"""
+        # Index of the next analysis frame in the original data array
+        self.position = self.start_index
+        self.state = VocoderState()
+
+        # Overlapping parts of the already synthesised blocks which are not finished yet
+        self.tail = np.zeros((self.AP.window_len,) + self.channel_shape)
+
+        # Time stretched audio waiting to be resampled (after the history the resampler reads)
+        # and the position of the next output sample in it
+        self.stretched = np.zeros((0,) + self.channel_shape)
+        self.resample_position = 0.0
+
+        # Pairs of [number of stretched samples, original index] used to follow the playback position
+        self.pending = deque()
+        self.source_index = self.start_index
+
+        self.restart_requested = False
+
+
+    def rewind(self):
+        """Makes the next read start from the beginning of the loop, safe to call from another thread"""
+        self.restart_requested = True
+
+
+    def set_factors(self, stretch_factor: float, pitch_factor: float):
+        """Changes the factors, they apply from the next processed frames"""
+        self.stretch_factor = stretch_factor
+        self.pitch_factor = pitch_factor
+
+
+    def read(self, frames: int) -> np.ndarray:
+        """ Returns the next block of output audio of length frames.
+
+        Only as many analysis frames as needed for the block are processed,
+        so the first block is ready after a single window of latency.
+        """
+        if self.restart_requested:
+            self.restart()
+
+        # Pitch shifting plays the stretched audio faster or slower
+        step = self.pitch_factor
+        reach = self.AP.resampler.reach(step)
+
+        # Synthesise until all input samples of the last output sample are available
+        needed = int(np.floor(self.resample_position + (frames - 1) * step)) + reach + 1
+        while len(self.stretched) < needed:
+            self.step()
+
+        positions = self.resample_position + step * np.arange(frames)
+        block = self.AP.resampler.interpolate(self.stretched[:needed], positions)
+
+        # Drop the stretched samples before the history of the next block
+        next_position = self.resample_position + frames * step
+        self.advance_source_index(int(np.floor(next_position)) - int(np.floor(self.resample_position)))
+        dropped = max(int(np.floor(next_position)) - reach, 0)
+        self.resample_position = next_position - dropped
+        self.stretched = self.stretched[dropped:]
+
+        return block
+
+
+    def step(self):
+        """Synthesises the next few analysis frames and appends the finished samples to stretched"""
+        window_len = self.AP.window_len
+
+        # Pitch shifting needs the audio stretched by both factors before resampling
+        hop_s = int(round(self.stretch_factor * self.pitch_factor * self.hop_a))
+
+        # Frames which fit into the loop from the current position
+        num_frames = min((self.end_index - self.position - window_len) // self.hop_a + 1, self.frames_per_step)
+
+        # Wrap around to the start of the loop, treating its first frame as a new starting frame
+        if num_frames <= 0:
+            self.position = self.start_index
+            workspace = self.state.workspace
+            self.state = VocoderState()
+            # The work buffers are kept, so looping doesn't allocate them again
+            self.state.workspace = workspace
+            num_frames = min((self.end_index - self.position - window_len) // self.hop_a + 1, self.frames_per_step)
+
+        segment = self.AP.data[self.position: self.position + (num_frames - 1) * self.hop_a + window_len]
+        blocks = self.AP.frames(segment, self.hop_a)
+
+        output = self.AP.synthesise(blocks, self.hop_a, hop_s, self.state)
+        output *= self.AP.overlap_gain(hop_s)
+
+        # Add the blocks to the unfinished tail, the first num_frames * hop_s samples are then complete
+        finished_len = num_frames * hop_s
+        buffer = np.zeros((finished_len + window_len,) + self.channel_shape)
+        buffer[:window_len] = self.tail
+        self.AP.overlap_add(buffer, output, 0, hop_s)
+
+        self.tail = buffer[finished_len:]
+        self.stretched = np.concatenate((self.stretched, buffer[:finished_len]))
+
+        for n in range(num_frames):
+            self.pending.append([hop_s, self.position + n * self.hop_a])
+        self.position += num_frames * self.hop_a
+
+
+    def advance_source_index(self, consumed: int):
+        """ Updates source_index, the index in the original data of the audio which is being played,
+        consumed is the number of stretched samples the playback position moved by
+        """
+        while self.pending and consumed >= self.pending[0][0]:
+            consumed -= self.pending[0][0]
+            self.pending.popleft()
+
+        if self.pending:
+            self.pending[0][0] -= consumed
+            self.source_index = self.pending[0][1]
@@ -0,0 +1,113 @@
+import numpy as np
+
+# Levels of silent frames in decibels, log of zero is avoided
+SILENCE_DB = -120.0
+
+
+def to_db(values: np.ndarray) -> np.ndarray:
+    """Converts powers to decibels, values up to 1e-12 are SILENCE_DB"""
+    return np.where(values > 1e-12, 10 * np.log10(np.maximum(values, 1e-12)), SILENCE_DB)
+
+
+def rises(levels: np.ndarray, previous: float, threshold: float) -> np.ndarray:
+    """Returns True for every frame whose level rose by more than threshold from the previous frame"""
+    before = np.empty_like(levels)
+    before[0] = previous
+    before[1:] = levels[:-1]
+    return levels - before > threshold
+
+
+class EnergyDetector:
+    """ A transient is a sudden high energy event in a signal.
+    They are often caused by drums or attack portions of sounds.
+
+    A frame is a transient if its energy in decibels is more than threshold_db above the previous frame.
+    The energy is weighted by the squared window once more, as the frames always were.
+    All channels of a multichannel frame count together.
+    """
+    name = "energy"
+
+    def __init__(self, threshold_db=6.0):
+        self.threshold_db = threshold_db
+
+
+    def key(self) -> tuple:
+        """Returns the settings changing the detected transients, used in the cache keys"""
+        return (self.name, self.threshold_db)
+
+
+    def detect(self, blocks: np.ndarray, mag: np.ndarray, plan, previous) -> tuple:
+        """ Detects transients in a batch of windowed blocks with their magnitude spectra.
+        plan is the VocoderPlan of the blocks, its tables (window_square, bin_weights) are precomputed
+        and shared by all threads.
+        previous is the value returned for the previous batch, None before the first one.
+        Returns the transient flags and the value for the next batch
+        """
+        # Sums of squares of all frames at once, einsum doesn't need a temporary array of the squares
+        energy = np.einsum("f...i,f...i,i->f...", blocks, blocks,
+                           plan.window_square.astype(blocks.dtype, copy=False))
+        levels = to_db(energy.reshape(len(energy), -1).sum(axis=1))
+        # The first frame of a file is compared with 0 dB
+        flags = rises(levels, 0.0 if previous is None else previous, self.threshold_db)
+        return flags, levels[-1]
+
+
+class SpectralFluxDetector:
+    """ A frame is a transient if the magnitudes which grew since the previous frame add up to more
+    than threshold of the sum of its magnitudes. It reacts to new notes even when the energy stays the same
+    """
+    name = "flux"
+
+    def __init__(self, threshold=0.4):
+        self.threshold = threshold
+
+
+    def key(self) -> tuple:
+        return (self.name, self.threshold)
+
+
+    def detect(self, blocks: np.ndarray, mag: np.ndarray, plan, previous) -> tuple:
+        mag = mag.reshape(len(mag), -1)
+        before = np.empty_like(mag)
+        # The first frame of a file grows from silence
+        before[0] = 0 if previous is None else previous
+        before[1:] = mag[:-1]
+
+        growth = np.maximum(np.subtract(mag, before, out=before), 0, out=before).sum(axis=1)
+        total = mag.sum(axis=1)
+        flags = growth > self.threshold * np.maximum(total, 1e-12)
+        return flags, mag[-1].copy()
+
+
+class HighFrequencyContentDetector:
+    """ High frequency content weights the power of every bin by its index, so short broadband attacks
+    stand out from tonal sounds. A frame is a transient if it is more than threshold_db above the previous frame
+    """
+    name = "hfc"
+
+    def __init__(self, threshold_db=6.0):
+        self.threshold_db = threshold_db
+
+
+    def key(self) -> tuple:
+        return (self.name, self.threshold_db)
+
+
+    def detect(self, blocks: np.ndarray, mag: np.ndarray, plan, previous) -> tuple:
+        # The weights are kept by the plan for its number of bins, the detector has no state of its own
+        content = np.einsum("f...i,f...i,i->f...", mag, mag, plan.bin_weights.astype(mag.dtype, copy=False))
+        levels = to_db(content.reshape(len(content), -1).sum(axis=1))
+        flags = rises(levels, SILENCE_DB if previous is None else previous, self.threshold_db)
+        return flags, levels[-1]
+
+
+# Transient detectors by name
+DETECTORS = {"energy": EnergyDetector, "flux": SpectralFluxDetector, "hfc": HighFrequencyContentDetector}
+
+def make_detector(detector):
+    """Returns a new transient detector by its name with the default threshold, detector instances are kept"""
+    if not isinstance(detector, str):
+        return detector
+    if detector not in DETECTORS:
+        raise ValueError(f"Unknown transient detector {detector!r}, use one of {', '.join(DETECTORS)}")
+    return DETECTORS[detector]()
@@ -0,0 +1,149 @@
+import numpy as np
+from sidecar import Sidecar
+
+class PeakPyramid(Sidecar):
+    """ Minimum, maximum and RMS of the mono mix of a whole file at power-of-two decimation levels,
+    used to draw its waveform.
+
+    Level k holds one value per block of base * 2**k samples, every level is half as long as the previous one.
+    columns picks the level with blocks just shorter than a column of the drawing, so any view of the file
+    is reduced from at most two blocks per column - the time doesn't depend on the length of the file.
+    All levels together take about 24 / base bytes per sample.
+
+    Like AnalysisIndex, the pyramid can be saved into a sidecar .peaks.npz file next to the audio file.
+    """
+    suffix = ".peaks.npz"
+    version = 1
+
+    def __init__(self, data, mins: list, maxs: list, power: list, base: int):
+        # Data is kept to draw views shorter than a block of level 0 from the samples
+        self.data = data
+        self.mins = mins
+        self.maxs = maxs
+        # Mean squares of the blocks, RMS is their square root
+        self.power = power
+        self.base = base
+
+
+    @staticmethod
+    def mono(samples: np.ndarray) -> np.ndarray:
+        """Returns the mono mix of samples as float32"""
+        samples = np.asarray(samples, dtype=np.float32)
+        return samples.mean(axis=1) if samples.ndim > 1 else samples
+
+
+    @staticmethod
+    def reduce(samples: np.ndarray, block_len: int) -> tuple:
+        """Returns minima, maxima and mean squares of the blocks of samples, the last block can be shorter"""
+        n = len(samples) // block_len
+        full = samples[: n * block_len].reshape(n, block_len)
+        mins, maxs = full.min(axis=1), full.max(axis=1)
+        power = np.einsum("ij,ij->i", full, full) / block_len
+
+        rest = samples[n * block_len:]
+        if len(rest):
+            mins = np.append(mins, rest.min())
+            maxs = np.append(maxs, rest.max())
+            power = np.append(power, np.dot(rest, rest) / len(rest))
+        return mins, maxs, power.astype(np.float32)
+
+
+    @classmethod
+    def build(cls, data, base=256, chunk_len=2**20, progress=None) -> "PeakPyramid":
+        """ Computes the pyramid of data in one pass over chunks of chunk_len samples, so the memory used
+        doesn't depend on the length of the file and an AudioSource is decoded only once.
+        progress is called with the part of the data done after every chunk
+        """
+        chunk_len = max(chunk_len // base, 1) * base
+        num_blocks = -(-len(data) // base)
+
+        mins = np.empty(num_blocks, dtype=np.float32)
+        maxs = np.empty(num_blocks, dtype=np.float32)
+        power = np.empty(num_blocks, dtype=np.float32)
+
+        for start in range(0, len(data), chunk_len):
+            end = min(start + chunk_len, len(data))
+            blocks = slice(start // base, -(-end // base))
+            mins[blocks], maxs[blocks], power[blocks] = cls.reduce(cls.mono(data[start:end]), base)
+
+            if progress is not None:
+                progress(end / len(data))
+
+        levels = cls.decimate(mins, maxs, power)
+        return cls(data, *levels, base)
+
+
+    @staticmethod
+    def decimate(mins: np.ndarray, maxs: np.ndarray, power: np.ndarray) -> tuple:
+        """Returns the lists of all levels starting with the given level 0, every next level joins pairs of blocks"""
+        levels = ([mins], [maxs], [power])
+        while len(mins) > 1:
+            # An odd last block is kept on its own
+            n = len(mins) // 2 * 2
+            mins = np.append(np.minimum(mins[0:n:2], mins[1:n:2]), mins[n:])
+            maxs = np.append(np.maximum(maxs[0:n:2], maxs[1:n:2]), maxs[n:])
+            power = np.append((power[0:n:2] + power[1:n:2]) / 2, power[n:])
+
+            for level, values in zip(levels, (mins, maxs, power)):
+                level.append(values)
+        return levels
+
+
+    def columns(self, start_index: int, end_index: int, width: int) -> tuple:
+        """ Returns minima, maxima and RMS of width columns covering the samples from start_index to end_index.
+        Columns shorter than a sample repeat it
+        """
+        start_index = min(max(start_index, 0), len(self.data))
+        end_index = min(max(end_index, start_index + 1), len(self.data))
+        edges = start_index + np.arange(width) * ((end_index - start_index) / width)
+
+        samples_per_column = (end_index - start_index) / width
+        if samples_per_column < self.base:
+            # Short views are drawn from the samples, there are at most base * width of them
+            samples = self.mono(self.data[start_index:end_index])
+            indices = np.minimum(edges.astype(np.int64) - start_index, len(samples) - 1)
+            mins = np.minimum.reduceat(samples, indices)
+            maxs = np.maximum.reduceat(samples, indices)
+            power = np.add.reduceat(samples * samples, indices) / np.maximum(np.diff(indices, append=len(samples)), 1)
+            return mins, maxs, np.sqrt(power)
+
+        # The level with blocks of at most one column, every column reduces one or two blocks
+        level = min(int(np.log2(samples_per_column / self.base)), len(self.mins) - 1)
+        block_len = self.base << level
+        first = start_index // block_len
+        last = min(-(-end_index // block_len), len(self.mins[level]))
+        indices = np.minimum(edges.astype(np.int64) // block_len, last - 1) - first
+
+        mins = np.minimum.reduceat(self.mins[level][first:last], indices)
+        maxs = np.maximum.reduceat(self.maxs[level][first:last], indices)
+        counts = np.maximum(np.diff(indices, append=last - first), 1)
+        power = np.add.reduceat(self.power[level][first:last], indices) / counts
+        return mins, maxs, np.sqrt(power)
+
+
+    def settings(self) -> tuple:
+        return (self.base, len(self.data))
+
+
+    def arrays(self) -> dict:
+        """Only the level 0 is saved, the other levels are quickly decimated from it when loaded"""
+        return {"mins": self.mins[0], "maxs": self.maxs[0], "power": self.power[0]}
+
+
+    @classmethod
+    def from_file(cls, file, settings: tuple, data=None) -> "PeakPyramid":
+        """Returns None if the pyramid was computed from data of another length"""
+        base, data_len = settings
+        if data_len != len(data):
+            return None
+
+        levels = cls.decimate(file["mins"], file["maxs"], file["power"])
+        return cls(data, *levels, base)
+
+
+    @classmethod
+    def for_file(cls, data, source_path: str, progress=None) -> "PeakPyramid":
+        """ Loads the sidecar file of source_path if it matches data,
+        otherwise builds the pyramid, reporting the progress like build, and tries to save the sidecar file
+        """
+        return cls.load_or_create(source_path, lambda: cls.build(data, progress=progress), data=data)
@@ -0,0 +1,228 @@
+import threading
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import NamedTuple
+from audio_processing import AudioProcessor, Render
+from ring_buffer import RingBuffer
+
+class PlaybackBuffer(NamedTuple):
+    """ Immutable snapshot of the audio used for playback.
+    A new snapshot is published as a whole, so the OutputStream callback never sees
+    new out_data together with old playback indexes.
+    """
+    # Processed audio, None before the first computation
+    out_data: np.ndarray
+    # Indexes of the selected segment in out_data
+    pb_start_index: int
+    pb_end_index: int
+    # Index of the original audio where out_data starts and the stretch factor used to compute it
+    start_index: int
+    stretch_factor: float
+    # Original indexes and their indexes in out_data of a render with envelopes (Render.time_map),
+    # None for a fixed stretch factor
+    time_map: tuple = None
+
+
+# AudioProcessor of a worker process, it is sent only once when the process starts
+_processor = None
+
+def _init_process(processor: AudioProcessor):
+    global _processor
+    _processor = processor
+
+
+def _render(start_index: int, end_index: int, stretch_factor: float, pitch_factor: float) -> Render:
+    return _processor.render_extendable(start_index, end_index, stretch_factor, pitch_factor)
+
+
+def _extend(render: Render, start_index: int, end_index: int) -> Render:
+    return _processor.extend(render, start_index, end_index)
+
+
+class RenderWorker:
+    """ Computes out_data in the background, so the GUI and the playback of the current audio keep running.
+
+    Threads are used by default. NumPy FFTs release the GIL only partly, so processes can be used instead,
+    each of them gets its own copy of the AudioProcessor when it starts.
+    Only the newest request matters - older requests are cancelled if they haven't started yet
+    and their results are dropped otherwise.
+    """
+    def __init__(self, processor: AudioProcessor, use_processes=False, max_workers=2):
+        self.AP = processor
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers, initializer=_init_process, initargs=(processor,))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers)
+        self.use_processes = use_processes
+
+        # Future of the newest request and its arguments
+        self.future = None
+        self.request = None
+
+
+    def submit(self, start_index: int, end_index: int, stretch_factor: float, pitch_factor: float):
+        """ Starts computing AudioProcessor.render_extendable in the background,
+        superseding the previous request
+        """
+        if self.future is not None:
+            self.future.cancel()
+
+        self.request = (start_index, end_index, stretch_factor, pitch_factor)
+
+        # Worker processes have their own caches, so results computed by them are cached here
+        if self.use_processes:
+            if self.AP.cached(*self.request) is not None:
+                self.future = Future()
+                self.future.set_result(self.AP.render_extendable(*self.request))
+            else:
+                self.future = self.executor.submit(_render, *self.request)
+        else:
+            self.future = self.executor.submit(self.AP.render_extendable, *self.request)
+
+
+    def extend(self, render: Render, start_index: int, end_index: int):
+        """ Starts extending a finished render to a larger range in the background, only the added audio
+        is processed. It supersedes the previous request like submit
+        """
+        if self.future is not None:
+            self.future.cancel()
+
+        self.request = (start_index, end_index, render.stretch_factor, render.pitch_factor)
+
+        if self.use_processes:
+            self.future = self.executor.submit(_extend, render, start_index, end_index)
+        else:
+            self.future = self.executor.submit(self.AP.extend, render, start_index, end_index)
+
+
+    def busy(self) -> bool:
+        """Returns True if the newest request is not finished yet"""
+        return self.future is not None and not self.future.done()
+
+
+    def poll(self) -> Render:
+        """ Returns the Render of the newest request once, when it is finished, None otherwise.
+        Exceptions raised while processing are raised here
+        """
+        if self.future is None or not self.future.done():
+            return None
+
+        future = self.future
+        self.future = None
+        result = future.result()
+
+        if self.use_processes:
+            self.AP.store(*self.request, result.data)
+        return result
+
+
+    def shutdown(self):
+        """Stops the workers without waiting for the running request"""
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PlaybackProducer:
+    """ Thread filling the RingBuffer read by the OutputStream callback.
+
+    It plays the newest PlaybackBuffer snapshot of the application, or its StreamingVocoder if there is one,
+    in blocks of block_len frames and wraps around at the end of the loop.
+    A new snapshot, a new streamer or rewind drop the buffered frames, so the change is heard immediately.
+    Only this thread reads the loop indexes and computes the streamed audio, the callback only copies frames.
+    """
+    def __init__(self, application, ring: RingBuffer, block_len: int):
+        self.app = application
+        self.ring = ring
+        self.block_len = block_len
+
+        # Snapshot or streamer being played and the index of the next frame in out_data
+        self.source = None
+        self.index = 0
+
+        self.running = False
+        self.rewind_requested = False
+        # Set to wake the thread up before its timeout when something changes
+        self.wake = threading.Event()
+        self.thread = None
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """Stops the thread after the block it is writing"""
+        self.running = False
+        self.wake.set()
+
+
+    def notify(self):
+        """Makes the thread check the application for a new snapshot or streamer now"""
+        self.wake.set()
+
+
+    def rewind(self):
+        """Starts the playback from the start of the loop again, safe to call from another thread"""
+        self.rewind_requested = True
+        self.wake.set()
+
+
+    def run(self):
+        # Waiting for half a block keeps the buffer full without busy waiting
+        timeout = self.block_len / self.app.samplerate / 2
+        while self.running:
+            if not self.fill():
+                self.wake.wait(timeout)
+                self.wake.clear()
+
+
+    def fill(self) -> bool:
+        """Writes the next block into the ring buffer, returns False if there was nothing to write"""
+        app = self.app
+        source = app.streamer if app.streamer is not None else app.playback
+
+        if source is not self.source or self.rewind_requested:
+            self.rewind_requested = False
+            self.source = source
+            self.index = source.pb_start_index if isinstance(source, PlaybackBuffer) else 0
+            self.ring.flush()
+
+        if source is None or self.ring.space() < self.block_len:
+            return False
+
+        if isinstance(source, PlaybackBuffer):
+            if source.out_data is None or source.pb_end_index <= source.pb_start_index:
+                return False
+            self.write_loop(source)
+        else:
+            position = source.source_index
+            self.ring.write(source.read(self.block_len), position)
+
+        return True
+
+
+    def write_loop(self, playback: PlaybackBuffer):
+        """Writes the next block of the loop of out_data, a block crossing the end of the loop continues at its start"""
+        start, end = playback.pb_start_index, playback.pb_end_index
+        if not start <= self.index < end:
+            self.index = start
+
+        remaining = self.block_len
+        while remaining > 0:
+            length = min(remaining, end - self.index)
+            if playback.time_map is None:
+                position = playback.start_index + self.index / playback.stretch_factor
+            else:
+                # The stretch factor changes within the block, so every frame gets its own position
+                indexes, positions = playback.time_map
+                position = np.interp(np.arange(self.index, self.index + length), positions, indexes)
+            self.ring.write(playback.out_data[self.index: self.index + length], position)
+
+            remaining -= length
+            self.index += length
+            if self.index >= end:
+                self.index = start